@@ -1,17 +1,20 @@
 import numpy
-import scipy.integrate.odepack
 import matplotlib.pyplot
 import itertools
 
-initialCondition = [float(input('Initial Resource Density (0~1): '))]
+from simrules.ode import NStrainODE
+
+initialResources = float(input('Initial Resource Density (0~1): '))
 numberStrains = int(input('Number of Strains: '))
 sporeChance = []
+initialVegetative = []
+initialSporulated = []
 
 n = int(input('Seconds to simulate: '))
 
 for i in range(0, numberStrains):
-    initialCondition.append(float(input('Strain ' + str(i + 1) + ' Initial Vegetative Cell Density (0~1): ')))
-    initialCondition.append(float(input('Strain ' + str(i + 1) + ' Initial Sporulated Cell Density (0~1): ')))
+    initialVegetative.append(float(input('Strain ' + str(i + 1) + ' Initial Vegetative Cell Density (0~1): ')))
+    initialSporulated.append(float(input('Strain ' + str(i + 1) + ' Initial Sporulated Cell Density (0~1): ')))
     sporeChance.append(float(input('Strain ' + str(i + 1) + ' Chance to Sporulate (0~1): ')))
 
 time = numpy.linspace(0, n, n * 20 + 1)
@@ -23,43 +26,23 @@ conversionRate = 0.2
 vDeathChance = 0.1
 sDeathChance = 0.05
 
+# The NStrain model without germination. See simrules/ode.py
+model = NStrainODE(numberStrains, c=eatChance, alpha=conversionRate, gamma=growRS, mu_v=vDeathChance,
+                   mu_s=sDeathChance, mu_R=wiltChance, spore_chance=sporeChance)
 
-def multi_yeast_model(ic, t, g, e, w, c, vd, sd, sc):
-    dicdt = [g - (w * ic[0])]
-    for i in range(0, numberStrains):
-        dicdt[0] -= e * ic[0] * ic[i * 2 + 1]
-        rate = ((c * e * ic[0] * ic[i * 2 + 1]) * (1 - sc[i]) - (vd * ic[i * 2 + 1]))
-        dicdt.append(rate)
-        rate = ((c * e * ic[0] * ic[i * 2 + 1]) * sc[i] - (sd * ic[i * 2 + 2]))
-        dicdt.append(rate)
-    return dicdt
-
-
-results = [numpy.empty_like(time)]
-results[0][0] = initialCondition[0]
-for i in range(1, numberStrains * 2 + 1):
-    results.append(numpy.empty_like(time))
-    results[i][0] = initialCondition[i]
-
-for i in range(1, n * 20 + 1):
-    tspan = [time[i - 1], time[i]]
-    pop = scipy.integrate.odepack.odeint(multi_yeast_model, initialCondition, tspan,
-                                         args=(growRS, eatChance, wiltChance, conversionRate, vDeathChance,
-                                               sDeathChance, sporeChance))
-
-    for x in range(0, numberStrains * 2 + 1):
-        results[x][i] = pop[1][x]
-
-    initialCondition = pop[1]
+# Integrate the whole time span in one go, saving the solution every 1/20th of a second for the plot
+solution = model.integrate([initialResources], [initialVegetative], [initialSporulated], (0, n), t_eval=time,
+                           method='LSODA')
+resources, vegetative, sporulated = model.unpack(solution.y)  # The first index is the patch, of which there is one
 
 colors = itertools.cycle(["aqua", "green", "fuchsia", "lime", "maroon", "navy", "purple", "red", "silver", "teal"])
 
-matplotlib.pyplot.plot(time, results[0], 'b-', label='Resources')
+matplotlib.pyplot.plot(time, resources[0], 'b-', label='Resources')
 
 for i in range(0, numberStrains):
     col = next(colors)
-    matplotlib.pyplot.plot(time, results[i * 2 + 1], color=col, linestyle='--', label='Vegetative Cells ' + str(i+1))
-    matplotlib.pyplot.plot(time, results[i * 2 + 2], color=col, linestyle=':', label='Sporulated Cells ' + str(i+1))
+    matplotlib.pyplot.plot(time, vegetative[0, i], color=col, linestyle='--', label='Vegetative Cells ' + str(i+1))
+    matplotlib.pyplot.plot(time, sporulated[0, i], color=col, linestyle=':', label='Sporulated Cells ' + str(i+1))
 
 matplotlib.pyplot.ylabel('Population Density')
 matplotlib.pyplot.xlabel('Time')
@@ -11,13 +11,27 @@ import pandas
 import logging
 import time
 import numpy as np
-from simrules import helpers
+from simrules import helpers, kernels, bitset
+from simrules.ode import NStrainODE
+from simrules.equilibria import EquilibriumTables, presence_mask
+from simrules.sparse import Propagules, pick_winners
 from rules import Rules
+from scheduler import ChangeFilter, Scheduler
+from writer import AsyncWriter
+from delta import DeltaBuffer
 import dashboard
 
 
 class NStrain(Rules):
 
+    # The parameters with a value for each strain
+    strain_params = ('spore_chance', 'germ_chance', 'fly_v_survival', 'fly_s_survival')
+
+    # Patch specific parameters. Each patch uses these values from the rules unless it is given its own.
+    patch_defaults = {'c': 'c', 'alpha': 'alpha', 'mu_v': 'mu_v', 'mu_s': 'mu_s', 'mu_R': 'mu_R', 'gamma': 'gamma',
+                      'germ_chance': 'germ_chance', 'fly_v': 'fly_v_survival', 'fly_s': 'fly_s_survival',
+                      'spore_chance': 'spore_chance'}
+
     def __init__(self, num_strains, worldmap=nx.complete_graph(100), replicate_number=None, run_name=None, console_input=False, spore_chance=None,
                  germ_chance=None,
                  fly_v_survival=None, fly_s_survival=None, folder_name=None, save_data=True):
@@ -29,6 +43,7 @@ class NStrain(Rules):
             num_strains: The number of strains
             replicate_number: For doing multiple runs
             console_input: If true then put in all parameters via console manually. Good for small, one off runs.
+                           Progress is then also written to the console, see Rules.
             spore_chance: A vector of the form [x1, x2, ..., xn] where xi is the chance of sporulation of strain i.
             germ_chance: A vector like spore_chance except for germination chance.
             fly_s_survival: A vector like above but for fly survival chance for sporulated cells
@@ -38,7 +53,7 @@ class NStrain(Rules):
             run_name: Name of the specific simulation run
         """
 
-        super().__init__()
+        super().__init__(progress=console_input)
         self.console_input = console_input
         self.run_name = run_name
         self.replicate_number = replicate_number
@@ -46,8 +61,8 @@ class NStrain(Rules):
         random.seed = 42  # Set seed for replicable results
 
         # Default patch specific parameters
-        # These are passed into the patch, which always uses it's own, meaning we can change these per patch.
-        # For example, we can make some patches more dangerous than others.
+        # Patches read these from the rules (see patch_defaults) unless given their own, meaning we can change
+        # these per patch. For example, we can make some patches more dangerous than others.
         logging.info("Setting default patch parameters")
         self.c = 0.1  # Consumption rate for init_resources_per_patch.
         self.alpha = 0.2  # Conversion factor for init_resources_per_patch into cells
@@ -93,9 +108,18 @@ class NStrain(Rules):
         self.prob_death = 0.4  # Probability of a patch dying.
         self.stop_time = 2000  # Iterations to run
         self.data_save_step = 1  # Save the data every this many generations
+        self.async_output = False  # If true the data files are written on a background thread. See writer.py
+        self.writer = None  # The background writer, made when first needed
+        # If record_rtol is set a totals row is only saved when some total changed by more than record_rtol (relative)
+        # plus record_atol since the last saved row, or record_heartbeat generations have passed. See ChangeFilter
+        self.record_rtol = None
+        self.record_atol = 0.0
+        self.record_heartbeat = None
+        self._totals_filter = None
+        self._unsaved_rows = None  # The last rows the filter skipped, if none were saved after them
 
         # Colonization Mode
-        self.colonize_mode = 'probabilities'  # 'fly' or 'probabilities'
+        self.colonize_mode = 'probabilities'  # 'fly', 'probabilities' or 'mean field'
         self.colonization_prob_slope = 1  # Total weighted number of yeast times this is the prob that a patch is colonized
 
         # Fly Params
@@ -104,10 +128,16 @@ class NStrain(Rules):
             self.num_flies = 0  # Set to zero if not using. (Just to defend against potential bugs)
         self.fly_stomach_size = 1  # Number of cells they each. Put in "type 2" for a type 2 functional response
         self.germinate_on_drop = True  # If true then sporulated cells germinate immediatly when they are dropped.
+        self.synchronous_colonization = False  # If true all flies act on the populations from the start of the step
 
         # Update Params
-        self.update_mode = 'eq'  # 'discrete' or 'eq'. See the update function for details
+        self.update_mode = 'eq'  # 'discrete', 'eq', 'ode' or 'adaptive'. See the update function for details
+        self.ode_method = 'BDF'  # The solve_ivp method for the 'ode' update mode
+        self.ode_rtol = 1e-6  # Relative and absolute error tolerance of the 'ode' and 'adaptive' update modes
+        self.ode_atol = 1e-9
         self.patch_update_iterations = 1  # How many times to repeat the update function
+        self.fused_step = False  # If true run the generations between census outputs in one call. See step()
+        self.max_fused_generations = 1000  # Come back to python for census at least this often when fused_step
 
         # Change these params if the number of yeast eaten is a type 2 functional response
         self.fly_attack_rate = 0.3
@@ -120,9 +150,25 @@ class NStrain(Rules):
         self.files = []
 
         #Patch Lookup table
-        self.all_patches_same = True  # If all patches are the same only need to make one lookup table
-        self.first_run = True
-        self.lookup_table = {}
+        # The equilibria of the eq update mode, one table for each distinct set of patch parameters
+        self.eq_tables = EquilibriumTables(self)
+        self.eq_solver = 'winner'  # 'winner' or 'coexistence'. See jump_to_eq_update
+        self._ranks = None  # See strain_ranks
+        self.compact_strains = False  # If true drop strains from the arrays once they are extinct everywhere
+        self.strain_ids = None  # The original number of each strain left after compaction. None if none were dropped
+        self._all_strain_params = None  # The strain_params of all strains, from before the first compaction
+        # If true patches only store their eq winner and new colonists. Needs update_mode 'eq' with the 'winner'
+        # solver and a colonize_mode other than 'fly'. See simrules/sparse.py
+        self.sparse_eq = False
+        self.propagules = None  # The colonists of the sparse eq mode
+        self._arrived = None  # The colonists the current update is using
+        self._sparse_rng = None
+        self._presence_valid = False  # False when world.state['presence'] has to be rebuilt, see before_update
+        self.all_patches_same = False  # If true every patch uses the table of the defaults, even if it has its own parameters
+
+        # What census does each generation. See add_observers
+        self.scheduler = Scheduler()
+        self.add_observers()
 
 
         if folder_name is None:
@@ -199,14 +245,18 @@ class NStrain(Rules):
         """
 
         # Give each patch a strain
-        for i, patch in enumerate(world.patches):  # Iterate through each patch
-            strain = i % world.rules.num_strains
-            # Fill the patch with a single strain
-            patch.v_populations[strain] += self.yeast_size
-            patch.s_populations[strain] += self.yeast_size
+        if self.sparse_eq:
+            n = world.num_patches
+            self.propagules.add(np.arange(n), np.arange(n) % self.num_strains, self.yeast_size, self.yeast_size)
         else:
-            patch.v_populations[strain] += 0
-            patch.s_populations[strain] += 0
+            for i, patch in enumerate(world.patches):  # Iterate through each patch
+                strain = i % world.rules.num_strains
+                # Fill the patch with a single strain
+                patch.v_populations[strain] += self.yeast_size
+                patch.s_populations[strain] += self.yeast_size
+            else:
+                patch.v_populations[strain] += 0
+                patch.s_populations[strain] += 0
 
         # Prepare an array of save files for each patch
         # todo: move this line to a better location
@@ -216,28 +266,64 @@ class NStrain(Rules):
 
         self.book_keeping(world)
 
+    def allocate_state(self, world):
+        """
+        The populations and resources of every patch are held in arrays, with a row for each patch.
+        patch.v_populations is then row patch.index of world.state['v_populations'].
+
+        step_size is the last step size of the 'adaptive' update mode, which is where the next update starts.
+        presence is a bitset of the strains with veg cells, see refresh_presence.
+
+        With sparse_eq the patches instead have a winner with its veg and spore populations, see simrules/sparse.py.
+        """
+
+        n = world.num_patches
+        self.patch_num = n  # The worldmap may have been swapped out after __init__
+        self._presence_valid = False
+
+        if self.sparse_eq:
+            # Only the winner of each patch, and the colonists since the last update. See simrules/sparse.py
+            self.propagules = Propagules()
+            self._arrived = Propagules()
+            return {'winner': np.full(n, -1, dtype=np.int64),
+                    'veg': np.zeros(n),
+                    'spore': np.zeros(n),
+                    'resources': np.full(n, self.init_resources_per_patch, dtype=float)}
+
+        return {'v_populations': np.zeros((n, self.num_strains)),
+                's_populations': np.zeros((n, self.num_strains)),
+                'resources': np.full(n, self.init_resources_per_patch, dtype=float),
+                'step_size': np.zeros(n),
+                'presence': np.zeros((n, bitset.num_words(self.num_strains)), dtype=np.uint64)}
+
+    def init_patch(self, patch):
+        """ The populations are already allocated and the parameters are defaults, so there is nothing to do. """
+
+        pass
+
     def reset_patch(self, patch):
         """
         Each patch starts with 0 of all individuals, unless changed by initial_conditions
         and a resource level of 0.
         """
 
+        if self.sparse_eq:
+            patch.winner = -1
+            patch.veg = 0
+            patch.spore = 0
+            patch.resources = self.init_resources_per_patch
+            self.propagules.drop(patch.index)
+            patch.use_defaults()
+            return
+
         # Set all populations to
         patch.v_populations = [0] * self.num_strains
         patch.s_populations = [0] * self.num_strains
+        patch.resources = self.init_resources_per_patch
+        patch.presence = 0
 
         # Reset patch parameters
-        patch.c = self.c
-        patch.alpha = self.alpha
-        patch.mu_v = self.mu_v
-        patch.mu_s = self.mu_s
-        patch.mu_R = self.mu_R
-        patch.gamma = self.gamma
-        patch.resources = self.init_resources_per_patch
-        patch.germ_chance = self.germ_chance
-        patch.fly_v = self.fly_v_survival
-        patch.fly_s = self.fly_s_survival
-        patch.spore_chance = self.spore_chance
+        patch.use_defaults()
 
         # print(f"Patch {patch.id} has been reset.")
 
@@ -249,157 +335,583 @@ class NStrain(Rules):
         the next timestep. The size of the steps is controlled through the parameter dt.
 
         Eq uses previously calculated values of each patch equlibrium and brings the patch to exactly that value.
+
+        Ode integrates the same model as discrete exactly (up to the solver's tolerance) over the same time,
+        dt * patch_update_iterations. It is much faster in bulk, see update_block and Rules.block_updates.
+
+        Adaptive integrates the same model over the same time too, but with simrules/ode.dormand_prince where each
+        patch picks its own step size. Patches near equilibrium take a few large steps and only patches that were
+        just colonized take small ones. Also best in bulk.
         """
 
         mode = self.update_mode
 
-        if mode == 'discrete':
+        if self.sparse_eq:
+            self.sparse_eq_update(patch)
+        elif mode == 'discrete':
             self.discrete_update(patch)
         elif mode == 'eq':
             self.jump_to_eq_update(patch)
+        elif mode == 'ode':
+            self.ode_update(patch)
+        elif mode == 'adaptive':
+            self.adaptive_update(patch)
         else:
             raise Exception(f"{type} is not a valid update mode.")
 
     def discrete_update(self, patch):
         """Do discrete updates. THat is don't go all the way to eq but only to a certain time.
         Note that this mode is not fully implemented and still buggy."""
+        if kernels.use_numba(self.backend):
+            i = patch.index
+            state = patch.world.state
+            kernels.nstrain_discrete(state['v_populations'][i:i + 1], state['s_populations'][i:i + 1],
+                                     state['resources'][i:i + 1], patch.c, patch.alpha, patch.gamma,
+                                     patch.mu_v, patch.mu_s, patch.mu_R, np.asarray(self.spore_chance, dtype=float),
+                                     np.asarray(self.germ_chance, dtype=float), self.dt, self.patch_update_iterations)
+            return
+
+        # Work on plain lists, which is faster than indexing the numpy rows for each strain
+        v_populations = patch.v_populations.tolist()
+        s_populations = patch.s_populations.tolist()
+        resources = float(patch.resources)
+
+        # Read the patch parameters once
+        c, alpha, gamma = patch.c, patch.alpha, patch.gamma
+        mu_v, mu_s, mu_R = patch.mu_v, patch.mu_s, patch.mu_R
+
         for i in range(0, self.patch_update_iterations):
 
-            r_change = patch.gamma - patch.mu_R * patch.resources  # Constant init_resources_per_patch, death proportional to population
+            r_change = gamma - mu_R * resources  # Constant init_resources_per_patch, death proportional to population
 
             for i in range(0, self.num_strains):  # Iterate through strains of patch
 
                 # Vegetative cell change
                 # (new veg)*(prop remaining veg) - (dead veg) + (germinated spores)
-                v_change = (patch.alpha * patch.c * patch.resources * patch.v_populations[i]) * (
+                v_change = (alpha * c * resources * v_populations[i]) * (
                         1 - self.spore_chance[i]) \
-                           - (patch.mu_v * patch.v_populations[i]) + (
-                                   self.germ_chance[i] * patch.resources * patch.s_populations[i])
+                           - (mu_v * v_populations[i]) + (
+                                   self.germ_chance[i] * resources * s_populations[i])
 
                 # Sporulated cell change
                 # (birth from resource consumption)*(prop spores) - (spore death) - (germinated spores)
-                s_change = (patch.alpha * patch.c * patch.resources * patch.v_populations[i]) * (
+                s_change = (alpha * c * resources * v_populations[i]) * (
                     self.spore_chance[i]) \
-                           - (patch.mu_s * patch.s_populations[i]) - (
-                                   self.germ_chance[i] * patch.resources * patch.s_populations[i])
+                           - (mu_s * s_populations[i]) - (
+                                   self.germ_chance[i] * resources * s_populations[i])
 
-                r_change -= patch.c * patch.resources * patch.v_populations[
+                r_change -= c * resources * v_populations[
                     i]  # Resource change -= eaten init_resources_per_patch
 
                 # Add population changes
-                patch.v_populations[i] += v_change * self.dt
-                patch.s_populations[i] += s_change * self.dt
+                v_populations[i] += v_change * self.dt
+                s_populations[i] += s_change * self.dt
 
-            patch.resources += r_change * self.dt  # Add resource changes
+            resources += r_change * self.dt  # Add resource changes
 
             # Make sure none become negative
             for i in range(0, self.num_strains):
-                if patch.v_populations[i] < 0:
-                    patch.v_populations[i] = 0
-                if patch.s_populations[i] < 0:
-                    patch.s_populations[i] = 0
-
-            if patch.resources < 0:
-                patch.resources = 0
-
+                if v_populations[i] < 0:
+                    v_populations[i] = 0
+                if s_populations[i] < 0:
+                    s_populations[i] = 0
+
+            if resources < 0:
+                resources = 0
+
+        patch.v_populations = v_populations
+        patch.s_populations = s_populations
+        patch.resources = resources
+
+    def ode_model(self, patch=None):
+        """ The NStrain model of simrules/ode.py with the parameters of the patch, or of the rules if patch is None. """
+
+        p = patch if patch is not None else self
+        return NStrainODE(self.num_strains, p.c, p.alpha, p.gamma, p.mu_v, p.mu_s, p.mu_R,
+                          self.spore_chance, self.germ_chance)
+
+    def ode_update(self, patch):
+        """ Integrates the patch over dt * patch_update_iterations. See simrules/ode.py. """
+
+        resources, v, s = self.ode_model(patch).advance([patch.resources], [patch.v_populations],
+                                                        [patch.s_populations], self.dt * self.patch_update_iterations,
+                                                        method=self.ode_method, rtol=self.ode_rtol, atol=self.ode_atol)
+        patch.v_populations = v[0]
+        patch.s_populations = s[0]
+        patch.resources = resources[0]
+
+    def adaptive_update(self, patch):
+        """ Integrates the patch over dt * patch_update_iterations with adaptive steps. See simrules/ode.py. """
+
+        resources, v, s, step_size = self.ode_model(patch).advance_adaptive(
+            [patch.resources], [patch.v_populations], [patch.s_populations], self.dt * self.patch_update_iterations,
+            rtol=self.ode_rtol, atol=self.ode_atol, step_size=patch.step_size)
+        patch.v_populations = v[0]
+        patch.s_populations = s[0]
+        patch.resources = resources[0]
+        patch.step_size = step_size[0]
 
     def jump_to_eq_update(self, patch):
         """
         This jumps a patch directly to the calculated equilibrium.
 
+        With eq_solver 'winner' the best competitor (lowest spore chance) takes the patch and all other strains go
+        extinct. With 'coexistence' the patch goes to the stable equilibrium of the strains that are present, which
+        is right even when germination changes who the best competitor is. See simrules/equilibria.py.
+
         Args:
             patch: The patch to set to eq
 
         """
 
-        if self.first_run:
-            self.make_eq_lookup_table(patch)
+        if self.eq_solver == 'coexistence':
+            self.coexistence_update(patch)
+            return
+
+        table = self.eq_tables.for_patch(patch)
+        spore_chance = patch.spore_chance
+        v_populations = patch.v_populations  # A row of world.state, so changing it changes the patch
+        s_populations = patch.s_populations
+        if kernels.use_numba(self.backend):
+            out = np.empty(self.num_strains, dtype=np.int64)
+            count = kernels.find_winners(v_populations, s_populations,
+                                         np.asarray(spore_chance, dtype=float), False, out)
+            winners = out[:count].tolist()
+        elif spore_chance is self.spore_chance:  # The patch uses the default spore chances, which the mask is sorted by
+            winners = self.mask_winners(patch.presence)
         else:
-            winners = helpers.find_winner(patch.v_populations, patch.s_populations,
-                                          self.spore_chance)  # This is the index of the best competitor
+            winners = helpers.find_winner(v_populations.tolist(), s_populations.tolist(),
+                                          spore_chance)  # This is the index of the best competitor
 
-            # Set all strains to be extinct
-            patch.v_populations = [0] * self.num_strains
-            patch.s_populations = [0] * self.num_strains
+        # Set all strains to be extinct
+        v_populations[:] = 0
+        s_populations[:] = 0
 
-            # If multiple winners choose a random one.
-            if not winners:
-                patch.resources = self.lookup_table["Empty"]["Resources"]
-                return
-            else:
-                i = random.choice(winners)
+        presence = patch.presence
+        presence[:] = 0
 
-            s = self.spore_chance[i]  # Sporulation chance of winner
+        # If multiple winners choose a random one.
+        if not winners:
+            patch.resources = table.empty_resources
+            return
+        else:
+            i = random.choice(winners)
 
-            # Set winning strain to eq
-            patch.v_populations[i] = self.lookup_table[i]["Veg"]
-            if s != 1:
-                patch.s_populations[i] = self.lookup_table[i]["Spore"]
+        # Set winning strain to eq
+        v_populations[i] = table.veg[i]
+        s_populations[i] = table.spore[i]
+        patch.resources = table.resources[i]
 
-                patch.resources = self.lookup_table[i]["Resources"]
-            else:  # Special case: If spore chance is 1 then just make the numerator real small
-                patch.s_populations[i] = self.lookup_table[i]["Spore"]
-                patch.resources = self.lookup_table[i]["Resources"]
+        if table.veg[i] > 0:  # A strain that can't live at all has no veg cells at its equilibrium
+            rank = self.strain_ranks()[1][i]
+            presence[rank // 64] = 1 << (rank % 64)
 
+    def strain_ranks(self, spore_chance=None):
+        """
+        Ranks the strains from the best competitor (lowest spore chance) to the worst. Bit k of a presence mask is
+        the strain with rank k, so the best competitor present is the lowest set bit.
 
+        Returns:
+            (order, rank, tie_end) where order[k] is the strain with rank k, rank[i] the rank of strain i and
+            tie_end[k] the rank just after the last strain tied with rank k.
+            Uses the given spore chances instead of the defaults if there are any.
+        """
 
+        if spore_chance is not None and spore_chance is not self.spore_chance:
+            return self._rank(spore_chance)[1:]
+
+        spore_chance = tuple(self.spore_chance)
+        if self._ranks is None or self._ranks[0] != spore_chance:
+            self._ranks = self._rank(spore_chance)
+        return self._ranks[1:]
+
+    @staticmethod
+    def _rank(spore_chance):
+        spore_chance = tuple(spore_chance)
+        order = np.argsort(spore_chance, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        sorted_chances = np.asarray(spore_chance)[order]
+        tie_end = np.searchsorted(sorted_chances, sorted_chances, side='right')
+        return spore_chance, order, rank, tie_end
+
+    def refresh_presence(self, world, rows=None):
+        """
+        Sets world.state['presence'] from the populations, of every patch or only of the patches in rows. Each row is
+        a bitset (see simrules/bitset.py) with bit k set if the strain of rank k (see strain_ranks) has veg cells in
+        the patch.
 
+        In the winner eq mode the update and the colonization keep the masks up to date as they change the
+        populations, so this is only needed after changing the populations some other way.
+        """
 
-    def make_eq_lookup_table(self, patch):
-        """Makes a dictionary of {Winner Strain Number: Eq values}. The eq values themselves are a dictionary
-        containing the following keys.
-            - Resources
-            - Strain # Veg
-            - Strain # Spore
-        The value is the associated equilibrium.
-        Todo: For now we allume all losing strains go to 0 and that all patches are the same.
+        order = self.strain_ranks()[0]
+        v = world.state['v_populations']
+        if rows is None:
+            world.state['presence'][:] = bitset.pack(v[:, order] > 0)
+            return
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if len(rows):
+            world.state['presence'][rows] = bitset.pack(v[rows][:, order] > 0)
+
+    def before_update(self, world):
+        """
+        The winner eq mode picks winners from the presence masks. Those are kept up to date as the populations
+        change, so they are only rebuilt from the populations on the first winner eq update, or the first after
+        updates in another mode, which don't keep them.
+        """
+
+        if self.sparse_eq:
+            if self.update_mode != 'eq' or self.eq_solver != 'winner':
+                raise Exception("sparse_eq only works with update_mode 'eq' and eq_solver 'winner'.")
+            # The update uses up the colonists, and new ones go in a new buffer
+            self._arrived = self.propagules
+            self._arrived.sort()
+            self.propagules = Propagules()
+            self._sparse_rng = helpers.numpy_rng()  # Only used to break ties
+        elif self.update_mode == 'eq' and self.eq_solver == 'winner':
+            if not self._presence_valid:
+                self.refresh_presence(world)
+                self._presence_valid = True
+        else:
+            self._presence_valid = False
+
+    def patch_removed(self, world, index):
+        """ The sparse colonists of a removed patch go with it. """
+
+        if self.sparse_eq:
+            self.propagules.drop_many([index])
+
+    def patch_moved(self, world, old, new):
+        """ The sparse colonists of a patch move to its new index along with the rest of its state. """
+
+        if self.sparse_eq:
+            self.propagules.move(old, new)
+
+    def mask_winners(self, presence):
+        """ Same as helpers.find_winner, but from the presence mask of a patch. """
+
+        order, _, tie_end = self.strain_ranks()
+        best = bitset.lowest_bit(presence)
+        if best < 0:
+            return []
+        if tie_end[best] - best == 1:  # No ties, which is the usual case
+            return [int(order[best])]
+        present = bitset.unpack(presence, self.num_strains)
+        return [int(order[k]) for k in range(best, tie_end[best]) if present[k]]
+
+    def sparse_eq_update(self, patch):
+        """ jump_to_eq_update for the sparse patch state. See simrules/sparse.py. """
+
+        propagules = self._arrived
+        here = propagules.of_patch(patch.index)
+        winner = pick_winners(np.array([patch.winner]), np.array([patch.veg]),
+                              np.zeros(here.stop - here.start, dtype=np.int64), propagules.strain[here],
+                              propagules.veg[here], *self.strain_ranks(patch.spore_chance), self._sparse_rng)[0]
+        self._set_sparse_eq(patch.world.state, np.array([patch.index]), np.array([winner]),
+                            self.eq_tables.for_patch(patch))
+
+    def sparse_eq_block(self, world, rows, rng):
+        """ update_block for the sparse patch state. See simrules/sparse.py. """
+
+        state = world.state
+        propagules = self._arrived
+        local = np.full(world.num_patches, -1)
+        local[rows] = np.arange(len(rows))
+        arriving = np.flatnonzero(local[propagules.patch] >= 0)
+
+        winner = pick_winners(state['winner'][rows], state['veg'][rows], local[propagules.patch[arriving]],
+                              propagules.strain[arriving], propagules.veg[arriving], *self.strain_ranks(), rng)
+        self._set_sparse_eq(state, rows, winner, self.eq_tables.default())
+
+    def _set_sparse_eq(self, state, rows, winner, table):
+        """ Puts the patches in rows at the equilibrium of their winners. """
+
+        occupied = winner >= 0
+        state['winner'][rows] = winner
+        state['veg'][rows] = np.where(occupied, table.veg[winner], 0)
+        state['spore'][rows] = np.where(occupied, table.spore[winner], 0)
+        state['resources'][rows] = np.where(occupied, table.resources[winner], table.empty_resources)
+
+    def dense_populations(self, world):
+        """ The (v_populations, s_populations) arrays of the world, also when the state is sparse. """
+
+        state = world.state
+        if not self.sparse_eq:
+            return state['v_populations'], state['s_populations']
+
+        v = np.zeros((world.num_patches, self.num_strains))
+        s = np.zeros((world.num_patches, self.num_strains))
+        held = np.flatnonzero(state['winner'] >= 0)
+        v[held, state['winner'][held]] = state['veg'][held]
+        s[held, state['winner'][held]] = state['spore'][held]
+
+        propagules = self.propagules
+        propagules.sort()
+        np.add.at(v, (propagules.patch, propagules.strain), propagules.veg)
+        np.add.at(s, (propagules.patch, propagules.strain), propagules.spore)
+        return v, s
+
+    def present_strains(self, v_populations, s_populations, germ_chance):
+        """ True for each strain with veg cells, or with spores that can germinate. Works on blocks of patches too. """
+        return (v_populations > 0) | ((s_populations > 0) & (np.asarray(germ_chance) > 0))
+
+    def coexistence_update(self, patch):
+        """ Jumps the patch to the equilibrium of the strains present in it. See jump_to_eq_update. """
+
+        v_populations = patch.v_populations
+        s_populations = patch.s_populations
+        present = self.present_strains(v_populations, s_populations, patch.germ_chance)
+        veg, spore, resources = self.eq_tables.coexistence_for_patch(patch, presence_mask(present))
+        v_populations[:] = veg
+        s_populations[:] = spore
+        patch.resources = resources
+
+    def step(self, world, n):
+        """
+        Runs up to n generations, see Rules.step. With fused_step the generations where no observer with a cadence
+        is due (see add_observers) are run in one call, of kernels.nstrain_generations with the numba backend
+        and of the numpy block code otherwise, without the per generation python hooks. The rest go through the
+        hooks as usual.
+
+        Returns:
+            How many generations were run
+        """
+
+        done = 0
+        while done < n:
+            span = self.fused_span(world, n - done)
+            if span > 1:
+                ran = self.fused_generations(world, span)
+                done += ran
+                if ran == span:
+                    continue
+                if done >= n:  # Died out on the last generation asked for. The next call stops.
+                    break
+            if super().step(world, 1) == 0:
+                break
+            done += 1
+        return done
+
+    def fused_span(self, world, limit):
+        """
+        How many generations from now can be fused, up to limit. 0 if this world can't be fused or census has
+        something to do this generation.
         """
 
-        # No strain case
+        if not self.fused_step or not self.can_fuse(world):
+            return 0
 
-        self.lookup_table["Empty"] = {}
-        self.lookup_table["Empty"]["Resources"] = patch.gamma / patch.mu_R
-        self.lookup_table["Empty"]["Veg"] = 0
-        self.lookup_table["Empty"]["Spore"] = 0
+        age = world.age
+        span = min(limit, self.stop_time - age, self.max_fused_generations)
+        # The next census with an observer to run, and the next generation the history records
+        for until_due in (self.scheduler.generations_until_due(age), world.history.generations_until_due(age)):
+            if until_due is not None:
+                span = min(span, until_due)
+        return max(span, 0)
 
-        for i in range(0,self.num_strains):  # i is the winning strain
+    def can_fuse(self, world):
+        """
+        True if every generation is plain array code: the discrete or winner eq update, 'mean field' colonization,
+        nothing saved per patch and no patches with their own parameters or update function. ('probabilities' draws
+        the same model one patch at a time, from random, so fusing it would change the run.)
+        """
+
+        return (self.update_mode in ('discrete', 'eq') and self.eq_solver == 'winner'
+                and self.colonize_mode == 'mean field' and not self.sparse_eq
+                and not self.save_patch_data
+                and not world.custom_patches)
+
+    def fused_generations(self, world, k):
+        """
+        Runs k generations of update, colonize (the 'mean field' mode) and kill_patches. Stops early if the
+        population dies out. Only the pool totals colonization needs are summed each generation, not the rest of
+        book_keeping.
 
+        Returns:
+            How many generations were run
+        """
+
+        state = world.state
+        v, s, resources = state['v_populations'], state['s_populations'], state['resources']
+
+        if kernels.use_numba(self.backend):
+            table = self.eq_tables.default()
+            kernels.seed(random.getrandbits(32))
+            ran = kernels.nstrain_generations(
+                v, s, resources, k, self.update_mode == 'eq', np.asarray(table.veg, dtype=float),
+                np.asarray(table.spore, dtype=float), np.asarray(table.resources, dtype=float),
+                float(table.empty_resources), float(self.c), float(self.alpha), float(self.gamma), float(self.mu_v),
+                float(self.mu_s), float(self.mu_R), np.asarray(self.spore_chance, dtype=float),
+                np.asarray(self.germ_chance, dtype=float), float(self.dt), int(self.patch_update_iterations),
+                np.asarray(self.fly_v_survival, dtype=float), np.asarray(self.fly_s_survival, dtype=float),
+                float(self.colonization_prob_slope), float(self.yeast_size), bool(self.germinate_on_drop),
+                float(self.prob_death), float(self.init_resources_per_patch))
+            self._presence_valid = False  # The kernel doesn't keep the masks
+        else:
+            rng = helpers.numpy_rng()
+            rows = np.arange(world.num_patches)
+            ran = 0
+            while ran < k and (v.any() or s.any()):
+                self.before_update(world)
+                self.update_block(world, rows, rng)
+                self.mean_field_colonize(world, v.sum(axis=0), s.sum(axis=0), rng)
+                self.reset_rows(world, np.flatnonzero(rng.random(len(rows)) < self.prob_death * self.dt))
+                ran += 1
+
+        world.age += ran
+        self.total_pop = self.population_total(world)  # So stop_condition sees if the population died out
+        return ran
+
+    def update_block(self, world, rows, rng):
+        """
+        Does patch_update for all the patches in rows at once, with numpy. World.update_patches calls this from
+        several threads when update_workers > 1. These patches all use the parameters on the rules, since patches
+        with their own parameters are updated one at a time.
+
+        Args:
+            world: The world
+            rows: The indices of the patches to update
+            rng: The random generator for this block, used to break ties between winners in eq mode
+        """
 
-            # Sporulation chance of winner
-            s = self.spore_chance[i]
+        if self.sparse_eq:
+            self.sparse_eq_block(world, rows, rng)
+            return
 
-            self.lookup_table[i] = {}
+        v_all = world.state['v_populations']
+        s_all = world.state['s_populations']
+        r_all = world.state['resources']
+        v = v_all[rows]
+        s = s_all[rows]
+        resources = r_all[rows]
 
-            # Calculate the veg population
-            self.lookup_table[i]["Veg"] = ((patch.c * patch.alpha * patch.gamma) * (1 - s) - patch.mu_R * patch.mu_v) / (
-                    patch.c * patch.mu_v)
+        compiled = kernels.use_numba(self.backend)
 
-            # Calculate the spore population
-            if s != 1:
-                self.lookup_table[i]["Spore"] = s * (
-                        ((patch.c * patch.alpha * patch.gamma) * (s - 1)) + patch.mu_R * patch.mu_v) / (
-                                                 (s - 1) * (patch.c * patch.mu_s))
+        if self.update_mode == 'discrete':
+            spore_chance = np.asarray(self.spore_chance, dtype=float)
+            germ_chance = np.asarray(self.germ_chance, dtype=float)
 
-                self.lookup_table[i]["Resources"] = -patch.mu_v / ((s - 1) * patch.alpha * patch.c)
-            # Special case: If spore chance is 1 then just make the numerator real small
+            if compiled:
+                kernels.nstrain_discrete(v, s, resources, self.c, self.alpha, self.gamma, self.mu_v, self.mu_s,
+                                         self.mu_R, spore_chance, germ_chance, self.dt, self.patch_update_iterations)
             else:
-                self.lookup_table[i]["Spore"] = (s * (
-                        (patch.c * patch.alpha * patch.gamma) * (s - 1)) + patch.mu_R * patch.mu_v) / (
-                                                 (.999999 - 1) * (patch.c * patch.mu_s))
+                for _ in range(0, self.patch_update_iterations):
+                    born = (self.alpha * self.c) * resources[:, None] * v
+                    germinated = germ_chance * resources[:, None] * s
+                    v_change = born * (1 - spore_chance) - self.mu_v * v + germinated
+                    s_change = born * spore_chance - self.mu_s * s - germinated
+                    r_change = self.gamma - self.mu_R * resources - self.c * resources * v.sum(axis=1)
+
+                    v += v_change * self.dt
+                    s += s_change * self.dt
+                    resources += r_change * self.dt
+                    np.maximum(v, 0, out=v)
+                    np.maximum(s, 0, out=s)
+                    np.maximum(resources, 0, out=resources)
+
+        elif self.update_mode == 'eq' and self.eq_solver == 'coexistence':
+            # Solve each distinct set of present strains once
+            present = self.present_strains(v, s, self.germ_chance)
+            subsets, which = np.unique(present, axis=0, return_inverse=True)
+            which = which.ravel()
+            veg = np.empty((len(subsets), self.num_strains))
+            spore = np.empty((len(subsets), self.num_strains))
+            resources_eq = np.empty(len(subsets))
+            for k, subset in enumerate(subsets):
+                veg[k], spore[k], resources_eq[k] = self.eq_tables.coexistence(self, presence_mask(subset))
+            v[:] = veg[which]
+            s[:] = spore[which]
+            resources = resources_eq[which]
+
+        elif self.update_mode == 'eq':
+            table = self.eq_tables.default()  # The patches of a block all use the defaults
+
+            for sc in self.spore_chance:
+                assert not sc > 1
+
+            # The winner is the present strain with the lowest sporulation chance. Ties are broken at random.
+            if compiled:
+                winner = kernels.eq_winners(v, np.asarray(self.spore_chance, dtype=float), rng.random(len(rows)))
+                occupied = winner >= 0
+            else:
+                order, _, tie_end = self.strain_ranks()
+                presence = world.state['presence'][rows]
+                best = bitset.lowest_bit(presence)
+                occupied = best >= 0
+                tied = occupied & (tie_end[best] - best > 1)
+                if tied.any():  # Pick one of the tied strains that are present at random
+                    k = np.arange(self.num_strains)
+                    candidates = (bitset.unpack(presence[tied], self.num_strains) & (k >= best[tied, None])
+                                  & (k < tie_end[best[tied], None]))
+                    best[tied] = np.where(candidates, rng.random(candidates.shape), -1).argmax(axis=1)
+                winner = order[best]
+
+            v[:] = 0
+            s[:] = 0
+            at = np.flatnonzero(occupied)
+            v[at, winner[at]] = table.veg[winner[at]]
+            s[at, winner[at]] = table.spore[winner[at]]
+            resources = np.where(occupied, table.resources[winner], table.empty_resources)
+
+            # Only the winners are left, if they have veg cells at their equilibrium
+            at = at[table.veg[winner[at]] > 0]
+            rank = self.strain_ranks()[1][winner[at]]
+            presence = world.state['presence']
+            presence[rows] = 0
+            presence[rows[at], rank // 64] = np.left_shift(np.uint64(1), (rank % 64).astype(np.uint64))
+
+        elif self.update_mode == 'ode':
+            # All the patches of the block as one system
+            resources, v, s = self.ode_model().advance(resources, v, s, self.dt * self.patch_update_iterations,
+                                                       method=self.ode_method, rtol=self.ode_rtol, atol=self.ode_atol)
+
+        elif self.update_mode == 'adaptive':
+            steps = world.state['step_size']
+            resources, v, s, steps[rows] = self.ode_model().advance_adaptive(
+                resources, v, s, self.dt * self.patch_update_iterations, rtol=self.ode_rtol, atol=self.ode_atol,
+                step_size=steps[rows])
+
+        else:
+            raise Exception(f"{self.update_mode} is not a valid update mode.")
+
+        v_all[rows] = v
+        s_all[rows] = s
+        r_all[rows] = resources
+
+    def make_eq_lookup_table(self, patch):
+        """Makes a dictionary of {Winner Strain Number: Eq values} for the parameters of the patch. The eq values
+        themselves are a dictionary containing the following keys.
+            - Resources
+            - Veg
+            - Spore
+        The value is the associated equilibrium. The tables are made and kept by self.eq_tables, see
+        simrules/equilibria.py.
+        Todo: For now we allume all losing strains go to 0.
+        """
 
-                self.lookup_table[i]["Resources"] = -patch.mu_v / ((.999999 - 1) * patch.alpha * patch.c)
+        return self.eq_tables.get(patch).as_lookup_table()
 
-        self.first_run = False
+    @property
+    def lookup_table(self):
+        """ The lookup table (see make_eq_lookup_table) of the default patch parameters. """
+        return self.eq_tables.default().as_lookup_table()
 
     def colonize(self, world):
         """The colonize function switches between a couple modes."""
 
+        if self.sparse_eq and self.colonize_mode == 'fly':
+            raise Exception("Fly colonization needs the populations of every strain, so it doesn't work with sparse_eq.")
+
         if self.colonize_mode == 'fly':
             self.colonize_fly_mode(world)
         elif self.colonize_mode == 'probabilities':
             self.probability_colonize_mode(world)
+        elif self.colonize_mode == 'mean field':
+            self.mean_field_colonize_mode(world)
         else:
-            raise ValueError(f"{self.colonize_mode} is not a valid colonization mode. (Choose 'fly' or 'probabilities'")
+            raise ValueError(f"{self.colonize_mode} is not a valid colonization mode. "
+                             f"(Choose 'fly', 'probabilities' or 'mean field')")
 
     def colonize_fly_mode(self, world):
         """
@@ -407,10 +919,21 @@ class NStrain(Rules):
         Each cell has a chance of surviving based off it's fly survival probability.
         The fly then chooses a random neighbor patch to deposit the yeast cells onto.
 
+        If synchronous_colonization is true every fly sees the populations from the start of the step, and what
+        the flies take and drop is only added at the end. Otherwise each fly changes the populations right away.
+        Either way the presence masks of the patches the flies took from or dropped on are refreshed at the end.
+
         Warnings:
             We assume the fly eats few cells compared to the total number.
         """
 
+        deltas = DeltaBuffer(world) if self.synchronous_colonization else None
+
+        if deltas is None and kernels.use_numba(self.backend):
+            self.compiled_fly_colonize(world)
+            return
+
+        touched = []  # The patches whose populations changed
         for i in range(0, self.num_flies):
 
             patch = random.choice(world.patches)  # Pick the random patch that the fly lands on
@@ -426,22 +949,45 @@ class NStrain(Rules):
             if num_eaten > 0:
                 try:
                     # Filter zeros out of patch populations
-                    patch_pops = patch.v_populations + patch.s_populations
+                    patch_pops = list(patch.v_populations) + list(patch.s_populations)
                     patch_pops = [x if x > 0 else 0 for x in patch_pops]
                     # Select the types of cells to be eaten
                     hitchhikers = random.choices(range(0, 2 * self.num_strains), weights=patch_pops,
                                                  k=num_eaten)
-                except IndexError:
+                except (IndexError, ValueError):  # Newer pythons raise ValueError when all weights are zero
                     if sum(patch.v_populations) > 0:
                         raise Exception(
                             f"Cannot choose {num_eaten} hitchikers out of {self.num_strains} strains in patch {patch.id} with population "
-                            f"{patch.v_populations + patch.s_populations}")
+                            f"{list(patch.v_populations) + list(patch.s_populations)}")
                     else:
                         logging.info(f"Patch {patch.id} is empty, the fly dies a slow sad death of starvation...")
                         hitchhikers = {}
 
                 v_survivors = [0] * self.num_strains
                 s_survivors = [0] * self.num_strains
+                touched.append(patch.index)
+
+                if deltas is not None:
+                    # Same as below, but the changes only happen when the buffer is applied
+                    for j in hitchhikers:
+                        if j < self.num_strains:
+                            deltas.add('v_populations', patch.index, -self.yeast_size, j)
+                            if random.random() < self.fly_v_survival[j]:
+                                v_survivors[j] += self.yeast_size
+                        else:
+                            deltas.add('s_populations', patch.index, -self.yeast_size, j - self.num_strains)
+                            if random.random() < self.fly_s_survival[j - self.num_strains]:
+                                s_survivors[j - self.num_strains] += self.yeast_size
+
+                    drop_patch = patch.random_neighbor()
+                    if drop_patch is not None:
+                        touched.append(drop_patch.index)
+                        deltas.add('v_populations', drop_patch.index, v_survivors)
+                        if self.germinate_on_drop:
+                            deltas.add('v_populations', drop_patch.index, s_survivors)
+                        else:
+                            deltas.add('s_populations', drop_patch.index, s_survivors)
+                    continue
 
                 # Remove the cell from the population. For each cell, check if it survives. If so, place it in survivors
                 for j in hitchhikers:
@@ -458,13 +1004,41 @@ class NStrain(Rules):
                 # If no neighbors then the fly vanishes
                 drop_patch = patch.random_neighbor()
                 if drop_patch is not None:
+                    touched.append(drop_patch.index)
                     drop_patch.v_populations = [x + y for x, y in zip(drop_patch.v_populations, v_survivors)]
                     # if spore cells germinate on the drop then add them directly to the veg populations
+                    # todo: this replaces the veg populations with the spore populations instead of adding to them
                     if self.germinate_on_drop:
                         drop_patch.v_populations = [x + y for x, y in zip(drop_patch.s_populations, s_survivors)]
                     else:
                         drop_patch.s_populations = [x + y for x, y in zip(drop_patch.s_populations, s_survivors)]
 
+        if deltas is not None:
+            deltas.apply()
+        self.refresh_presence(world, touched)
+
+    def compiled_fly_colonize(self, world):
+        """
+        colonize_fly_mode with the compiled kernel. Where each fly lands and drops its survivors doesn't depend on
+        the populations, so those are drawn here and the kernel does the rest, one fly after the other.
+        """
+
+        n = world.num_patches
+        dispersal = world.dispersal
+        sources = [random.randrange(n) for _ in range(self.num_flies)]
+        drops = [dispersal.sample(i, random.random()) for i in sources]
+        drops = [-1 if d is None else d for d in drops]
+        type_2 = self.fly_stomach_size == "type 2"
+
+        kernels.seed(random.getrandbits(32))
+        kernels.fly_colonize(world.state['v_populations'], world.state['s_populations'],
+                             np.array(sources, dtype=np.int64), np.array(drops, dtype=np.int64),
+                             0 if type_2 else int(self.fly_stomach_size), type_2, float(self.fly_attack_rate),
+                             float(self.fly_handling_time), float(self.yeast_size),
+                             np.asarray(self.fly_v_survival, dtype=float), np.asarray(self.fly_s_survival, dtype=float),
+                             bool(self.germinate_on_drop))
+        self.refresh_presence(world, sources + [d for d in drops if d >= 0])
+
     def probability_colonize_mode(self, world):
         """
         This mode goes through each patch and flips a coin to see if a colonizer lands on it.
@@ -477,9 +1051,8 @@ class NStrain(Rules):
             None
         """
 
-        propagules = self.book_keeping(world)
-        veg = propagules[1]
-        spores = propagules[2]
+        self.book_keeping(world)
+        veg, spores = self.active_totals
 
         # Make sure no negatives in veg and spores. If any set to 0.
         veg = [v if v >= 0 else 0 for v in veg]
@@ -492,21 +1065,89 @@ class NStrain(Rules):
         weights = weighted_veg + weighted_spore
         weighted_sum = sum(weights)
         # print("Weights", weighted_sum)
-        weighted_sum = weighted_sum / self.patch_num  # Take average so that number of patches does not affect chance.
+        weighted_sum = weighted_sum / world.num_patches  # Take average so that number of patches does not affect chance.
         # print("Colonization Prob", weighted_sum * self.colonization_prob_slope * self.dt)
 
         # Each patch has a chance of being colonized. Higher colonization power means higher chance.
+        targets = []
+        colonists = []
         for patch in world.patches:
             if self.colonization_prob(weighted_sum):  # todo: can turn this into binomial draw
                 # Figure out which strain and type colonizes based off "colonization power" of each type.
-                colonist = random.choices(range(0, self.num_strains * 2), weights=weights, k=1)[0]
-                if colonist > self.num_strains - 1:  # If a spore colonize...
-                    if self.germinate_on_drop:  # ... and it germinates on drop add one veg cell to the patch.
-                        patch.v_populations[colonist - self.num_strains] += self.yeast_size
-                    else:  # Otherwise add one spore to the patch.
-                        patch.s_populations[colonist - self.num_strains] += self.yeast_size
-                else:  # Otherwise must be a veg cell
-                    patch.v_populations[colonist] += self.yeast_size
+                targets.append(patch.index)
+                colonists.append(random.choices(range(0, self.num_strains * 2), weights=weights, k=1)[0])
+
+        self.add_colonists(world, targets, colonists)
+
+    def add_colonists(self, world, targets, colonists):
+        """
+        Drops one yeast of each colonist on its target patch. Colonists 0 to num_strains - 1 are veg cells of that
+        strain and the rest are spores. If germinate_on_drop the spores germinate and are added as veg cells.
+
+        Args:
+            world: The world
+            targets: The index of the patch each colonist lands on
+            colonists: The type of each colonist
+        """
+
+        S = self.num_strains
+        targets = np.asarray(targets, dtype=np.int64)
+        colonists = np.asarray(colonists, dtype=np.int64)
+        strains = colonists % S
+        as_spore = (colonists >= S) & (not self.germinate_on_drop)
+
+        if self.sparse_eq:
+            self.propagules.add(targets, strains, np.where(as_spore, 0, self.yeast_size),
+                                np.where(as_spore, self.yeast_size, 0))
+        else:
+            np.add.at(world.state['v_populations'], (targets[~as_spore], strains[~as_spore]), self.yeast_size)
+            np.add.at(world.state['s_populations'], (targets[as_spore], strains[as_spore]), self.yeast_size)
+            # The veg colonists are now present
+            bitset.set_bits(world.state['presence'], targets[~as_spore], self.strain_ranks()[1][strains[~as_spore]])
+
+    def mean_field_colonize_mode(self, world):
+        """
+        The same model as probability_colonize_mode, where all propagules go into one global pool, but drawn in bulk.
+        The number of colonized patches is a single binomial draw, the colonized patches are picked uniformly and
+        the colonists are picked from the pool, all with numpy. This is what a complete worldmap amounts to, and the
+        cost no longer grows with the number of patches that are not colonized.
+
+        Args:
+            world: The world
+
+        Returns:
+            None
+        """
+
+        self.book_keeping(world)
+        self.mean_field_colonize(world, *self.active_totals)
+
+    def mean_field_colonize(self, world, veg, spores, rng=None):
+        """
+        The draws of mean_field_colonize_mode, from a pool of the given veg and spore totals of each strain.
+        Draws from rng, or from a new generator seeded from random if it is None.
+        """
+
+        S = self.num_strains
+        n = world.num_patches
+
+        veg = np.maximum(veg, 0)
+        spores = np.maximum(spores, 0)
+        weights = np.concatenate((veg * self.fly_v_survival, spores * self.fly_s_survival))
+        weighted_sum = weights.sum()
+        if weighted_sum <= 0:
+            return
+
+        prob = min(weighted_sum / n * self.colonization_prob_slope * self.dt, 1)
+
+        if rng is None:
+            rng = helpers.numpy_rng()
+        num_colonized = rng.binomial(n, prob)
+        if num_colonized == 0:
+            return
+        targets = rng.choice(n, size=num_colonized, replace=False)
+        colonists = rng.choice(2 * S, size=num_colonized, p=weights / weighted_sum)
+        self.add_colonists(world, targets, colonists)
 
     def colonization_prob(self, n):
 
@@ -525,12 +1166,34 @@ class NStrain(Rules):
             return False
 
     def kill_patches(self, world):
-        """ Resets population on a patch to 0 with probability prob_death """
+        """
+        Resets population on a patch to 0 with probability prob_death. The deaths of all patches are drawn at once
+        and their state is reset in bulk (see reset_rows), so no patch objects are made. Patches that were given
+        their own parameters go back to the defaults.
+        """
 
-        # Kill ALL the patches
-        for patch in world.patches:
-            if random.random() < self.prob_death * self.dt:
-                self.reset_patch(patch)
+        dead = helpers.numpy_rng().random(world.num_patches) < self.prob_death * self.dt
+        if not dead.any():
+            return
+        self.reset_rows(world, np.flatnonzero(dead))
+        for patch in world.patches.materialized_patches():
+            if dead[patch.index] and patch.has_overrides():
+                patch.use_defaults()
+
+    def reset_rows(self, world, rows):
+        """ reset_patch for the state of the patches with indices rows, all at once. """
+
+        state = world.state
+        state['resources'][rows] = self.init_resources_per_patch
+        if self.sparse_eq:
+            state['winner'][rows] = -1
+            state['veg'][rows] = 0
+            state['spore'][rows] = 0
+            self.propagules.drop_many(rows)
+        else:
+            state['v_populations'][rows] = 0
+            state['s_populations'][rows] = 0
+            state['presence'][rows] = 0
 
     def book_keeping(self, world):
         """
@@ -580,53 +1243,224 @@ class NStrain(Rules):
         #     if has_occupant:
         #         self.patches_occupied += 1
 
-        self.total_resources = sum((patch.resources for patch in world.patches))
-        self.v_population_totals = [sum(patch.v_populations[i] for patch in world.patches) for i in range(0, self.num_strains)]
-        self.s_population_totals = [sum(patch.s_populations[i] for patch in world.patches) for i in range(0, self.num_strains)]
-        self.all_population_totals = [v + s for v, s in zip(self.v_population_totals, self.s_population_totals)]
+        self.total_resources = float(world.state['resources'].sum())
 
-        self.patches_occupied = sum([1 if (any(patch.v_populations) or any(patch.s_populations)) else 0 for patch in world.patches])
-        self.patch_occupancy = [sum(1 if (patch.v_populations[i] >= self.yeast_size or patch.s_populations[i] >= self.yeast_size) else 0 for patch in world.patches)
-                             for i in range(0, self.num_strains)]
+        if self.sparse_eq:
+            self.sparse_book_keeping(world)
+        else:
+            # The populations of all patches are held in world.state, one row per patch. See allocate_state()
+            v = world.state['v_populations']
+            s = world.state['s_populations']
+
+            self.v_population_totals = v.sum(axis=0).tolist()
+            self.s_population_totals = s.sum(axis=0).tolist()
+            self.patches_occupied = int(np.count_nonzero(v.any(axis=1) | s.any(axis=1)))
+            self.patch_occupancy = np.count_nonzero((v >= self.yeast_size) | (s >= self.yeast_size), axis=0).tolist()
+
+        # The colonization uses the totals of the strains that are left. Strains dropped by compact_extinct_strains
+        # show up in the reported totals as 0.
+        self.active_totals = (self.v_population_totals, self.s_population_totals)
+        if self.strain_ids is not None:
+            self.v_population_totals = self.report_strains(self.v_population_totals)
+            self.s_population_totals = self.report_strains(self.s_population_totals)
+            self.patch_occupancy = self.report_strains(self.patch_occupancy)
+
+        self.all_population_totals = [v + s for v, s in zip(self.v_population_totals, self.s_population_totals)]
 
 
 
         self.total_pop = sum(self.all_population_totals)
-        self.patches_occupied = self.patches_occupied/self.patch_num  # Turns patches_occupied into a frequency
-        self.patch_occupancy = [p / self.patch_num for p in
+        self.patches_occupied = self.patches_occupied / world.num_patches  # Turns patches_occupied into a frequency
+        self.patch_occupancy = [p / world.num_patches for p in
                                 self.patch_occupancy]  # Turns number of patches occupied into frequency
 
         return (self.total_resources, self.v_population_totals, self.s_population_totals, self.all_population_totals)
 
+    def sparse_book_keeping(self, world):
+        """ The totals of book_keeping from the sparse state, without making the dense arrays. """
+
+        state = world.state
+        S = self.num_strains
+        held = np.flatnonzero(state['winner'] >= 0)
+        propagules = self.propagules
+        propagules.sort()
+
+        # Every population in the world, the winners and the colonists
+        patch = np.concatenate((held, propagules.patch))
+        strain = np.concatenate((state['winner'][held], propagules.strain))
+        veg = np.concatenate((state['veg'][held], propagules.veg))
+        spore = np.concatenate((state['spore'][held], propagules.spore))
+
+        self.v_population_totals = np.bincount(strain, veg, minlength=S).tolist()
+        self.s_population_totals = np.bincount(strain, spore, minlength=S).tolist()
+        self.patches_occupied = len(np.unique(patch[(veg != 0) | (spore != 0)]))
+
+        # A colonist can land on a patch its strain already holds, so add up each strain in each patch first
+        pairs, which = np.unique(patch * S + strain, return_inverse=True)
+        pair_veg = np.bincount(which.ravel(), veg, minlength=len(pairs))
+        pair_spore = np.bincount(which.ravel(), spore, minlength=len(pairs))
+        occupying = pairs[(pair_veg >= self.yeast_size) | (pair_spore >= self.yeast_size)] % S
+        self.patch_occupancy = np.bincount(occupying, minlength=S).tolist()
+
+    def compact_extinct_strains(self, world):
+        """
+        Drops the strains that are extinct in every patch from the state arrays and the per strain parameters, so
+        that the rest of the run doesn't spend time on them. Colonists only come from living cells, so an extinct
+        strain can never come back. The strains that are left are renumbered 0 to num_strains - 1 and strain_ids
+        holds their original numbers. book_keeping and the saved data still report all the original strains.
+
+        Returns:
+            The original numbers of the strains that were dropped
+        """
+
+        state = world.state
+        S = self.num_strains
+        if self.sparse_eq:
+            alive = np.zeros(S, dtype=bool)
+            held = (state['winner'] >= 0) & ((state['veg'] > 0) | (state['spore'] > 0))
+            alive[state['winner'][held]] = True
+            self.propagules.sort()
+            alive[self.propagules.strain[(self.propagules.veg > 0) | (self.propagules.spore > 0)]] = True
+        else:
+            alive = (state['v_populations'] > 0).any(axis=0) | (state['s_populations'] > 0).any(axis=0)
+        if alive.all() or not alive.any():  # Keep at least one, so the arrays never have no columns
+            return []
+
+        keep = np.flatnonzero(alive)
+        ids = self.strain_ids if self.strain_ids is not None else np.arange(S)
+        dropped = ids[~alive].tolist()
+
+        if self._all_strain_params is None:
+            self._all_strain_params = {name: list(getattr(self, name)) for name in self.strain_params}
+
+        # Patches with their own per strain parameters
+        own = [(patch, field) for patch in world.patches.materialized_patches() if patch.has_overrides()
+               for field, rules_name in self.patch_defaults.items()
+               if rules_name in self.strain_params and getattr(patch, field) is not getattr(self, rules_name)]
+        for patch, field in own:
+            setattr(patch, field, [getattr(patch, field)[i] for i in keep])
+        for name in self.strain_params:
+            setattr(self, name, [getattr(self, name)[i] for i in keep])
+
+        if self.sparse_eq:
+            new_index = np.full(S, -1)
+            new_index[keep] = np.arange(len(keep))
+            winner = state['winner']
+            winner[:] = np.where(winner >= 0, new_index[np.maximum(winner, 0)], -1)
+            propagules = self.propagules
+            living = new_index[propagules.strain] >= 0
+            propagules.patch, propagules.strain, propagules.veg, propagules.spore = (
+                propagules.patch[living], new_index[propagules.strain[living]], propagules.veg[living],
+                propagules.spore[living])
+        else:
+            for name in ['v_populations', 's_populations']:
+                world.set_state(name, np.ascontiguousarray(state[name][:, keep]))
+            world.set_state('presence', np.zeros((world.num_patches, bitset.num_words(len(keep))), dtype=np.uint64))
+            self.refresh_presence(world)
+
+        self.strain_ids = ids[keep]
+        self.num_strains = len(keep)
+        logging.info(f"Strains {dropped} are extinct and were dropped at gen {world.age}.")
+        return dropped
+
+    def report_strains(self, values):
+        """ Spreads values of the strains left after compaction over all the original strains, 0 for dropped ones. """
+
+        if self.strain_ids is None:
+            return list(values)
+        full = [0] * len(self._all_strain_params['spore_chance'])
+        for i, value in zip(self.strain_ids, values):
+            full[i] = value
+        return full
+
+    def all_strain_params(self, name):
+        """ The per strain parameter name for all the original strains, including the ones compaction dropped. """
+
+        if self._all_strain_params is None:
+            return getattr(self, name)
+        return self._all_strain_params[name]
+
     def census(self, world):
+        """
+        Runs the observers that are due this generation (see add_observers and scheduler.py). The totals are only
+        summed when one of them needs them, otherwise only the total population is, for stop_condition.
+        """
 
-        if world.age % 100 == 0:
-            self.safety_checks(world)  # Do this only once in a while for performance reasons
+        if not self.scheduler.run(world, lambda: self.book_keeping(world)):
+            self.total_pop = self.population_total(world)
 
-        logging.info("Censusing and saving data")
-        total_resources, v_population_totals, s_population_totals, final_totals = self.book_keeping(world)
+    def add_observers(self):
+        """
+        The observers census runs: safety checks every 100 generations, saving the totals every data_save_step
+        generations, patch data, dropping extinct strains and progress reports. Add others (a checkpoint, say)
+        with self.scheduler.observe.
+        """
 
+        scheduler = self.scheduler
+        scheduler.observe('safety checks', lambda world, totals: self.safety_checks(world), every=100)
+        scheduler.observe('compaction', self.compaction_observer, every=1, totals=True,
+                          enabled=lambda: self.compact_strains)
+        scheduler.observe('patch data', self.save_patch_observer, every=1, enabled=lambda: self.save_patch_data)
+        scheduler.observe('totals', self.save_totals_observer, every=lambda: self.data_save_step, totals=True,
+                          enabled=lambda: self.save_data)
+        scheduler.observe('progress', self.progress_observer, when=lambda world: self.reporter.due(world.age),
+                          totals=True)
+
+    def compaction_observer(self, world, totals):
+        # Only look for extinct strains when some strain's total is down to 0
+        if min(v + s for v, s in zip(*self.active_totals)) <= 0:
+            self.compact_extinct_strains(world)
+
+    def save_patch_observer(self, world, totals):
         # Write to individual patch save files
-        if self.save_patch_data:
-            for patch in world.patches:
-                self.files[patch.id].write(f"{world.age}, {str(patch.init_resources_per_patch)}")
-                for i in range(0, self.num_strains):
-                    self.files[patch.id].write(str(patch.v_populations[i]) + ',' + str(patch.s_populations[i]) + ',')
+        for patch in world.patches:
+            self.files[patch.id].write(f"{world.age}, {str(patch.init_resources_per_patch)}")
+            for i in range(0, self.num_strains):
+                self.files[patch.id].write(str(patch.v_populations[i]) + ',' + str(patch.s_populations[i]) + ',')
+
+    def save_totals_observer(self, world, totals):
+        total_resources, v_population_totals, s_population_totals, final_totals = totals
+        rows = self.observation_rows(world, total_resources, v_population_totals, s_population_totals)
+
+        # With a tolerance only save rows that changed enough since the last saved one
+        if self.record_rtol is not None:
+            if self._totals_filter is None:
+                self._totals_filter = ChangeFilter(self.record_rtol, self.record_atol, self.record_heartbeat)
+            values = [rows[1]] + rows[2] + rows[3] + rows[4] + [rows[5]]
+            if not self._totals_filter.changed(world.age, values):
+                self._unsaved_rows = rows  # Saved at the end if nothing comes after it, so the last row is exact
+                return
 
-        if self.save_data:
-            # Open closed data files
-            if self.total_file.closed:
-                # print("Opening totals file")
-                self.total_file = open(f'{self.data_path}/totals.csv', 'a')
-            # Update the data files every n'th step
-            if world.age % self.data_save_step == 0:
-                self.record_observations(self.total_file, world, total_resources, v_population_totals,
-                                         s_population_totals)
-
-        # if world.age % 10 == 0:
-            # print("    Veg, Spore, Resource, patches occupied:",
-            #       round(sum(v_population_totals), 3), round(sum(s_population_totals), 3),
-            #       round(total_resources, 3), self.patches_occupied)
+        logging.info("Saving the totals")
+        self._unsaved_rows = None
+        self.save_totals(rows)
+
+    def save_totals(self, rows):
+        """ Appends rows (see observation_rows) to totals.csv. """
+
+        if self.async_output:
+            self.output_writer().write(f'{self.data_path}/totals.csv', self.format_observations, *rows)
+            return
+
+        # Open closed data files
+        if self.total_file.closed:
+            self.total_file = open(f'{self.data_path}/totals.csv', 'a')
+        self.total_file.write(self.format_observations(*rows))
+
+    def progress_observer(self, world, totals):
+        total_resources, v_population_totals, s_population_totals, final_totals = totals
+        self.reporter.report(world, lambda: [f"Veg, Spore, Resource, patches occupied: "
+                                             f"{round(sum(v_population_totals), 3)}, "
+                                             f"{round(sum(s_population_totals), 3)}, "
+                                             f"{round(total_resources, 3)}, {self.patches_occupied}"])
+
+    def population_total(self, world):
+        """ The total population of the world, without the rest of book_keeping when the state is dense. """
+
+        if self.sparse_eq:
+            self.book_keeping(world)
+            return self.total_pop
+        return float(world.state['v_populations'].sum() + world.state['s_populations'].sum())
 
     def stop_condition(self, world):
         if world.age >= self.stop_time:
@@ -647,10 +1481,20 @@ class NStrain(Rules):
         self.book_keeping(world)
 
         if self.save_data:
-            with open(f'{self.data_path}/final_eq.csv', 'a') as final_eq:
+            if self._unsaved_rows is not None:  # The last totals the change filter skipped
+                self.save_totals(self._unsaved_rows)
+                self._unsaved_rows = None
+
+            if self.async_output:
                 total_resources, v_population_totals, s_population_totals, final_totals = self.book_keeping(world)
-                self.record_observations(final_eq, world, total_resources, v_population_totals,
-                                         s_population_totals)
+                self.record_observations(f'{self.data_path}/final_eq.csv', world, total_resources,
+                                         v_population_totals, s_population_totals)
+                self.output_writer().close()  # Everything is on disk once the simulation ends
+            else:
+                with open(f'{self.data_path}/final_eq.csv', 'a') as final_eq:
+                    total_resources, v_population_totals, s_population_totals, final_totals = self.book_keeping(world)
+                    self.record_observations(final_eq, world, total_resources, v_population_totals,
+                                             s_population_totals)
 
             self.total_file.close()
 
@@ -659,32 +1503,49 @@ class NStrain(Rules):
         Recall that the columns are
         "Iteration", "Global Resources", "Strain Number", "Sporulation Chance",
         "Type", "Population", "Patch Occupancy of Strain", "Global Patch Occupancy" "Replicate Number"
+
+        file is an open file, or the path of one to hand the rows to the background writer (see async_output).
         """
 
-        for case in ["spore", "veg", "total"]:
-            for i in range(0, self.num_strains):
+        rows = self.observation_rows(world, total_resources, v_population_totals, s_population_totals)
+        if isinstance(file, str):
+            self.output_writer().write(file, self.format_observations, *rows)
+        else:
+            file.write(self.format_observations(*rows))
+
+    def observation_rows(self, world, total_resources, v_population_totals, s_population_totals):
+        """ What record_observations writes, as the arguments of format_observations. """
 
-                file.write(str(world.age) + ",")  # Iteration
-                file.write(str(total_resources) + ",")  # Resources
-                file.write(str(i) + ",")  # Strain Num
-                file.write(str(self.spore_chance[i]) + ",")  # Strain Num
+        # Copies, since the background writer formats them later
+        return (world.age, total_resources, list(v_population_totals), list(s_population_totals),
+                list(self.patch_occupancy), self.patches_occupied, list(self.all_strain_params('spore_chance')))
+
+    def format_observations(self, age, total_resources, v_population_totals, s_population_totals, patch_occupancy,
+                            patches_occupied, spore_chance):
+        """ The rows record_observations writes, as text. """
+
+        lines = []
+        for case in ["spore", "veg", "total"]:
+            for i in range(0, len(spore_chance)):
 
                 # Type and population
                 if case == "spore":
-                    file.write("Spore,")
-                    file.write(str(s_population_totals[i]) + ',')
+                    kind, population = "Spore", s_population_totals[i]
                 elif case == "veg":
-                    file.write("Veg,")
-                    file.write(str(v_population_totals[i]) + ',')
-                elif case == "total":
-                    file.write("Both,")
-                    file.write(str(v_population_totals[i] + s_population_totals[i]) + ',')
+                    kind, population = "Veg", v_population_totals[i]
+                else:
+                    kind, population = "Both", v_population_totals[i] + s_population_totals[i]
+
+                lines.append(f"{age},{total_resources},{i},{spore_chance[i]},{kind},{population},"
+                             f"{patch_occupancy[i]},{patches_occupied},{self.replicate_number}\n")
+        return "".join(lines)
 
-                file.write(str(self.patch_occupancy[i]) + ',')  # Patch occupancy of strain
-                file.write(str(self.patches_occupied) + ",")  # Global patch occupancy
+    def output_writer(self):
+        """ The background writer of async_output, made when first needed. """
 
-                file.write(str(self.replicate_number))
-                file.write("\n")
+        if self.writer is None:
+            self.writer = AsyncWriter(name=f"{self.data_path} writer")
+        return self.writer
 
 
 
@@ -30,9 +30,9 @@ def basic_sim(num_strains, num_loops, name, sc_override=None, save_data=True):
     if sc_override:
         sc = sc_override
 
-    world = World(NStrain(num_strains, folder_name=name, console_input=False, spore_chance=sc, germ_chance=gc,
-                          fly_s_survival=fss,
-                          fly_v_survival=fvs, save_data=save_data))
+    rules = NStrain(num_strains, folder_name=name, console_input=False, spore_chance=sc, germ_chance=gc,
+                    fly_s_survival=fss,
+                    fly_v_survival=fvs, save_data=save_data)
 
     if not skip_simulation:
 
@@ -46,6 +46,7 @@ def basic_sim(num_strains, num_loops, name, sc_override=None, save_data=True):
                                   fly_s_survival=fss,
                                   fly_v_survival=fvs))
             run(world)
+            rules = world.rules
 
             # Make a list of final eq values
             resources = list(world.rules.book_keeping(world))[0]
@@ -72,14 +73,14 @@ def basic_sim(num_strains, num_loops, name, sc_override=None, save_data=True):
     print("averg patch freqs", average_patch_freqs)
 
     # Save the data
-    helpers.init_csv(world.rules.data_path, "average_eqs.csv", ["Sporulation Probability", "Average Eq Frequency"])
-    with open(world.rules.data_path + "/average_eqs.csv", 'a') as f:
+    helpers.init_csv(rules.data_path, "average_eqs.csv", ["Sporulation Probability", "Average Eq Frequency"])
+    with open(rules.data_path + "/average_eqs.csv", 'a') as f:
         for chance, eq in zip(sc, average_eqs):
             f.write(f"{chance},{eq}\n")
 
-    helpers.init_csv(world.rules.data_path, "average_patch_freq_eq.csv",
+    helpers.init_csv(rules.data_path, "average_patch_freq_eq.csv",
                      [f"Patch Occupancy Strain {i}" for i in range(0, num_strains)])
-    with open(world.rules.data_path + "/average_patch_freq_eq.csv", 'a') as f:
+    with open(rules.data_path + "/average_patch_freq_eq.csv", 'a') as f:
         for chance, eq in zip(sc, [average_patch_freqs]):
             f.write(f"{chance},")
             for strain in eq:
@@ -100,11 +101,11 @@ def single_spore_curve(folder_name, resolution, iterations_for_average, save_dat
     Returns:
 
     """
-    # Make world just so can make path
-    world = World(NStrain(1, folder_name=folder_name, console_input=False, spore_chance=[1], germ_chance=[1],
-                          fly_s_survival=[1], fly_v_survival=[1], save_data=save_data))
+    # Make rules just so can make path. (No need to build a world for this.)
+    rules = NStrain(1, folder_name=folder_name, console_input=False, spore_chance=[1], germ_chance=[1],
+                    fly_s_survival=[1], fly_v_survival=[1], save_data=save_data)
 
-    helpers.init_csv(world.rules.data_path, "single_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
+    helpers.init_csv(rules.data_path, "single_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
 
     pops = []
     patch_freqs = []
@@ -121,14 +122,14 @@ def single_spore_curve(folder_name, resolution, iterations_for_average, save_dat
 
 
 
-    helpers.init_csv(world.rules.data_path, "single_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
-    with open(world.rules.data_path + "/single_strain_averages.csv", 'a') as f:
+    helpers.init_csv(rules.data_path, "single_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
+    with open(rules.data_path + "/single_strain_averages.csv", 'a') as f:
         for chance, eq in zip(sc, pops):
             f.write(f"{chance},{eq}\n")
 
-    helpers.init_csv(world.rules.data_path, "single_strain_patch_freq_averages.csv", ["Sporulation Probability"] +
-                     [f"Patch Occupancy Strain {i}" for i in range(0, world.rules.num_strains)])
-    with open(world.rules.data_path + "/single_strain_patch_freq_averages.csv", 'a') as f:
+    helpers.init_csv(rules.data_path, "single_strain_patch_freq_averages.csv", ["Sporulation Probability"] +
+                     [f"Patch Occupancy Strain {i}" for i in range(0, rules.num_strains)])
+    with open(rules.data_path + "/single_strain_patch_freq_averages.csv", 'a') as f:
         for chance, eq in zip(sc, patch_freqs):
             f.write(f"{chance},{eq}\n")
 
@@ -144,10 +145,10 @@ def double_spore_curve(folder_name, resolution, iterations_for_average):
     Returns:
 
     """
-    # Make world just so can make path  # Todo this is inelegant and leads to errors about strain number in csv. Fix
-    world = World(NStrain(2, folder_name=folder_name, console_input=False, spore_chance=[1], germ_chance=[1],
-                          fly_s_survival=[1], fly_v_survival=[1], save_data=True))
-    helpers.init_csv(world.rules.data_path, "double_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
+    # Make rules just so can make path  # Todo this is inelegant and leads to errors about strain number in csv. Fix
+    rules = NStrain(2, folder_name=folder_name, console_input=False, spore_chance=[1], germ_chance=[1],
+                    fly_s_survival=[1], fly_v_survival=[1], save_data=True)
+    helpers.init_csv(rules.data_path, "double_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
 
     eqs = []
     patch_freqs = []
@@ -163,15 +164,15 @@ def double_spore_curve(folder_name, resolution, iterations_for_average):
 
     print("patch freqs", patch_freqs)
 
-    helpers.init_csv(world.rules.data_path, "double_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
-    with open(world.rules.data_path + "/double_strain_averages.csv", 'a') as f:
+    helpers.init_csv(rules.data_path, "double_strain_averages.csv", ["Sporulation Probability", "Average Eq"])
+    with open(rules.data_path + "/double_strain_averages.csv", 'a') as f:
         for chance, eq in zip(sc, eqs):
             f.write(f"{chance},{eq}\n")
 
-    helpers.init_csv(world.rules.data_path, "double_strain_patch_freq_avgs.csv",
+    helpers.init_csv(rules.data_path, "double_strain_patch_freq_avgs.csv",
                      ["Sporulation Probability"] +
-                     [f"Patch Occupancy Strain {i}" for i in range(0, world.rules.num_strains)])
-    with open(world.rules.data_path + "/double_strain_patch_freq_avgs.csv", 'a') as f:
+                     [f"Patch Occupancy Strain {i}" for i in range(0, rules.num_strains)])
+    with open(rules.data_path + "/double_strain_patch_freq_avgs.csv", 'a') as f:
         for chance, eq in zip(sc, patch_freqs):
             f.write(f"{chance},")
             for strain in eq:
@@ -0,0 +1,108 @@
+"""
+The delta buffer. Collects the changes to the patches made during a step and applies them all at once at the end.
+
+Normally a colonization event changes the populations right away, so what later events see depends on the order the
+patches are visited in. With a buffer every event reads the state as it was at the start of the step and writes its
+change into the buffer instead. Applying the buffer is then a single numpy operation for each state array
+(numpy.add.at, so many changes to the same patch add up).
+
+Changes to attributes that are not part of world.state (see Rules.allocate_state) are applied one at a time.
+"""
+
+import numpy as np
+
+
+class DeltaBuffer:
+
+    def __init__(self, world):
+        """
+        Args:
+            world: The world whose patches are changed
+        """
+
+        self.world = world
+        self._deltas = {}  # {state name: ([patch indices], [columns], [amounts])}
+        self._other = []  # Changes to attributes outside world.state, as (patch index, name, amount, column)
+
+    def add(self, name, index, amount, column=None):
+        """
+        Queues adding amount to an attribute of a patch.
+
+        Args:
+            name: The attribute, for example 'v_populations'
+            index: The index of the patch
+            amount: What to add. If column is None this is added to the whole attribute, so it can be a list with an
+                    entry for each strain.
+            column: Only add to this entry of the attribute, for example a strain number or dictionary key.
+        """
+
+        if name not in self.world.state:
+            self._other.append((index, name, amount, column))
+            return
+
+        deltas = self._deltas.get(name)
+        if deltas is None:
+            deltas = self._deltas[name] = ([], [], [])
+
+        if column is None and self.world.state[name].ndim > 1:  # A whole row
+            amount = list(amount)
+            deltas[0].extend([index] * len(amount))
+            deltas[1].extend(range(len(amount)))
+            deltas[2].extend(amount)
+        else:
+            deltas[0].append(index)
+            deltas[1].append(column)
+            deltas[2].append(amount)
+
+    def add_many(self, name, indices, amounts, columns=None):
+        """
+        Queues many changes to a state array at once, like calling add for each of them.
+
+        Args:
+            name: The state array, for example 'v_populations'
+            indices: The index of the patch of each change
+            amounts: The amount of each change
+            columns: The column of each change, for arrays with a row per patch. None for one dimensional arrays.
+        """
+
+        deltas = self._deltas.get(name)
+        if deltas is None:
+            deltas = self._deltas[name] = ([], [], [])
+        indices = np.asarray(indices).tolist()
+        deltas[0].extend(indices)
+        deltas[1].extend([None] * len(indices) if columns is None else np.asarray(columns).tolist())
+        deltas[2].extend(np.broadcast_to(amounts, (len(indices),)).tolist())
+
+    def apply(self):
+        """ Applies every queued change and empties the buffer. """
+
+        state = self.world.state
+        for name, (indices, columns, amounts) in self._deltas.items():
+            array = state[name]
+            if array.ndim == 1:
+                np.add.at(array, np.asarray(indices, dtype=np.intp), np.asarray(amounts, dtype=array.dtype))
+            else:
+                np.add.at(array, (np.asarray(indices, dtype=np.intp), np.asarray(columns, dtype=np.intp)),
+                          np.asarray(amounts, dtype=array.dtype))
+
+        for index, name, amount, column in self._other:
+            patch = self.world.patches[index]
+            if column is None:
+                value = getattr(patch, name)
+                if np.ndim(value):  # Entry by entry, not list concatenation
+                    added = np.add(value, amount)
+                    setattr(patch, name, added.tolist() if isinstance(value, list) else added)
+                else:
+                    setattr(patch, name, value + amount)
+            else:
+                getattr(patch, name)[column] += amount
+
+        self.clear()
+
+    def clear(self):
+        """ Forget every queued change without applying it. """
+        self._deltas = {}
+        self._other = []
+
+    def __len__(self):
+        return sum(len(indices) for indices, _, _ in self._deltas.values()) + len(self._other)
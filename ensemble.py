@@ -0,0 +1,278 @@
+"""
+The ensemble engine. Runs many replicates of an NStrain simulation at once.
+
+A World runs one replicate, and for small worlds most of the time goes to the Python loop around the numpy calls
+instead of the numpy calls themselves. An Ensemble instead keeps the populations of all replicates in one array with
+a leading replicate axis, v[replicate, patch, strain], so every phase (update, colonize, kill, census) is one set of
+numpy calls for all replicates. Replicates that are finished (stop_time reached or extinct) are left out of the
+calls and keep their final state.
+
+Each replicate can have its own NStrain parameters (both the patch parameters and the per strain ones), so a sweep
+over parameter points with the same number of strains and patches can also be one ensemble. Global settings like the
+update and colonize modes, dt and stop_time come from the first rules object.
+
+The patches are well mixed, like a complete worldmap: colonization uses the global pool of the 'probabilities' and
+'mean field' modes (which draw the same thing), so only the number of patches of the worldmap is used.
+
+    ensemble = Ensemble(NStrain(3, ...), replicates=100)
+    ensemble.run()
+    ensemble.v_population_totals  # (replicates, strains)
+"""
+
+import logging
+
+import numpy as np
+
+from simrules import helpers
+from simrules.equilibria import single_strain_equilibria
+from simrules.ode import NStrainODE
+
+# The parameters each replicate can have its own value of
+PATCH_PARAMS = ('c', 'alpha', 'gamma', 'mu_v', 'mu_s', 'mu_R')
+STRAIN_PARAMS = ('spore_chance', 'germ_chance', 'fly_v_survival', 'fly_s_survival')
+
+UPDATE_MODES = ('discrete', 'eq', 'ode', 'adaptive')
+
+
+class Ensemble:
+
+    def __init__(self, rules, replicates=None, record_every=None):
+        """
+        Args:
+            rules: An NStrain rules object used for every replicate, or a list with one for each replicate. They must
+                   all have the same number of strains and patches.
+            replicates: The number of replicates, if rules is a single object
+            record_every: Keep the totals of every this many generations in history. None to keep none.
+        """
+
+        if not isinstance(rules, (list, tuple)):
+            rules = [rules] * (replicates if replicates is not None else 1)
+        first = rules[0]
+
+        self.rules = rules
+        self.num_replicates = R = len(rules)
+        self.num_strains = S = first.num_strains
+        self.num_patches = n = first.worldmap.number_of_nodes()
+        for r in rules:
+            if r.num_strains != S or r.worldmap.number_of_nodes() != n:
+                raise ValueError("All replicates of an ensemble need the same number of strains and patches.")
+
+        # The parameters of each replicate, (R,) for patch parameters and (R, S) for strain parameters
+        for name in PATCH_PARAMS:
+            setattr(self, name, np.array([float(getattr(r, name)) for r in rules]))
+        for name in STRAIN_PARAMS:
+            setattr(self, name, np.array([list(getattr(r, name)) for r in rules], dtype=float))
+
+        # Global settings
+        self.update_mode = first.update_mode
+        self.colonize_mode = first.colonize_mode
+        if self.update_mode not in UPDATE_MODES:
+            raise ValueError(f"{self.update_mode} is not a valid update mode for an ensemble. (Choose {UPDATE_MODES})")
+        if self.colonize_mode == 'fly':
+            raise ValueError("Ensembles are well mixed, so they can't use the 'fly' colonize mode.")
+        self.dt = first.dt
+        self.patch_update_iterations = first.patch_update_iterations
+        self.colonization_prob_slope = first.colonization_prob_slope
+        self.prob_death = first.prob_death
+        self.stop_time = first.stop_time
+        self.yeast_size = first.yeast_size
+        self.germinate_on_drop = first.germinate_on_drop
+        self.init_resources_per_patch = first.init_resources_per_patch
+        self.ode_method = first.ode_method
+        self.ode_rtol = first.ode_rtol
+        self.ode_atol = first.ode_atol
+
+        self.rng = helpers.numpy_rng()
+        self.record_every = record_every
+        self.history = []  # (generation, total resources, veg totals, spore totals) of each replicate
+
+        # The state of every replicate
+        self.v = np.zeros((R, n, S))
+        self.s = np.zeros((R, n, S))
+        self.resources = np.full((R, n), self.init_resources_per_patch, dtype=float)
+        self.step_size = np.zeros((R, n))  # See the 'adaptive' update mode of NStrain
+        self.age = np.zeros(R, dtype=int)
+        self.done = np.zeros(R, dtype=bool)
+
+        # The census of every replicate
+        self.total_resources = np.zeros(R)
+        self.v_population_totals = np.zeros((R, S))
+        self.s_population_totals = np.zeros((R, S))
+        self.patch_occupancy = np.zeros((R, S))
+        self.patches_occupied = np.zeros(R)
+        self.total_pop = np.zeros(R)
+
+        if self.update_mode == 'eq':
+            # One row per replicate, and empty_resources is (R, 1)
+            p = {name: getattr(self, name)[:, None] for name in PATCH_PARAMS}
+            self.eq_table = single_strain_equilibria(self.spore_chance, **p)
+
+        self.set_initial_conditions()
+
+    def set_initial_conditions(self):
+        """ Same as NStrain: patch i gets a little of strain i % num_strains. """
+
+        patches = np.arange(self.num_patches)
+        strains = patches % self.num_strains
+        self.v[:, patches, strains] += self.yeast_size
+        self.s[:, patches, strains] += self.yeast_size
+        self.census(slice(None))
+
+    def run(self):
+        """ Runs every replicate until it reaches stop_time or goes extinct. """
+
+        while self.step():
+            pass
+        logging.info(f"Ensemble of {self.num_replicates} finished. Generations: {self.age.tolist()}")
+
+    def step(self):
+        """
+        Runs one generation of every replicate that isn't finished, like main.simulate.
+
+        Returns:
+            False once every replicate is finished.
+        """
+
+        self.done |= (self.age >= self.stop_time) | (self.total_pop == 0)
+        if self.done.all():
+            return False
+
+        # The replicates still running. A slice when they all are, so the arrays are views and need no copying.
+        running = slice(None) if not self.done.any() else np.flatnonzero(~self.done)
+        v, s, resources = self.v[running], self.s[running], self.resources[running]
+        p = {name: getattr(self, name)[running] for name in PATCH_PARAMS + STRAIN_PARAMS}
+
+        resources = self.update(running, v, s, resources, p)
+        self.colonize(v, s, p)
+        self.kill_patches(v, s, resources)
+
+        self.v[running] = v
+        self.s[running] = s
+        self.resources[running] = resources
+        self.age[running] += 1
+        self.census(running)
+        return True
+
+    def update(self, running, v, s, resources, p):
+        """
+        The patch update of the running replicates, see NStrain.patch_update. Changes v and s in place.
+
+        Returns:
+            The new resources
+        """
+
+        if self.update_mode == 'discrete':
+            ac = (p['alpha'] * p['c'])[:, None, None]
+            spore_chance = p['spore_chance'][:, None, :]
+            germ_chance = p['germ_chance'][:, None, :]
+            for _ in range(self.patch_update_iterations):
+                r = resources[..., None]
+                born = ac * r * v
+                germinated = germ_chance * r * s
+                v_change = born * (1 - spore_chance) - p['mu_v'][:, None, None] * v + germinated
+                s_change = born * spore_chance - p['mu_s'][:, None, None] * s - germinated
+                r_change = p['gamma'][:, None] - p['mu_R'][:, None] * resources - p['c'][:, None] * resources * v.sum(-1)
+
+                v += v_change * self.dt
+                s += s_change * self.dt
+                resources = resources + r_change * self.dt
+                np.maximum(v, 0, out=v)
+                np.maximum(s, 0, out=s)
+                np.maximum(resources, 0, out=resources)
+            return resources
+
+        if self.update_mode == 'eq':
+            # The winner is the present strain with the lowest sporulation chance. Ties are broken at random.
+            present = v > 0
+            spore_chance = np.where(present, p['spore_chance'][:, None, :], np.inf)
+            tied = present & (spore_chance == spore_chance.min(axis=-1)[..., None])
+            winner = np.where(tied, self.rng.random(tied.shape), -1).argmax(axis=-1)
+            occupied = present.any(axis=-1)
+
+            table = self.eq_table
+            veg, spore = table.veg[running], table.spore[running]
+            rows = np.arange(len(v))[:, None]
+            v[:] = 0
+            s[:] = 0
+            at_r, at_patch = np.nonzero(occupied)
+            at_strain = winner[at_r, at_patch]
+            v[at_r, at_patch, at_strain] = veg[at_r, at_strain]
+            s[at_r, at_patch, at_strain] = spore[at_r, at_strain]
+            return np.where(occupied, table.resources[running][rows, winner], table.empty_resources[running])
+
+        # 'ode' and 'adaptive' integrate all patches of all running replicates as one stacked system
+        R, n, S = v.shape
+        model = NStrainODE(S, *(np.repeat(p[name], n) for name in PATCH_PARAMS),
+                           spore_chance=np.repeat(p['spore_chance'], n, axis=0),
+                           germ_chance=np.repeat(p['germ_chance'], n, axis=0))
+        duration = self.dt * self.patch_update_iterations
+        y = (resources.ravel(), v.reshape(-1, S), s.reshape(-1, S))
+        if self.update_mode == 'ode':
+            new_resources, new_v, new_s = model.advance(*y, duration, method=self.ode_method, rtol=self.ode_rtol,
+                                                        atol=self.ode_atol)
+        else:
+            new_resources, new_v, new_s, step_size = model.advance_adaptive(
+                *y, duration, rtol=self.ode_rtol, atol=self.ode_atol, step_size=self.step_size[running].ravel())
+            self.step_size[running] = step_size.reshape(R, n)
+        v[:] = new_v.reshape(R, n, S)
+        s[:] = new_s.reshape(R, n, S)
+        return new_resources.reshape(R, n)
+
+    def colonize(self, v, s, p):
+        """
+        The global pool colonization of NStrain.probability_colonize_mode for the running replicates. Each patch is
+        colonized with a chance that grows with the surviving propagules of its replicate, and the colonist is
+        drawn from that replicate's pool.
+        """
+
+        R, n, S = v.shape
+        weights = np.concatenate((np.maximum(v.sum(axis=1), 0) * p['fly_v_survival'],
+                                  np.maximum(s.sum(axis=1), 0) * p['fly_s_survival']), axis=1)
+        weighted_sum = weights.sum(axis=1)
+        prob = np.minimum(weighted_sum / n * self.colonization_prob_slope * self.dt, 1)
+
+        at_r, at_patch = np.nonzero(self.rng.random((R, n)) < prob[:, None])
+        if len(at_r) == 0:
+            return
+
+        # Draw each colonist from the cumulative weights of its replicate
+        cdf = np.cumsum(weights, axis=1) / np.maximum(weighted_sum, 1e-300)[:, None]
+        colonists = np.minimum((self.rng.random(len(at_r))[:, None] > cdf[at_r]).sum(axis=1), 2 * S - 1)
+
+        strains = colonists % S
+        as_spore = (colonists >= S) & (not self.germinate_on_drop)
+        np.add.at(v, (at_r[~as_spore], at_patch[~as_spore], strains[~as_spore]), self.yeast_size)
+        np.add.at(s, (at_r[as_spore], at_patch[as_spore], strains[as_spore]), self.yeast_size)
+
+    def kill_patches(self, v, s, resources):
+        """ Resets each patch with probability prob_death * dt, like NStrain.kill_patches. """
+
+        dead = self.rng.random(resources.shape) < self.prob_death * self.dt
+        v[dead] = 0
+        s[dead] = 0
+        resources[dead] = self.init_resources_per_patch
+
+    def census(self, running):
+        """ The totals of NStrain.book_keeping, for each of the running replicates. """
+
+        v, s = self.v[running], self.s[running]
+        self.total_resources[running] = self.resources[running].sum(axis=1)
+        self.v_population_totals[running] = v_totals = v.sum(axis=1)
+        self.s_population_totals[running] = s_totals = s.sum(axis=1)
+        self.total_pop[running] = (v_totals + s_totals).sum(axis=1)
+        self.patches_occupied[running] = (v.any(axis=-1) | s.any(axis=-1)).mean(axis=1)
+        self.patch_occupancy[running] = ((v >= self.yeast_size) | (s >= self.yeast_size)).mean(axis=1)
+
+        if self.record_every is not None:
+            generation = int(self.age[running].max()) if self.age[running].size else 0
+            if generation % self.record_every == 0:
+                self.history.append((generation, self.total_resources.copy(), self.v_population_totals.copy(),
+                                     self.s_population_totals.copy()))
+
+    @property
+    def all_population_totals(self):
+        return self.v_population_totals + self.s_population_totals
+
+    def __repr__(self):
+        return (f"Ensemble({self.num_replicates} replicates, {self.num_patches} patches, {self.num_strains} strains, "
+                f"{np.count_nonzero(~self.done)} running)")
@@ -17,6 +17,9 @@ from simrules import helpers
 from world import World
 from simrules.NStrainsSimple import NStrainsSimple
 
+# How many generations simulate asks world.step for at a time
+STEP_GENERATIONS = 1000
+
 
 def simulate(world):
     """
@@ -25,12 +28,11 @@ def simulate(world):
     """
 
     world.rules.set_initial_conditions(world)
-    while not world.rules.stop_condition(world):
-        world.rules.census(world)
-        world.update_patches()
-        world.rules.colonize(world)
-        world.rules.kill_patches(world)
-        world.age += 1
+    try:
+        while world.step(STEP_GENERATIONS) == STEP_GENERATIONS:  # Fewer means the stop condition was reached
+            pass
+    finally:
+        world.close()
 
     logging.info(f"Finished simulating world {world.name}")
     return world
@@ -8,56 +8,96 @@ The Patch class. This contains three parts
 
 Any other attributes should be defined during patch creation. This can be done with
 > patch.attribute_name = attribute_value
+
+Patches are kept small because there can be hundreds of thousands of them. They use __slots__, and parameters
+that are the same for every patch are stored once on the rules (see Rules.patch_defaults). Reading such a
+parameter from a patch gives the rules' value, unless that patch has been given its own value with
+> patch.parameter_name = value
+in which case only that patch keeps a copy. patch.use_defaults() forgets these per-patch values.
 """
 
 import logging
 import random
-from collections import Callable
 from general import pass_
 
 
+class RulesMethod:
+    """
+    A patch attribute that is the method of the same name on the world's rules, e.g. patch.patch_update.
+    Setting the attribute on a patch replaces it for that patch only.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, patch, owner=None):
+        if patch is None:
+            return self
+        return getattr(patch.world.rules, self.name)
+
+
 class Patch:
 
-    def __init__(self, id_, world, initial_populations=None):
+    __slots__ = ('id', 'index', 'world', 'populations', '_overrides', '__dict__')
+
+    patch_update = RulesMethod('patch_update')
+    reset_patch = RulesMethod('reset_patch')
+
+    def __new__(cls, id_, world, initial_populations=None, index=None):
+        # Patches are made from the world's patch class, which knows where the world keeps the patch state and
+        # which parameters are shared defaults. See patch_class().
+        if cls is Patch and world is not None:
+            cls = getattr(world, "patch_class", Patch)
+        return super().__new__(cls)
+
+    def __init__(self, id_, world, initial_populations=None, index=None):
         """
         Args:
             id_: The id that corresponds to the patch in the world map.
             world: The world that the patch is in.
             initial_populations: Overrides the initial population reset_patch gives, unless set to None.
+            index: The dense index of the patch in the world (its position in world.patches). Looked up from
+                the id if not given.
         """
 
+        if world is None:
+            logging.critical("Patch {} belongs to no world!".format(id_))
+            raise Exception("Patch {} belongs to no world!".format(id_))
+
         # Init values
         self.id = id_
-        self.patch_update = world.rules.patch_update
+        self.index = index if index is not None else world.node_index[id_]
         self.world = world
+        self._overrides = None  # The patch's own values of default parameters. None if it has none.
 
         # Setup the patches
-        self.reset_patch = world.rules.reset_patch
-        self.reset_patch(self)
+        world.rules.init_patch(self)
 
         if initial_populations is not None:
             self.populations = initial_populations  # Override
 
-        self._safety_check()
-
-        logging.info("Patch {} created".format(self.id))
-        logging.debug("Patch {} values:{}".format(self.id, self.__dict__))
-
-    def _safety_check(self):
-        """ A quick check to make sure all values are well defined after initialization. """
+    def use_defaults(self):
+        """ Forget the patch's own parameter values so it uses the defaults on the rules again. """
+        self._overrides = None
+        self._track_custom()
 
-        if self.world is None:
-            logging.critical("Patch {} belongs to no world!".format(self.id))
-            raise Exception("Patch {} belongs to no world!".format(self.id))
+    def has_overrides(self):
+        """ True if the patch has its own value for any default parameter. """
+        return self._overrides is not None
 
-        if not hasattr(self.world, "worldmap"):
-            error = "Patch {} of world {} has no worldmap!".format(self.id, self.world)
-            logging.critical(error)
-            raise Exception(error)
+    def is_custom(self):
+        """
+        True if the patch has its own update function or its own parameter values. Such patches are always
+        updated one at a time, never in bulk. See World.update_patches.
+        """
+        return self._overrides is not None or self.patch_update != self.world.rules.patch_update
 
-        # Test populations is good.
-        # if self.populations is None:
-        #     logging.warning(f"Patch {self.id} has initiated with None for populations.")
+    def _track_custom(self):
+        """ Keeps the patch in world.custom_patches while it is_custom, so the world never has to look for them. """
+        if self.is_custom():
+            self.world.custom_patches.add(self)
+        else:
+            self.world.custom_patches.discard(self)
 
     def update(self):
         """
@@ -89,24 +129,35 @@ class Patch:
         """
 
         neighbors = self.world.worldmap[self.id]  # This goes to the worldmap adjacency matrix to find all neighbors
-        nbs = list(neighbors)\
+        nbs = list(neighbors)
 
         if self_loop:
             nbs.append(self.id)
 
         return sorted(nbs)
 
+    def neighbor_indices(self, self_loop=True):
+        """
+        Like neighbor_ids, but returns the indices of the neighbors in world.patches instead of their node labels.
+        """
+
+        nbs = list(self.world.neighbors[self.index])
+        if self_loop:
+            nbs.append(self.index)
+        return nbs
+
     def random_neighbor(self):
-        """ Returns a random neighboring patch """
+        """
+        Returns the patch a propagule leaving this patch lands on, or None if it has nowhere to go.
 
-        ids = self.neighbor_ids()
+        Follows the direction and weights of the worldmap edges, see World.dispersal. With the default rules and an
+        unweighted map this is a uniform choice among the neighbors and the patch itself.
+        """
 
-        # If no neighbors return None
-        if not ids:
+        i = self.world.dispersal.sample(self.index, random.random())
+        if i is None:
             return None
-
-        id = random.choice(ids)
-        return self.world.patches[id]
+        return self.world.patches[i]
 
     def random_neighbors(self, n):
         """ Returns n random neighbor patches, without duplicates """
@@ -122,7 +173,91 @@ class Patch:
         """
 
         self.patch_update = func
+        self._track_custom()
 
     def census(self):
         pass
         # todo: log history of each patch
+
+
+class StateField:
+    """
+    A patch attribute that lives in the world's bulk allocated state, world.state[name][patch.index].
+
+    Reading a list-like field gives a view of the patch's row, so changing an entry changes the world state.
+    Setting the field copies the value into the row.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, patch, owner=None):
+        if patch is None:
+            return self
+        return patch.world.state[self.name][patch.index]
+
+    def __set__(self, patch, value):
+        patch.world.state[self.name][patch.index] = value
+
+
+class DefaultField:
+    """
+    A patch parameter whose default is stored once, as an attribute of the rules.
+    Setting it on a patch stores an override for only that patch.
+    """
+
+    def __init__(self, name, rules_name):
+        self.name = name
+        self.rules_name = rules_name
+
+    def __get__(self, patch, owner=None):
+        if patch is None:
+            return self
+        overrides = patch._overrides
+        if overrides is not None and self.name in overrides:
+            return overrides[self.name]
+        return getattr(patch.world.rules, self.rules_name)
+
+    def __set__(self, patch, value):
+        if patch._overrides is None:
+            patch._overrides = {}
+            patch.world.custom_patches.add(patch)
+        patch._overrides[self.name] = value
+
+    def __delete__(self, patch):
+        if patch._overrides is not None:
+            patch._overrides.pop(self.name, None)
+            if not patch._overrides:
+                patch._overrides = None
+                patch._track_custom()
+
+
+_patch_classes = {}
+
+
+def patch_class(fields=(), defaults=None, slots=()):
+    """
+    Returns a Patch subclass where each of the given fields is a StateField, each of the defaults is a DefaultField
+    and the slots are extra __slots__.
+    Classes are cached, so all worlds of the same shape share one class.
+
+    Args:
+        fields: A tuple of state field names
+        defaults: A dictionary of {patch attribute name: rules attribute name}
+        slots: A tuple of other attribute names every patch has
+    """
+
+    defaults = tuple(sorted(defaults.items())) if defaults else ()
+    slots = tuple(slot for slot in slots if slot not in Patch.__slots__ and slot not in fields)
+    key = (tuple(fields), defaults, slots)
+
+    if key not in _patch_classes:
+        if key == ((), (), ()):
+            _patch_classes[key] = Patch
+        else:
+            namespace = {'__slots__': slots}
+            namespace.update((name, DefaultField(name, rules_name)) for name, rules_name in defaults)
+            namespace.update((name, StateField(name)) for name in fields)
+            _patch_classes[key] = type("Patch", (Patch,), namespace)
+
+    return _patch_classes[key]
@@ -0,0 +1,157 @@
+"""
+The progress reporter. Rules tell the reporter what the simulation is doing instead of printing it directly.
+
+Printing every patch every generation is slow, so the reporter only writes to the console when a report is due.
+A report is due at most once every `every` generations and at most once every `interval` seconds.
+Each report also carries machine readable progress (generations per second, ETA) which can be read from
+reporter.last or passed to a callback.
+
+Per-event messages (a patch was reset, a yeast moved) should go to logging.debug instead of the reporter.
+"""
+
+import sys
+import time
+
+
+class ProgressReporter:
+
+    def __init__(self, every=1, interval=1.0, total=None, silent=False, stream=None, callback=None):
+        """
+        Args:
+            every: Report at most once every this many generations. None means no generation limit.
+            interval: Report at most once every this many seconds. None means no time limit.
+            total: Total number of generations, used for the ETA. If None we use world.rules.stop_time.
+            silent: If true nothing is written, but progress is still measured and passed to the callback.
+            stream: Where to write reports. Defaults to sys.stdout.
+            callback: A function that receives the progress dictionary every time a report is made.
+        """
+
+        self.every = every
+        self.interval = interval
+        self.total = total
+        self.silent = silent
+        self.stream = stream
+        self.callback = callback
+
+        self.last = None  # The progress dictionary of the last report
+        self._start_time = None
+        self._start_generation = 0
+        self._last_time = None
+        self._last_generation = None
+
+    def reset(self):
+        """ Forget all timing information. Used when the reporter is reused for a new run. """
+
+        self.last = None
+        self._start_time = None
+        self._start_generation = 0
+        self._last_time = None
+        self._last_generation = None
+
+    def due(self, generation):
+        """
+        Returns true if a report should be made this generation. Cheap enough to call every generation.
+        The first call always returns true.
+        """
+
+        if self._last_generation is None:
+            return True
+        if generation == self._last_generation:
+            return False
+        if self.every is not None and generation - self._last_generation < self.every:
+            return False
+        if self.interval is not None and time.perf_counter() - self._last_time < self.interval:
+            return False
+
+        return True
+
+    def progress(self, generation, total=None):
+        """
+        Returns a dictionary describing how far along the simulation is.
+
+        Keys are generation, total, elapsed (seconds), generations_per_second and eta (seconds, None if unknown).
+        """
+
+        now = time.perf_counter()
+        if self._start_time is None:
+            self._start_time = now
+            self._start_generation = generation
+
+        if total is None:
+            total = self.total
+
+        elapsed = now - self._start_time
+        done = generation - self._start_generation
+        rate = done / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if total is not None and rate > 0:
+            eta = max(total - generation, 0) / rate
+
+        return {'generation': generation, 'total': total, 'elapsed': elapsed,
+                'generations_per_second': rate, 'eta': eta}
+
+    def report(self, world, lines=None, force=False):
+        """
+        Make a report for the world if one is due.
+
+        Args:
+            world: The world being simulated. world.age is the generation.
+            lines: Extra lines to write under the progress line. Can be a function returning the lines, so that
+                   expensive lines are only built when the report is actually made.
+            force: Report even if one is not due.
+
+        Returns:
+            The progress dictionary if a report was made, otherwise None.
+        """
+
+        generation = world.age
+        if not force and not self.due(generation):
+            return None
+
+        total = self.total if self.total is not None else getattr(world.rules, "stop_time", None)
+        info = self.progress(generation, total)
+        info['world'] = world.name
+
+        self.last = info
+        self._last_time = time.perf_counter()
+        self._last_generation = generation
+
+        if self.callback is not None:
+            self.callback(info)
+
+        if not self.silent:
+            if callable(lines):
+                lines = lines()
+            self._write(self.format(info), lines)
+
+        return info
+
+    def format(self, info):
+        """ The one line summary of a progress dictionary. """
+
+        s = f"{info['world']} gen {info['generation']}"
+        if info['total'] is not None:
+            s += f"/{info['total']}"
+        s += f" ({info['generations_per_second']:.1f} gen/s"
+        if info['eta'] is not None:
+            s += f", ETA {info['eta']:.0f}s"
+        s += ")"
+        return s
+
+    def _write(self, header, lines):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(header + "\n")
+        if lines:
+            for line in lines:
+                stream.write("    " + str(line) + "\n")
+        stream.flush()
+
+    def __repr__(self):
+        return f"ProgressReporter(every={self.every}, interval={self.interval}, silent={self.silent})"
+
+
+def silent_reporter():
+    """ A reporter that never writes anything. """
+    return ProgressReporter(silent=True)
+
@@ -1,10 +1,44 @@
 import logging
 
+import numpy as np
+
+from delta import DeltaBuffer
+from reporter import ProgressReporter
+from simrules import helpers
+
 
 class Rules:
 
-    def __init__(self):
-        pass
+    # Patch parameters that are the same for every patch unless changed on a patch, as
+    # {patch attribute name: rules attribute name}. They are stored once here instead of being copied onto each patch.
+    patch_defaults = {}
+
+    # Other attributes that every patch has, which are stored in __slots__ rather than a per patch dictionary.
+    patch_slots = ()
+
+    # Dispersal over the worldmap (see worldmap.DispersalTable). The edge attribute that holds the dispersal weight
+    # (edges without it have weight 1), and the weight of a propagule staying on its own patch when the map has no
+    # self loop there.
+    dispersal_weight = "weight"
+    dispersal_self_weight = 1.0
+
+    # How many threads World.update_patches splits the patches over. See update_block.
+    update_workers = 1
+
+    # If true World.update_patches always goes through update_block, even with a single worker.
+    block_updates = False
+
+    # 'python' or 'numba'. Rules with compiled kernels (see simrules/kernels.py) use them when this is 'numba'.
+    backend = 'python'
+
+    def __init__(self, progress=False):
+        """
+        Args:
+            progress: If true the reporter writes progress to the console. Otherwise it stays silent, so sweeps and
+                      tests print nothing, until a caller opts in with rules.reporter.silent = False.
+        """
+
+        self.reporter = ProgressReporter(silent=not progress)  # Console output goes through this. See reporter.py
 
     def set_initial_conditions(self, world):
         """
@@ -18,6 +52,100 @@ class Rules:
 
         logging.warning(f"set_initial_conditions() for world {world.name} does nothing.")
 
+    def allocate_state(self, world):
+        """
+        Allocates the state of every patch at once, before any patch objects are made.
+
+        Returns None (the default) or a dictionary of {attribute name: array}, where row i of each array is the
+        value of that attribute for the patch with index i. Those attributes of the patches then read and write the
+        arrays directly. The arrays must start at the values reset_patch would give.
+
+        Examples:
+            return {'populations': numpy.zeros((world.num_patches, self.num_strains))}
+        """
+
+        return None
+
+    def init_patch(self, patch):
+        """
+        Sets up a patch when its object is first made. By default this resets the patch.
+
+        Rules that allocate their state in bulk only need to set the attributes that are not part of the state here,
+        because the state already holds the reset values.
+        """
+
+        self.reset_patch(patch)
+
+    def before_update(self, world):
+        """
+        Called by World.update_patches before any patch is updated, for work done once for all patches, like
+        refreshing state derived from the populations. Does nothing by default.
+        """
+
+        pass
+
+    def patch_removed(self, world, index):
+        """
+        Called by World.remove_patch when the patch with this index is removed, before another patch takes over its
+        index (see patch_moved). Rules that keep state of their own by patch index drop it here. Does nothing by
+        default.
+        """
+
+        pass
+
+    def patch_moved(self, world, old, new):
+        """
+        Called by World.remove_patch when a patch moves from index old to the index new, which has just been freed by
+        patch_removed, so that rules that keep state of their own by patch index can move it along. The rows of
+        world.state have already moved. Does nothing by default.
+        """
+
+        pass
+
+    def step(self, world, n):
+        """
+        Runs up to n generations, the loop of main.simulate: stop_condition, census (and recording the history),
+        update, colonize and kill_patches, then the world ages. World.step calls this.
+
+        Rules that can run many generations in one call of a kernel override this, and only go through the hooks
+        one generation at a time when census or stop_condition has something to do.
+
+        Returns:
+            How many generations were run. Less than n only if the stop condition was reached.
+        """
+
+        for done in range(n):
+            if self.stop_condition(world):
+                return done
+            self.census(world)
+            world.history.record(world)
+            world.update_patches()
+            self.colonize(world)
+            self.kill_patches(world)
+            world.age += 1
+        return n
+
+    def update_block(self, world, rows, rng):
+        """
+        Updates the patches with the given indices. When update_workers > 1, World.update_patches splits the patches
+        into blocks and calls this from several threads at once, each with its own rows and its own random generator,
+        so it must only change those rows.
+
+        The default updates the patches one at a time. Rules that keep their state in arrays should override this
+        with numpy code that does all the rows at once. Numpy releases the GIL, so the blocks then really run in
+        parallel.
+
+        Args:
+            world: The world
+            rows: A numpy array of patch indices
+            rng: A numpy random generator for this block. Draws must come from it, not from random, so that a run
+                 is the same whatever order the threads happen to run in.
+        """
+
+        patches = world.patches
+        for i in rows:
+            patches[i].update()
+
     def reset_patch(self, patch):
         """
         Resets the patch to the default value. This function also runs to initialize patches.
@@ -98,4 +226,157 @@ class Rules:
         if world:
             print("    World Parameters:")
             for d in world.__dict__.items():
-                print("        " + d[0] + ':', d[1])
\ No newline at end of file
+                print("        " + d[0] + ':', d[1])
+
+
+class VectorRules(Rules):
+    """
+    Rules whose hooks work on the state arrays of all patches at once, instead of being called one patch at a time.
+
+    A model allocates its state in allocate_state (which it must do, since the hooks only see world.state) and
+    implements
+        update(world, rows, rng): moves the patches with indices rows forward a time step
+        reset(world, rows): puts the patches with indices rows back to their start values
+        disperse(world, deltas, rng): queues the colonization of this generation into a DeltaBuffer. Every change
+            then reads the state from before any of them, and they are applied together afterwards.
+        deaths(world, rng): a bool mask of the patches that die this generation. By default each patch dies with
+            probability prob_death.
+    The per patch Rules hooks are made from these, so World and main.simulate run the model unchanged, and always in
+    bulk. LegacyRulesAdapter gives the same interface for per patch Rules.
+    """
+
+    block_updates = True  # Always go through update_block, which is update
+    prob_death = 0.0
+    _rng = None  # The generator of this generation's patch_update calls, see before_update
+
+    def update(self, world, rows, rng):
+        logging.warning(f"update() for {world.name} does nothing.")
+
+    def reset(self, world, rows):
+        logging.warning(f"reset() for {world.name} does nothing.")
+
+    def disperse(self, world, deltas, rng):
+        """ No colonization by default. """
+
+        pass
+
+    def deaths(self, world, rng):
+        return rng.random(world.num_patches) < self.prob_death
+
+    # The Rules hooks, in terms of the ones above
+
+    def init_patch(self, patch):
+        """ The state already holds the reset values. """
+
+        pass
+
+    def before_update(self, world):
+        """ The patches updated one at a time this generation share a generator, made when the first one needs it. """
+
+        self._rng = None
+
+    def update_block(self, world, rows, rng):
+        self.update(world, rows, rng)
+
+    def patch_update(self, patch):
+        if self._rng is None:
+            self._rng = helpers.numpy_rng()
+        self.update(patch.world, np.array([patch.index]), self._rng)
+
+    def reset_patch(self, patch):
+        self.reset(patch.world, np.array([patch.index]))
+        patch.use_defaults()
+
+    def colonize(self, world):
+        deltas = DeltaBuffer(world)
+        self.disperse(world, deltas, helpers.numpy_rng())
+        deltas.apply()
+
+    def kill_patches(self, world):
+        dead = np.asarray(self.deaths(world, helpers.numpy_rng()), dtype=bool)
+        rows = np.flatnonzero(dead)
+        if len(rows) == 0:
+            return
+        self.reset(world, rows)
+        for patch in world.patches.materialized_patches():  # Patches that were given their own parameters
+            if dead[patch.index] and patch.has_overrides():
+                patch.use_defaults()
+
+
+class LegacyRulesAdapter(VectorRules):
+    """
+    Runs per patch Rules through the VectorRules interface, so code written against update, reset, disperse and
+    deaths also runs the older models. Each of them calls the per patch hooks of the wrapped rules (update goes
+    through their update_block, so rules with a bulk update keep it). Every other attribute, like worldmap or
+    stop_time, is read from the wrapped rules, so change settings there.
+
+        world = World(LegacyRulesAdapter(TwoStrain()))
+    """
+
+    # The class settings World reads from the rules
+    settings = ('patch_defaults', 'patch_slots', 'dispersal_weight', 'dispersal_self_weight', 'update_workers',
+                'block_updates', 'backend')
+
+    def __init__(self, rules):
+        self.rules = rules
+        for name in self.settings:
+            setattr(self, name, getattr(rules, name))
+
+    def __getattr__(self, name):
+        if name == 'rules':  # Not set yet, for example while unpickling
+            raise AttributeError(name)
+        return getattr(self.rules, name)
+
+    def update(self, world, rows, rng):
+        self.rules.update_block(world, rows, rng)
+
+    def reset(self, world, rows):
+        patches = world.patches
+        for i in rows:
+            self.rules.reset_patch(patches[i])
+
+    def disperse(self, world, deltas, rng):
+        """ Per patch rules change the patches right away, so the buffer stays empty. """
+
+        self.rules.colonize(world)
+
+    def deaths(self, world, rng):
+        """ Kills the patches with the wrapped rules' kill_patches, so nothing is left to kill. """
+
+        self.rules.kill_patches(world)
+        return np.zeros(world.num_patches, dtype=bool)
+
+    # The rest of the Rules hooks go straight to the wrapped rules
+
+    def set_initial_conditions(self, world):
+        self.rules.set_initial_conditions(world)
+
+    def allocate_state(self, world):
+        return self.rules.allocate_state(world)
+
+    def init_patch(self, patch):
+        self.rules.init_patch(patch)
+
+    def before_update(self, world):
+        self.rules.before_update(world)
+
+    def patch_removed(self, world, index):
+        self.rules.patch_removed(world, index)
+
+    def patch_moved(self, world, old, new):
+        self.rules.patch_moved(world, old, new)
+
+    def patch_update(self, patch):
+        self.rules.patch_update(patch)
+
+    def reset_patch(self, patch):
+        self.rules.reset_patch(patch)
+
+    def step(self, world, n):
+        return self.rules.step(world, n)
+
+    def census(self, world):
+        self.rules.census(world)
+
+    def stop_condition(self, world):
+        return self.rules.stop_condition(world)
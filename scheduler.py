@@ -0,0 +1,157 @@
+"""
+The output scheduler. Decides which observers of a run (saving totals, patch snapshots, safety checks, progress
+reports, checkpoints, ...) run at each census, and only sums up the populations when one of them needs the totals.
+
+Each observer has a cadence (every so many generations), a trigger (a function of the world that says when it is
+due), or both, in which case it runs when either says so. Rules call scheduler.run(world, aggregate) from census,
+where aggregate computes the totals. If no observer that is due needs the totals they are never computed, so a run
+that saves every 50 generations skips the summing in the other 49.
+
+    scheduler = Scheduler()
+    scheduler.observe('safety checks', lambda world, totals: check(world), every=100)
+    scheduler.observe('totals', save_totals, every=lambda: rules.data_save_step, totals=True)
+    scheduler.observe('progress', report, when=lambda world: reporter.due(world.age), totals=True)
+
+An observer that saves the totals can also skip the saves where nothing changed much with a ChangeFilter.
+"""
+
+import numpy as np
+
+
+class Observer:
+    """ Something that watches the run, with when it is due. See Scheduler.observe. """
+
+    __slots__ = ('name', 'action', 'every', 'when', 'totals', 'enabled')
+
+    def __init__(self, name, action, every=None, when=None, totals=False, enabled=True):
+        self.name = name
+        self.action = action
+        self.every = every
+        self.when = when
+        self.totals = totals
+        self.enabled = enabled
+
+    def cadence(self):
+        """ The number of generations between runs, or None if the observer has no cadence. """
+
+        every = self.every() if callable(self.every) else self.every
+        return every if every else None
+
+    def is_enabled(self):
+        return self.enabled() if callable(self.enabled) else self.enabled
+
+    def due(self, world):
+        if not self.is_enabled():
+            return False
+        every = self.cadence()
+        if every is not None and world.age % every == 0:
+            return True
+        return self.when is not None and bool(self.when(world))
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.observers = {}  # {name: Observer}, run in the order they were added
+
+    def observe(self, name, action, every=None, when=None, totals=False, enabled=True):
+        """
+        Adds an observer, or replaces the one with the same name.
+
+        Args:
+            name: A name for the observer, used to remove or replace it
+            action: Called as action(world, totals) when the observer is due. totals is what the aggregate passed
+                    to run returns, or None if no observer that is due needs it.
+            every: Run every this many generations (when world.age % every == 0). An int, or a function returning
+                   one so the cadence can follow a setting that changes. None for no cadence.
+            when: A function of the world, true when the observer is due. Checked every census.
+            totals: If true the observer needs the totals
+            enabled: A bool, or a function returning one. Disabled observers never run.
+
+        Returns:
+            The Observer
+        """
+
+        if every is None and when is None:
+            raise ValueError(f"The observer {name} needs a cadence (every) or a trigger (when).")
+        observer = Observer(name, action, every, when, totals, enabled)
+        self.observers.pop(name, None)
+        self.observers[name] = observer
+        return observer
+
+    def remove(self, name):
+        self.observers.pop(name, None)
+
+    def due(self, world):
+        """ The observers that are due this generation. """
+        return [observer for observer in self.observers.values() if observer.due(world)]
+
+    def run(self, world, aggregate):
+        """
+        Runs the observers that are due.
+
+        Args:
+            world: The world
+            aggregate: A function that computes the totals. Called at most once, and only if an observer that is due
+                       needs them.
+
+        Returns:
+            True if the totals were computed
+        """
+
+        due = self.due(world)
+        totals = aggregate() if any(observer.totals for observer in due) else None
+        for observer in due:
+            observer.action(world, totals)
+        return totals is not None
+
+    def generations_until_due(self, age):
+        """
+        How many generations from age until an observer with a cadence is next due, 0 if one is due at age. None if
+        no enabled observer has a cadence. Triggers are not predicted, so code that skips generations (like a fused
+        step) only checks them at the generations it stops at.
+        """
+
+        waits = [-age % every for every in (observer.cadence() for observer in self.observers.values()
+                                            if observer.is_enabled()) if every is not None]
+        return min(waits) if waits else None
+
+    def __contains__(self, name):
+        return name in self.observers
+
+    def __repr__(self):
+        return f"Scheduler({list(self.observers)})"
+
+
+class ChangeFilter:
+    """
+    Lets a record through only when the observed values changed by more than a tolerance since the last record that
+    went through, or when heartbeat generations have passed since then. The records that go through are then a
+    step function that is within the tolerance of every value that was filtered out: each value is close to the
+    last record before it.
+
+    A value x changed if |x - last| > atol + rtol * |last| for any entry.
+    """
+
+    def __init__(self, rtol=0.0, atol=0.0, heartbeat=None):
+        self.rtol = rtol
+        self.atol = atol
+        self.heartbeat = heartbeat
+        self.last = None  # The values of the last record that went through
+        self.last_generation = None
+
+    def changed(self, generation, values):
+        """ True if the record of these values should go through. Then they become the last record. """
+
+        values = np.asarray(values, dtype=float)
+        through = (self.last is None or values.shape != self.last.shape
+                   or (self.heartbeat is not None and generation - self.last_generation >= self.heartbeat)
+                   or bool((np.abs(values - self.last) > self.atol + self.rtol * np.abs(self.last)).any()))
+        if through:
+            self.last = values
+            self.last_generation = generation
+        return through
+
+    def reset(self):
+        self.last = None
+        self.last_generation = None
@@ -8,8 +8,10 @@ Updates and colonization happen in a random order each time.
 
 import random
 import logging
+import numpy as np
 from simrules import helpers
 from rules import Rules
+from delta import DeltaBuffer
 
 
 class NStrainsSimple(Rules):
@@ -23,6 +25,7 @@ class NStrainsSimple(Rules):
         self.resource_value = resource_value
         self.stop_time = stop_time  # Iterations to run
         self.dt = dt
+        self.synchronous_colonization = False  # If true every move is made from the populations at the start of the step
 
     def set_initial_conditions(self, world):
         """
@@ -31,6 +34,17 @@ class NStrainsSimple(Rules):
         """
         world.patches[0].populations = [1] * self.num_strains
 
+    def allocate_state(self, world):
+        """ Every patch starts empty with a resource level of resource_value. """
+
+        n = world.num_patches
+        return {'populations': np.zeros((n, self.num_strains)),
+                'resource_level': np.full(n, self.resource_value, dtype=float)}
+
+    def init_patch(self, patch):
+        """ Nothing to do, the state was allocated already reset. """
+        pass
+
     def reset_patch(self, patch):
         """
         Each patch starts with 0 of all individuals, unless changed by initial_conditions
@@ -50,48 +64,55 @@ class NStrainsSimple(Rules):
     def colonize(self, world):
         """
         A random individual is chosen from each patch and sent to a random neighbor patch.
+
+        If synchronous_colonization is true the individuals are chosen from the populations at the start of the step
+        and all moves are added at once at the end, so the order the patches are visited in does not matter.
         """
 
+        deltas = DeltaBuffer(world) if self.synchronous_colonization else None
+
         # Make a random order for each colonization event.
         order = helpers.random_index_order(world.patches)
 
-        print("\nCOLONIZE STEP")
         for i in order:
 
             patch = world.patches[i]
 
             if not helpers.has_positive(patch.populations):
-                s = f"Patch {patch.id} is empty, cannot colonize."
-                logging.info(s)
-                print(s)
-            elif patch.random_neighbor() is None:
-                print(f"Patch {patch.id} has no neighbors, so cannot colonize.")
+                logging.debug("Patch %s is empty, cannot colonize.", patch.id)
+                continue
+
+            target_patch = patch.random_neighbor()
+            if target_patch is None:
+                logging.debug("Patch %s has no neighbors, so cannot colonize.", patch.id)
             else:
                 # Randomly select from patch's population, with chance proportional to population size
                 # Remember, each population is a list
                 #       [population size strain 0, population of strain 1, ... population of strain n]
                 strain_id = random.choices(range(0, len(patch.populations)), weights=patch.populations)[0]
-                target_patch = patch.random_neighbor()
 
-                patch.populations[strain_id] -= 1  # Take the individual from the current patch...
-                target_patch.populations[strain_id] += 1  # ... and add it to those of the new patch
+                if deltas is not None:
+                    deltas.add('populations', patch.index, -1, strain_id)
+                    deltas.add('populations', target_patch.index, 1, strain_id)
+                else:
+                    patch.populations[strain_id] -= 1  # Take the individual from the current patch...
+                    target_patch.populations[strain_id] += 1  # ... and add it to those of the new patch
+
+                logging.debug("1 yeast of strain %s moved from %s to %s.", strain_id, patch.id, target_patch.id)
 
-                print(f"1 yeast of strain {strain_id} moved from {patch.id} to {target_patch.id}.")
+        if deltas is not None:
+            deltas.apply()
 
     def kill_patches(self, world):
         """ Resets population on a patch to 0 with probability prob_death """
 
-        print("\nKILL PATCHES STEP")
-
         for patch in world.patches:
             if random.random() < self.prob_death:
                 self.reset_patch(patch)
-                print(f"Patch {patch.id} killed.")
+                logging.debug("Patch %s killed.", patch.id)
 
     def census(self, world):
-        print(f"\n=== Time {world.age} ===============\n")
-        for patch in world.patches:
-            print(f"Patch {patch.id}: {str(patch.populations)}.")
+        self.reporter.report(world, lambda: [f"Patch {patch.id}: {str(patch.populations)}." for patch in world.patches])
 
     def stop_condition(self, world):
         return world.age > self.stop_time
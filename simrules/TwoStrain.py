@@ -4,7 +4,7 @@ from main import run
 import networkx as nx
 from world import World
 import logging
-from simrules import helpers
+from simrules import helpers, kernels
 from rules import Rules
 import general
 
@@ -25,12 +25,18 @@ class TwoStrain(Rules):
     Where k → competitor, c → colonizer, v → vegatative, and s → sporulated.
     """
 
+    # Patch specific parameters. Each patch uses these values from the rules unless it is given its own.
+    patch_defaults = {name: name for name in ['c', 'alpha', 'activation', 'mu_v', 'mu_s', 'mu_R', 'gamma',
+                                              'kv_fly_survival', 'ks_fly_survival', 'rv_fly_survival',
+                                              'rs_fly_survival', 'sk', 'sr']}
+    patch_slots = ('resources',)
+
     def __init__(self):
 
         super().__init__()
 
         # Default patch specific parameters
-        # (These are passed into the patch, which always uses it's own, meaning we can change these per patch.)
+        # (Patches read these from the rules unless given their own, meaning we can change these per patch.)
         self.c = 0.2  # Consumption rate for init_resources_per_patch.
         self.alpha = 0.2  # Conversion factor for init_resources_per_patch into cells
         self.mu_v = 0.1  # Background death rate for vegetative cells
@@ -90,47 +96,42 @@ class TwoStrain(Rules):
 
         patch.populations = {'rv': 0, 'kv': 0, 'rs': 0, 'ks': 0}  # Reset populations to 0
 
-        # Reset patch parameters
-        patch.c = self.c
-        patch.alpha = self.alpha
-        patch.activation = self.activation
-        patch.mu_v = self.mu_v
-        patch.mu_s = self.mu_s
-        patch.mu_R = self.mu_R
-        patch.gamma = self.gamma
-        patch.kv_fly_survival = self.kv_fly_survival
-        patch.ks_fly_survival = self.ks_fly_survival
-        patch.rv_fly_survival = self.rv_fly_survival
-        patch.rs_fly_survival = self.rs_fly_survival
         patch.resources = self.resources
-        patch.sk = self.sk
-        patch.sr = self.sr
 
-        print(f"Patch {patch.id} has been reset.")
+        # Reset patch parameters
+        patch.use_defaults()
+
+        logging.debug("Patch %s has been reset.", patch.id)
 
     def patch_update(self, patch):
         """
         Each individual has fitness of resource_level and reproduces by that amount.
         """
 
+        pops = patch.populations
+        rv, rs, kv, ks = pops['rv'], pops['rs'], pops['kv'], pops['ks']
+        resources = patch.resources
+        c, alpha, activation, sr, sk = patch.c, patch.alpha, patch.activation, patch.sr, patch.sk
+        mu_v, mu_s = patch.mu_v, patch.mu_s
+
+        if kernels.use_numba(self.backend):
+            pops['rv'], pops['rs'], pops['kv'], pops['ks'], patch.resources = kernels.two_strain_step(
+                rv, rs, kv, ks, resources, c, alpha, activation, sr, sk, mu_v, mu_s, patch.mu_R, patch.gamma, self.dt)
+            return
+
         # Calculate the changes in the populations and init_resources_per_patch
-        change_rv = patch.alpha * patch.c * patch.resources * patch.populations['rv'] * (1 - patch.sr) - patch.mu_v * \
-                    patch.populations['rv'] + patch.activation * patch.resources * patch.populations['rs']
-        change_rs = patch.alpha * patch.c * patch.resources * patch.populations['rv'] * patch.sr - patch.mu_s * \
-                    patch.populations['rs'] - patch.activation * patch.resources * patch.populations['rs']
-        change_kv = patch.alpha * patch.c * patch.resources * patch.populations['kv'] * (1 - patch.sk) - patch.mu_v * \
-                    patch.populations['kv'] + patch.activation * patch.resources * patch.populations['ks']
-        change_ks = patch.alpha * patch.c * patch.resources * patch.populations['kv'] * patch.sk - patch.mu_s * \
-                    patch.populations['ks'] - patch.activation * patch.resources * patch.populations['ks']
-        change_resources = - patch.c * patch.resources * patch.populations['kv'] - patch.c * patch.resources * \
-                           patch.populations['rv'] + patch.gamma - patch.mu_R * patch.resources
+        change_rv = alpha * c * resources * rv * (1 - sr) - mu_v * rv + activation * resources * rs
+        change_rs = alpha * c * resources * rv * sr - mu_s * rs - activation * resources * rs
+        change_kv = alpha * c * resources * kv * (1 - sk) - mu_v * kv + activation * resources * ks
+        change_ks = alpha * c * resources * kv * sk - mu_s * ks - activation * resources * ks
+        change_resources = - c * resources * kv - c * resources * rv + patch.gamma - patch.mu_R * resources
 
         # Change the current population values.
-        patch.populations['rv'] += change_rv * self.dt
-        patch.populations['rs'] += change_rs * self.dt
-        patch.populations['kv'] += change_kv * self.dt
-        patch.populations['ks'] += change_ks * self.dt
-        patch.resources += change_resources * self.dt
+        pops['rv'] = rv + change_rv * self.dt
+        pops['rs'] = rs + change_rs * self.dt
+        pops['kv'] = kv + change_kv * self.dt
+        pops['ks'] = ks + change_ks * self.dt
+        patch.resources = resources + change_resources * self.dt
 
         # make sure none become negative
 
@@ -215,26 +216,27 @@ class TwoStrain(Rules):
 
     def census(self, world):
 
-        print("\n")
-        print("=" * 30)
+        if not self.reporter.due(world.age):
+            return
 
         sum_dicts = helpers.merge_dicts([patch.populations for patch in world.patches])  # Sum populations from patch
         total_resources = 0
         for patch in world.patches:  # Sum init_resources_per_patch from each patch
             total_resources += patch.resources
 
-        print("\nIndividual Patch Info")
-        for patch in world.patches:
-            print(f"Patch {patch.id}")
-            print(f"    Population: {str(patch.populations)}")
-            print(f"    Resources: {patch.resources}")
+        def lines():
+            l = [f"GEN {world.age} TOTALS: {str(sum_dicts)}. Resources: {total_resources}", "Individual Patch Info"]
+            for patch in world.patches:
+                l.append(f"Patch {patch.id}  Population: {str(patch.populations)}  Resources: {patch.resources}")
+            return l
 
-            # Append data to patch save files
-            # self.files[patch.id].write(str(patch.populations['rv']) + ',' + str(patch.populations['rs']) + ',' +
-            #                            str(patch.populations['kv']) + ',' + str(patch.populations['ks']) + ',' +
-            #                            str(patch.resources) + '\n')
+        self.reporter.report(world, lines)
 
-        print(f"\nGEN {world.age} TOTALS: {str(sum_dicts)}.")
+        # Append data to patch save files
+        # for patch in world.patches:
+        #     self.files[patch.id].write(str(patch.populations['rv']) + ',' + str(patch.populations['rs']) + ',' +
+        #                                str(patch.populations['kv']) + ',' + str(patch.populations['ks']) + ',' +
+        #                                str(patch.resources) + '\n')
 
         # Append data to gen_totals file
         # Saving is currently broken Totals file removed to not break test
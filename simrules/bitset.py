@@ -0,0 +1,92 @@
+"""
+Packed bitsets, for example which strains are present in each patch.
+
+A set of num_bits bits is stored as num_words(num_bits) unsigned 64 bit words, and many sets as an array with one row
+of words per set. Bit i is bit i % 64 of word i // 64, so with up to 64 strains a set is a single integer and
+testing if it is empty is a single comparison.
+"""
+
+import numpy as np
+
+
+def num_words(num_bits):
+    """ The number of 64 bit words needed for num_bits bits. """
+    return max(1, -(-num_bits // 64))
+
+
+def pack(bits):
+    """
+    Packs bools into bitsets.
+
+    Args:
+        bits: A bool array of shape (n, num_bits), or (num_bits,) for a single set
+
+    Returns:
+        A uint64 array of shape (n, num_words), or (num_words,)
+    """
+
+    bits = np.asarray(bits, dtype=bool)
+    single = bits.ndim == 1
+    bits = np.atleast_2d(bits)
+
+    padded = np.zeros((len(bits), 64 * num_words(bits.shape[1])), dtype=bool)
+    padded[:, :bits.shape[1]] = bits
+    # Little endian bit and byte order, so bit i of the bytes is bit i of the words
+    masks = np.packbits(padded, axis=1, bitorder='little').view('<u8').astype(np.uint64)
+    return masks[0] if single else masks
+
+
+def unpack(masks, num_bits):
+    """ The opposite of pack. """
+
+    masks = np.asarray(masks, dtype=np.uint64)
+    single = masks.ndim == 1
+    masks = np.atleast_2d(masks)
+
+    bits = np.unpackbits(masks.astype('<u8').view(np.uint8), axis=1, bitorder='little')[:, :num_bits].astype(bool)
+    return bits[0] if single else bits
+
+
+def set_bits(masks, rows, bits):
+    """ Sets bit bits[j] of set rows[j] in masks, in place. Rows can repeat. """
+
+    bits = np.asarray(bits, dtype=np.int64)
+    np.bitwise_or.at(masks, (np.asarray(rows, dtype=np.intp), bits // 64),
+                     np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+
+
+def popcount(masks):
+    """ The number of set bits in each set. """
+
+    masks = np.asarray(masks, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):  # numpy 2
+        return np.bitwise_count(masks).sum(axis=-1)
+    return np.unpackbits(masks.astype('<u8').view(np.uint8), axis=-1).sum(axis=-1)
+
+
+def lowest_bit(masks):
+    """
+    The index of the lowest set bit of each set, or -1 if the set is empty.
+
+    A single set (one row of words) gives a python int, for the patch by patch code.
+    """
+
+    masks = np.asarray(masks, dtype=np.uint64)
+    if masks.ndim == 1:
+        for k, word in enumerate(masks.tolist()):
+            if word:
+                return 64 * k + (word & -word).bit_length() - 1
+        return -1
+
+    nonzero = masks != 0
+    first = nonzero.argmax(axis=1)
+    word = masks[np.arange(len(masks)), first]
+    lowest = word & (~word + np.uint64(1))  # Only the lowest set bit is left
+    with np.errstate(divide='ignore'):
+        bit = np.log2(lowest.astype(float))  # Exact, since lowest is a power of two
+    return np.where(nonzero.any(axis=1), 64 * first + np.nan_to_num(bit, neginf=0).astype(np.int64), -1)
+
+
+def bit_counts(masks, num_bits):
+    """ How many of the sets have each bit set. """
+    return unpack(masks, num_bits).sum(axis=0)
@@ -0,0 +1,118 @@
+"""
+A cache of computed results shared by every rules object in the process.
+
+Parameter sweeps (see AM_programs/RunSimulations.py) make thousands of rules objects with the same parameters, and
+each would otherwise work out the same equilibria again. Results are stored under a key that holds everything they
+depend on, starting with the name of what was computed, for example ('single strain', spore chances, c, ...).
+
+The cache keeps at most maxsize results in memory and forgets the least recently used one when it is full. If it
+is given a folder it also saves every result there, so later runs (and other processes) can load them instead.
+
+    from simrules import cache
+    cache.shared.path = "save_data/cache"  # Optional, keep results between runs
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+class SharedCache:
+
+    def __init__(self, maxsize=1024, path=None):
+        """
+        Args:
+            maxsize: How many results to keep in memory
+            path: A folder to also save results in, or None to only keep them in memory
+        """
+
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+        self._results = OrderedDict()  # {key: result}, the most recently used last
+        self._lock = threading.Lock()  # World.update_patches can update blocks of patches from several threads
+
+    def get(self, key, make):
+        """
+        The result stored under key. If there is none it is loaded from the folder, or made with make() and stored.
+
+        Args:
+            key: A hashable key whose repr is the same in every process (tuples of strings and numbers)
+            make: A function with no arguments that computes the result
+        """
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+
+        result = self._load(key)
+        if result is None:
+            result = make()
+            self._save(key, result)
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+        return result
+
+    def clear(self, disk=False):
+        """ Forget everything in memory, and everything in the folder too if disk is true. """
+
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+        if disk and self.path is not None and os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(self.path, name))
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + ".pkl")
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(self._file(key), 'rb') as file:
+                stored_key, result = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:  # A broken file is just a miss
+            logging.warning(f"Could not read the cached result for {key}: {e}")
+            return None
+        return result if stored_key == key else None
+
+    def _save(self, key, result):
+        if self.path is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        file_name = self._file(key)
+        temp_name = f"{file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_name, 'wb') as file:
+            pickle.dump((key, result), file)
+        os.replace(temp_name, file_name)  # So other processes never read half a file
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return f"SharedCache(maxsize={self.maxsize}, path={self.path!r}, size={len(self)})"
+
+
+# The cache used by all rules in this process
+shared = SharedCache()
@@ -0,0 +1,205 @@
+"""
+Equilibria of the NStrain model, for its 'eq' update mode.
+
+When a single strain wins a patch, the patch goes to the equilibrium of that strain alone (see simrules/ode.py for
+the model). These equilibria only depend on the parameters in EQ_PARAMS and on the spore chances, so a table of them
+is made once for every distinct set of parameters and shared by all patches with those parameters. On a landscape
+where every patch uses the defaults there is only one table, and patches with their own parameters get their own.
+
+The single strain tables assume the best competitor excludes all the others. coexistence_equilibrium instead finds the
+stable equilibrium for any set of present strains. Each strain alone has a break even resource level R*, where
+its growth (including germinating spores) just balances its deaths. The strains with the lowest R* draw the
+resources down to R* and the others die out. With germination this is not always the strain with the lowest spore
+chance. These equilibria are kept for each presence mask, a number whose bit i is set if strain i is present.
+
+The tables are also kept in simrules/cache.py, so new rules objects with the same parameters reuse them.
+"""
+
+import numpy as np
+
+from simrules import cache
+
+# The patch parameters the equilibria depend on, besides spore_chance
+EQ_PARAMS = ('c', 'alpha', 'gamma', 'mu_v', 'mu_s', 'mu_R')
+
+
+class EqTable:
+    """
+    The equilibrium of each strain winning alone, as arrays with one entry per strain, and of the empty patch.
+    """
+
+    __slots__ = ('veg', 'spore', 'resources', 'empty_resources')
+
+    def __init__(self, veg, spore, resources, empty_resources):
+        self.veg = veg
+        self.spore = spore
+        self.resources = resources
+        self.empty_resources = empty_resources
+
+    def as_lookup_table(self):
+        """ The table in the format of NStrain.lookup_table, {winner: {"Veg", "Spore", "Resources"}, "Empty": ...} """
+
+        table = {"Empty": {"Resources": self.empty_resources, "Veg": 0, "Spore": 0}}
+        for i in range(len(self.veg)):
+            table[i] = {"Veg": float(self.veg[i]), "Spore": float(self.spore[i]),
+                        "Resources": float(self.resources[i])}
+        return table
+
+
+def single_strain_equilibria(spore_chance, c, alpha, gamma, mu_v, mu_s, mu_R):
+    """
+    The equilibrium of each strain when it is alone in a patch, for all strains at once.
+
+    Args:
+        spore_chance: The spore chance of each strain
+        The rest are the NStrain patch parameters.
+
+    Returns:
+        An EqTable
+    """
+
+    s = np.asarray(spore_chance, dtype=float)
+    growth = c * alpha * gamma
+
+    # If the spore chance is 1 then the equilibrium divides by 0, so make the denominator real small instead
+    s_denominator = np.where(s == 1, .999999, s) - 1
+
+    veg = (growth * (1 - s) - mu_R * mu_v) / (c * mu_v)
+    spore = s * (growth * (s - 1) + mu_R * mu_v) / (s_denominator * c * mu_s)
+    resources = -mu_v / (s_denominator * alpha * c)
+
+    return EqTable(veg, spore, resources, gamma / mu_R)
+
+
+def break_even_resources(spore_chance, germ_chance, c, alpha, mu_v, mu_s):
+    """
+    The resource level R* at which each strain alone neither grows nor shrinks, for all strains at once. It is the
+    positive root of
+
+        alpha c R (1 - spore_chance) - mu_v + alpha c germ_chance spore_chance R^2 / (mu_s + germ_chance R) = 0
+
+    and is inf for a strain that can never grow (a spore chance of 1 without germination).
+    """
+
+    s = np.asarray(spore_chance, dtype=float)
+    g = np.broadcast_to(np.asarray(germ_chance, dtype=float), s.shape)
+    ac = alpha * c
+
+    # Multiplied by (mu_s + g R) it is the quadratic A R^2 + B R + C with C < 0, so it has one positive root
+    A = ac * g
+    B = ac * (1 - s) * mu_s - mu_v * g
+    C = -mu_v * mu_s
+    root = np.sqrt(B * B - 4 * A * C)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Two forms of the same root, so we never subtract two nearly equal numbers
+        r_star = np.where(B > 0, -2 * C / (B + root), (root - B) / (2 * A))
+    return np.where(r_star > 0, r_star, np.inf)
+
+
+def coexistence_equilibrium(present, spore_chance, germ_chance, c, alpha, gamma, mu_v, mu_s, mu_R):
+    """
+    The stable equilibrium of a patch with the present strains. The strains with the lowest R* survive. If several
+    strains tie, any split of the vegetative cells between them is an equilibrium, and we split them equally.
+    If no present strain can live on the resources of an empty patch the patch ends up empty.
+
+    Args:
+        present: A bool for each strain
+        The rest are the NStrain patch parameters.
+
+    Returns:
+        (veg, spore, resources) where veg and spore have an entry per strain
+    """
+
+    s = np.asarray(spore_chance, dtype=float)
+    g = np.broadcast_to(np.asarray(germ_chance, dtype=float), s.shape)
+    veg = np.zeros(len(s))
+    spore = np.zeros(len(s))
+
+    r_star = np.where(present, break_even_resources(s, g, c, alpha, mu_v, mu_s), np.inf)
+    best = r_star.min()
+    if not best < gamma / mu_R:
+        return veg, spore, gamma / mu_R
+
+    winners = r_star <= best * (1 + 1e-12)
+    veg[winners] = (gamma - mu_R * best) / (c * best) / winners.sum()  # From dR/dt = 0
+    spore[winners] = alpha * c * best * s[winners] * veg[winners] / (mu_s + g[winners] * best)  # From ds/dt = 0
+    return veg, spore, best
+
+
+def presence_mask(present):
+    """ The presence mask of a bool for each strain, with bit i set if strain i is present. """
+    return sum(1 << int(i) for i in np.flatnonzero(present))
+
+
+def mask_strains(mask, num_strains):
+    """ The opposite of presence_mask. """
+    return np.array([(mask >> i) & 1 for i in range(num_strains)], dtype=bool)
+
+
+class EquilibriumTables:
+    """
+    The equilibrium tables of a rules object, one for each distinct set of parameters.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._tables = {}  # {key: EqTable}
+        self._coexistence = {}  # {(key, presence mask): (veg, spore, resources)}
+
+    @staticmethod
+    def key(p):
+        """ The parameters of p (a patch or the rules) that the equilibria depend on. """
+        return (tuple(float(x) for x in p.spore_chance),) + tuple(float(getattr(p, name)) for name in EQ_PARAMS)
+
+    def get(self, p):
+        """ The table for the parameters of p, a patch or the rules. Made the first time it is needed. """
+
+        key = self.key(p)
+        table = self._tables.get(key)
+        if table is None:
+            table = cache.shared.get(('single strain',) + key, lambda: single_strain_equilibria(*key))
+            self._tables[key] = table
+        return table
+
+    def default(self):
+        """ The table for the default parameters on the rules. """
+        return self.get(self.rules)
+
+    def for_patch(self, patch):
+        """
+        The table for the patch. Patches that use the default parameters share the default table, unless
+        rules.all_patches_same is true in which case every patch does.
+        """
+
+        if self.rules.all_patches_same or not patch.has_overrides():
+            return self.default()
+        return self.get(patch)
+
+    def coexistence(self, p, mask):
+        """
+        The equilibrium (see coexistence_equilibrium) for the parameters of p and the strains in the presence
+        mask. Solved the first time each mask is needed.
+        """
+
+        key = (self.key(p) + (tuple(float(x) for x in p.germ_chance),), mask)
+        result = self._coexistence.get(key)
+        if result is None:
+            params = key[0]
+            result = cache.shared.get(('coexistence', mask) + params, lambda: coexistence_equilibrium(
+                mask_strains(mask, len(params[0])), params[0], params[-1], *params[1:-1]))
+            self._coexistence[key] = result
+        return result
+
+    def coexistence_for_patch(self, patch, mask):
+        """ Same as coexistence, but shares the defaults like for_patch. """
+
+        if self.rules.all_patches_same or not patch.has_overrides():
+            return self.coexistence(self.rules, mask)
+        return self.coexistence(patch, mask)
+
+    def clear(self):
+        self._tables.clear()
+        self._coexistence.clear()
+
+    def __len__(self):
+        return len(self._tables)
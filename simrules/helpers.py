@@ -5,6 +5,8 @@ import os
 import logging
 import random
 
+import numpy as np
+
 
 def typeIIresponse(resource_density, attack_rate, holding_time, max_=float('inf'), min_=0):
     """
@@ -72,6 +74,15 @@ def random_index_order(list_):
     return random_order
 
 
+def numpy_rng():
+    """
+    Returns a numpy random generator seeded from python's random module, so that seeding random still makes a run
+    that uses numpy draws reproducible.
+    """
+
+    return np.random.default_rng(random.getrandbits(64))
+
+
 def has_positive(list_):
     """ Checks if a list_ has a postive value. """
     try:
@@ -0,0 +1,332 @@
+"""
+Compiled kernels for the inner loops of the rules.
+
+These are the scalar loops that numpy can't express well: the per strain population dynamics, picking the winning
+strain, and flies that each change the populations the next fly sees. With numba installed they are compiled to
+machine code (and release the GIL, so World.update_patches can run them on several threads). numba is optional.
+
+Rules pick their backend with rules.backend, which is 'python' (the default) or 'numba'. Rules only call these
+kernels when kernels.use_numba(rules.backend) is true, and otherwise keep their own Python/numpy code. Without numba
+the kernels are still plain Python functions that give the same results, which is how they are tested.
+"""
+
+import logging
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_NUMBA = numba is not None
+
+_warned = False
+
+
+def jit(func):
+    """ Compiles func with numba if it is installed. Otherwise returns func unchanged. """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+def use_numba(backend):
+    """
+    True if backend asks for the compiled kernels and numba is installed. If numba is asked for but missing we warn
+    once and the rules fall back to their Python code.
+    """
+
+    global _warned
+
+    if backend == 'python':
+        return False
+    if backend != 'numba':
+        raise ValueError(f"{backend} is not a valid backend. (Choose 'python' or 'numba')")
+    if not HAVE_NUMBA and not _warned:
+        logging.warning("The numba backend was chosen but numba is not installed. Using the python backend.")
+        _warned = True
+    return HAVE_NUMBA
+
+
+@jit
+def nstrain_discrete(v, s, resources, c, alpha, gamma, mu_v, mu_s, mu_R, spore_chance, germ_chance, dt,
+                     iterations):
+    """
+    The discrete update of NStrain for a block of patches. Changes the arrays in place.
+
+    Args:
+        v, s: Veg and spore populations, one row per patch and one column per strain
+        resources: The resources of each patch
+        The rest are the NStrain parameters. spore_chance and germ_chance are arrays with an entry per strain.
+    """
+
+    num_strains = v.shape[1]
+    for row in range(v.shape[0]):
+        r = resources[row]
+        for _ in range(iterations):
+            r_change = gamma - mu_R * r
+            for i in range(num_strains):
+                vi = v[row, i]
+                si = s[row, i]
+                born = alpha * c * r * vi
+                germinated = germ_chance[i] * r * si
+                v[row, i] = vi + (born * (1 - spore_chance[i]) - mu_v * vi + germinated) * dt
+                s[row, i] = si + (born * spore_chance[i] - mu_s * si - germinated) * dt
+                r_change -= c * r * vi
+            r += r_change * dt
+
+            for i in range(num_strains):
+                if v[row, i] < 0:
+                    v[row, i] = 0
+                if s[row, i] < 0:
+                    s[row, i] = 0
+            if r < 0:
+                r = 0
+        resources[row] = r
+
+
+@jit
+def find_winners(v, s, spore_chance, germinate_spores, out):
+    """
+    Same as helpers.find_winner for one patch, but writes the winning strains into out.
+
+    Returns:
+        The number of winners. out[:count] are the winners.
+    """
+
+    best = 1.0
+    count = 0
+    for i in range(v.shape[0]):
+        pop = v[i] + s[i] if germinate_spores else v[i]
+        if pop > 0:
+            if spore_chance[i] < best:
+                best = spore_chance[i]
+                count = 0
+                out[count] = i
+                count += 1
+            elif spore_chance[i] == best:
+                out[count] = i
+                count += 1
+    return count
+
+
+@jit
+def eq_winners(v, spore_chance, u):
+    """
+    The winner of every patch in a block, for the eq update of NStrain. Ties are broken with the uniform random
+    numbers u (one per patch).
+
+    Returns:
+        An array with the winning strain of each patch, or -1 if the patch is empty.
+    """
+
+    winners = np.full(v.shape[0], -1, dtype=np.int64)
+    for row in range(v.shape[0]):
+        best = np.inf
+        ties = 0
+        for i in range(v.shape[1]):
+            if v[row, i] > 0:
+                if spore_chance[i] < best:
+                    best = spore_chance[i]
+                    ties = 1
+                elif spore_chance[i] == best:
+                    ties += 1
+        if ties == 0:
+            continue
+
+        pick = min(int(u[row] * ties), ties - 1)
+        for i in range(v.shape[1]):
+            if v[row, i] > 0 and spore_chance[i] == best:
+                if pick == 0:
+                    winners[row] = i
+                    break
+                pick -= 1
+    return winners
+
+
+@jit
+def two_strain_step(rv, rs, kv, ks, resources, c, alpha, activation, sr, sk, mu_v, mu_s, mu_R, gamma, dt):
+    """
+    The patch update of TwoStrain.
+
+    Returns:
+        The new (rv, rs, kv, ks, resources), none of them negative.
+    """
+
+    change_rv = alpha * c * resources * rv * (1 - sr) - mu_v * rv + activation * resources * rs
+    change_rs = alpha * c * resources * rv * sr - mu_s * rs - activation * resources * rs
+    change_kv = alpha * c * resources * kv * (1 - sk) - mu_v * kv + activation * resources * ks
+    change_ks = alpha * c * resources * kv * sk - mu_s * ks - activation * resources * ks
+    change_resources = - c * resources * kv - c * resources * rv + gamma - mu_R * resources
+
+    return (max(rv + change_rv * dt, 0.0), max(rs + change_rs * dt, 0.0), max(kv + change_kv * dt, 0.0),
+            max(ks + change_ks * dt, 0.0), max(resources + change_resources * dt, 0.0))
+
+
+@jit
+def seed(value):
+    """ Seeds the random generator numba uses inside compiled kernels (it is separate from numpy's). """
+    np.random.seed(value)
+
+
+@jit
+def fly_colonize(v, s, sources, drops, stomach_size, type_2, attack_rate, handling_time, yeast_size,
+                 fly_v_survival, fly_s_survival, germinate_on_drop):
+    """
+    The fly colonization of NStrain. Each fly eats from its source patch and drops the survivors on its drop patch,
+    changing the populations the next fly sees, so this has to be a loop. Changes v and s in place.
+
+    Args:
+        v, s: Veg and spore populations of every patch
+        sources: The patch each fly lands on
+        drops: The patch each fly drops its survivors on, or -1 if it has nowhere to go
+        stomach_size: How many cells each fly eats, unless type_2
+        type_2: If true the number eaten is a type II functional response to the population of the patch
+        The rest are the NStrain parameters.
+    """
+
+    num_strains = v.shape[1]
+    weights = np.empty(2 * num_strains)
+    v_survivors = np.empty(num_strains)
+    s_survivors = np.empty(num_strains)
+
+    for f in range(sources.shape[0]):
+        patch = sources[f]
+
+        if type_2:
+            density = 0.0
+            for i in range(num_strains):
+                density += v[patch, i] + s[patch, i]
+            num_eaten = int(max(0.0, (attack_rate * density) / (1 + attack_rate * handling_time * density)))
+        else:
+            num_eaten = stomach_size
+        if num_eaten <= 0:
+            continue
+
+        total = 0.0
+        for i in range(num_strains):
+            weights[i] = max(v[patch, i], 0.0)
+            weights[num_strains + i] = max(s[patch, i], 0.0)
+        for j in range(2 * num_strains):
+            total += weights[j]
+        if total <= 0:  # The patch is empty, so the fly starves
+            continue
+
+        v_survivors[:] = 0
+        s_survivors[:] = 0
+        for _ in range(num_eaten):
+            x = np.random.random() * total
+            j = 0
+            while j < 2 * num_strains - 1 and x >= weights[j]:
+                x -= weights[j]
+                j += 1
+            while weights[j] == 0:  # Rounding can run past the last cell type that is present
+                j -= 1
+
+            if j < num_strains:
+                v[patch, j] -= yeast_size
+                if np.random.random() < fly_v_survival[j]:
+                    v_survivors[j] += yeast_size
+            else:
+                s[patch, j - num_strains] -= yeast_size
+                if np.random.random() < fly_s_survival[j - num_strains]:
+                    s_survivors[j - num_strains] += yeast_size
+
+        drop = drops[f]
+        if drop < 0:
+            continue
+        for i in range(num_strains):
+            v[drop, i] += v_survivors[i]
+            # Same as the python version, see the todo in NStrain.colonize_fly_mode
+            if germinate_on_drop:
+                v[drop, i] = s[drop, i] + s_survivors[i]
+            else:
+                s[drop, i] += s_survivors[i]
+
+
+@jit
+def nstrain_generations(v, s, resources, generations, eq, table_veg, table_spore, table_resources, empty_resources,
+                        c, alpha, gamma, mu_v, mu_s, mu_R, spore_chance, germ_chance, dt, iterations,
+                        fly_v_survival, fly_s_survival, colonization_prob_slope, yeast_size, germinate_on_drop,
+                        prob_death, init_resources):
+    """
+    Whole generations of NStrain (see NStrain.step): the discrete or eq update of every patch, the global pool
+    colonization of the 'mean field' mode and patch deaths. Changes the arrays in place.
+
+    Args:
+        v, s, resources: The state of every patch
+        generations: How many generations to run
+        eq: If true the eq update with the table_ arrays, else the discrete update
+        The rest are the NStrain parameters.
+
+    Returns:
+        The number of generations run. Less than generations if the population died out, since the simulation stops.
+    """
+
+    n, num_strains = v.shape
+    weights = np.empty(2 * num_strains)
+
+    for generation in range(generations):
+        total = 0.0
+        for row in range(n):
+            for i in range(num_strains):
+                total += v[row, i] + s[row, i]
+        if total == 0:
+            return generation
+
+        # Update
+        if eq:
+            winners = eq_winners(v, spore_chance, np.random.random(n))
+            for row in range(n):
+                winner = winners[row]
+                v[row, :] = 0
+                s[row, :] = 0
+                if winner >= 0:
+                    v[row, winner] = table_veg[winner]
+                    s[row, winner] = table_spore[winner]
+                    resources[row] = table_resources[winner]
+                else:
+                    resources[row] = empty_resources
+        else:
+            nstrain_discrete(v, s, resources, c, alpha, gamma, mu_v, mu_s, mu_R, spore_chance, germ_chance, dt,
+                             iterations)
+
+        # Colonize from the global pool
+        weighted_sum = 0.0
+        for i in range(num_strains):
+            veg = 0.0
+            spore = 0.0
+            for row in range(n):
+                veg += v[row, i]
+                spore += s[row, i]
+            weights[i] = max(veg, 0.0) * fly_v_survival[i]
+            weights[num_strains + i] = max(spore, 0.0) * fly_s_survival[i]
+            weighted_sum += weights[i] + weights[num_strains + i]
+
+        if weighted_sum > 0:
+            prob = min(weighted_sum / n * colonization_prob_slope * dt, 1.0)
+            for row in range(n):
+                if np.random.random() < prob:
+                    x = np.random.random() * weighted_sum
+                    j = 0
+                    while j < 2 * num_strains - 1 and x >= weights[j]:
+                        x -= weights[j]
+                        j += 1
+                    while weights[j] == 0:  # Rounding can run past the last cell type that is present
+                        j -= 1
+                    if j < num_strains:
+                        v[row, j] += yeast_size
+                    elif germinate_on_drop:
+                        v[row, j - num_strains] += yeast_size
+                    else:
+                        s[row, j - num_strains] += yeast_size
+
+        # Patch deaths
+        for row in range(n):
+            if np.random.random() < prob_death * dt:
+                v[row, :] = 0
+                s[row, :] = 0
+                resources[row] = init_resources
+
+    return generations
@@ -0,0 +1,300 @@
+"""
+The NStrain resource model as a system of ODEs, for integrating patches exactly instead of with Euler steps.
+
+For each patch with resources R, vegetative cells v_i and spores s_i of strain i
+
+    dR/dt   = gamma - mu_R R - c R sum_i v_i
+    dv_i/dt = alpha c R v_i (1 - spore_chance_i) - mu_v v_i + germ_chance_i R s_i
+    ds_i/dt = alpha c R v_i spore_chance_i - mu_s s_i - germ_chance_i R s_i
+
+which is the model NStrain.discrete_update steps with forward Euler (and MultiStrain.py without germination).
+
+Many patches are integrated together as one stacked system, so one call to the solver advances a whole block of
+patches. The patches don't interact, so the Jacobian is block diagonal and is given to the solver as a sparse matrix.
+The state of P patches is packed into a flat vector of P blocks [R, v_0 ... v_S-1, s_0 ... s_S-1].
+
+dormand_prince is an alternative to solve_ivp for many patches. It is the same Runge-Kutta 5(4) method as solve_ivp's
+RK45, but every patch gets its own step size and error control, so a patch that changes quickly does not force small
+steps on all the others.
+"""
+
+import numpy as np
+import scipy.sparse
+from scipy.integrate import solve_ivp
+
+# Methods that use the Jacobian. The others are explicit.
+IMPLICIT_METHODS = ('Radau', 'BDF', 'LSODA')
+
+
+class NStrainODE:
+
+    def __init__(self, num_strains, c, alpha, gamma, mu_v, mu_s, mu_R, spore_chance, germ_chance=0.0):
+        """
+        Every parameter can be the same for all patches, or have one value per patch to integrate many parameter sets
+        at once. Scalar parameters are then arrays of shape (P,), and spore_chance and germ_chance (which have one
+        value per strain) arrays of shape (P, S).
+
+        Args:
+            num_strains: Number of strains S
+            The rest are the NStrain parameters.
+        """
+
+        self.num_strains = num_strains
+        self.c = self._patch_param(c)
+        self.alpha = self._patch_param(alpha)
+        self.gamma = self._patch_param(gamma)
+        self.mu_v = self._patch_param(mu_v)
+        self.mu_s = self._patch_param(mu_s)
+        self.mu_R = self._patch_param(mu_R)
+        self.spore_chance = self._strain_param(spore_chance)
+        self.germ_chance = self._strain_param(germ_chance)
+
+        self._pattern = {}  # {number of patches: (rows, cols) of the Jacobian's nonzero entries}
+
+    @staticmethod
+    def _patch_param(x):
+        """ Shapes a parameter so it broadcasts against the (P,) resources. """
+        return np.asarray(x, dtype=float)
+
+    def _strain_param(self, x):
+        """ Shapes a per strain parameter so it broadcasts against the (P, S) populations. """
+        x = np.asarray(x, dtype=float)
+        if x.ndim == 0:
+            x = np.full(self.num_strains, float(x))
+        return x
+
+    def _per_patch(self, x):
+        """ A scalar parameter as a column, so it broadcasts against the (P, S) populations. """
+        return x[:, None] if x.ndim == 1 else x
+
+    @property
+    def size(self):
+        """ The number of variables of a single patch. """
+        return 1 + 2 * self.num_strains
+
+    def pack(self, resources, v, s):
+        """
+        Packs the state of P patches into the flat vector the solver works on.
+
+        Args:
+            resources: Array (P,)
+            v, s: Arrays (P, S)
+        """
+
+        resources = np.asarray(resources, dtype=float).reshape(-1, 1)
+        v = np.asarray(v, dtype=float).reshape(len(resources), self.num_strains)
+        s = np.asarray(s, dtype=float).reshape(len(resources), self.num_strains)
+        return np.hstack((resources, v, s)).ravel()
+
+    def unpack(self, y):
+        """
+        The opposite of pack. y can also be a matrix with one packed state per column, like the output of the solver,
+        in which case each returned array gets an extra last axis for time.
+
+        Returns:
+            (resources, v, s) with shapes (P,), (P, S) and (P, S)
+        """
+
+        S = self.num_strains
+        y = y.reshape((-1, self.size) + y.shape[1:])
+        return y[:, 0], y[:, 1:1 + S], y[:, 1 + S:]
+
+    def rhs(self, t, y):
+        """ The time derivative of the packed state y. """
+        return self.derivative(y.reshape(-1, self.size)).ravel()
+
+    def derivative(self, y):
+        """ The time derivative of the state of P patches, as a (P, 1 + 2S) array with a row per patch. """
+
+        S = self.num_strains
+        resources, v, s = y[:, 0], y[:, 1:1 + S], y[:, 1 + S:]
+        r = resources[:, None]
+        born = self._per_patch(self.alpha * self.c) * r * v
+        germinated = self.germ_chance * r * s
+
+        d = np.empty_like(y)
+        d[:, 0] = self.gamma - self.mu_R * resources - self.c * resources * v.sum(axis=1)
+        d[:, 1:1 + S] = born * (1 - self.spore_chance) - self._per_patch(self.mu_v) * v + germinated
+        d[:, 1 + S:] = born * self.spore_chance - self._per_patch(self.mu_s) * s - germinated
+        return d
+
+    def jacobian(self, t, y):
+        """ The Jacobian of rhs at y, as a sparse block diagonal matrix. """
+
+        resources, v, s = self.unpack(y)
+        P, S = v.shape
+        r = resources[:, None]
+        ac = self._per_patch(self.alpha * self.c)
+        c = self._per_patch(self.c)
+        sc = np.broadcast_to(self.spore_chance, (P, S))
+        gc = np.broadcast_to(self.germ_chance, (P, S))
+
+        # The nonzero entries of each patch's block, in the order of _sparsity_pattern
+        values = np.hstack((
+            np.broadcast_to(-self.mu_R - self.c * v.sum(axis=1), (P,))[:, None],  # dR/dR
+            np.broadcast_to(-c * r, (P, S)),  # dR/dv
+            ac * v * (1 - sc) + gc * s,  # dv/dR
+            np.broadcast_to(ac * r * (1 - sc) - self._per_patch(self.mu_v), (P, S)),  # dv/dv
+            gc * r,  # dv/ds
+            ac * v * sc - gc * s,  # ds/dR
+            np.broadcast_to(ac * r * sc, (P, S)),  # ds/dv
+            np.broadcast_to(-self._per_patch(self.mu_s) - gc * r, (P, S)),  # ds/ds
+        ))
+
+        rows, cols = self._sparsity_pattern(P)
+        n = P * self.size
+        return scipy.sparse.csc_matrix((values.ravel(), (rows, cols)), shape=(n, n))
+
+    def _sparsity_pattern(self, P):
+        """ The rows and columns of the nonzero entries of the Jacobian for P patches. """
+
+        if P not in self._pattern:
+            S = self.num_strains
+            R, V, Sp = 0, 1 + np.arange(S), 1 + S + np.arange(S)
+            zero = np.zeros(S, dtype=int)
+            rows = np.concatenate(([R], zero + R, V, V, V, Sp, Sp, Sp))
+            cols = np.concatenate(([R], V, zero + R, V, Sp, zero + R, V, Sp))
+            offsets = (np.arange(P) * self.size)[:, None]
+            self._pattern[P] = ((offsets + rows).ravel(), (offsets + cols).ravel())
+        return self._pattern[P]
+
+    def integrate(self, resources, v, s, t_span, t_eval=None, method='BDF', dense_output=False, **kwargs):
+        """
+        Integrates the patches over t_span with scipy's solve_ivp, all patches as one system.
+
+        Args:
+            resources, v, s: The starting state, see pack
+            t_span: (start time, end time)
+            t_eval: Times at which to store the solution. See solve_ivp.
+            method: The solve_ivp method. The implicit ones ('BDF', 'Radau', 'LSODA') are given the Jacobian.
+            dense_output: If true the result has a continuous solution, result.sol(t).
+            **kwargs: Passed on to solve_ivp, for example rtol and atol.
+
+        Returns:
+            The solve_ivp result. Unpack result.y to get the populations over time.
+        """
+
+        y0 = self.pack(resources, v, s)
+        if method in IMPLICIT_METHODS:
+            if method == 'LSODA':  # LSODA only takes dense Jacobians
+                kwargs.setdefault('jac', lambda t, y: self.jacobian(t, y).toarray())
+            else:
+                kwargs.setdefault('jac', self.jacobian)
+
+        result = solve_ivp(self.rhs, t_span, y0, method=method, t_eval=t_eval, dense_output=dense_output, **kwargs)
+        if not result.success:
+            raise Exception(f"Integrating the NStrain model failed: {result.message}")
+        return result
+
+    def advance(self, resources, v, s, duration, method='BDF', **kwargs):
+        """
+        Moves the patches forward by duration and returns their new state.
+        The solver can overshoot zero by rounding error, so the result is clipped at zero like the discrete update.
+
+        Returns:
+            (resources, v, s)
+        """
+
+        result = self.integrate(resources, v, s, (0, duration), t_eval=[duration], method=method, **kwargs)
+        resources, v, s = self.unpack(result.y[:, -1])
+        return np.maximum(resources, 0), np.maximum(v, 0), np.maximum(s, 0)
+
+    def advance_adaptive(self, resources, v, s, duration, rtol=1e-6, atol=1e-9, step_size=None):
+        """
+        Same as advance, but with dormand_prince so each patch controls its own step size.
+
+        Args:
+            step_size: The step size each patch ended on last time, which is a good first guess. None (or 0) to
+                       estimate it.
+
+        Returns:
+            (resources, v, s, step_size)
+        """
+
+        y = np.asarray(self.pack(resources, v, s)).reshape(-1, self.size)
+        y, step_size, _ = dormand_prince(self.derivative, y, duration, rtol=rtol, atol=atol, step_size=step_size)
+        S = self.num_strains
+        y = np.maximum(y, 0)
+        return y[:, 0], y[:, 1:1 + S], y[:, 1 + S:], step_size
+
+
+# The Dormand-Prince 5(4) tableau
+_DP_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1])
+_DP_A = [np.array([]),
+         np.array([1 / 5]),
+         np.array([3 / 40, 9 / 40]),
+         np.array([44 / 45, -56 / 15, 32 / 9]),
+         np.array([19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729]),
+         np.array([9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656])]
+_DP_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+_DP_E = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])  # 5th - 4th order
+
+
+def dormand_prince(f, y, duration, rtol=1e-6, atol=1e-9, step_size=None, max_steps=100000):
+    """
+    Integrates many independent systems of the same size over the same time, each with its own adaptive step size.
+
+    Every iteration takes one Dormand-Prince step for all systems that haven't reached the end yet, vectorized over
+    the systems. Each system then accepts or rejects its own step by its own error estimate and picks its next step
+    size, so the systems don't wait on each other's accuracy.
+
+    Args:
+        f: The derivative, a function from a (P, m) array of states to a (P, m) array
+        y: The starting states, a (P, m) array
+        duration: How far to integrate
+        rtol, atol: The error tolerances, as in solve_ivp
+        step_size: The first step size of each system, (P,) or a number. It is estimated where it is None or 0.
+        max_steps: Give up after this many iterations
+
+    Returns:
+        (y, step_size, steps) where y is the state at duration, step_size the step size each system would
+        take next and steps the number of accepted steps of each system.
+    """
+
+    y = np.array(y, dtype=float)
+    P = len(y)
+    t = np.zeros(P)
+    steps = np.zeros(P, dtype=int)
+    k1 = f(y)
+
+    h = np.zeros(P) if step_size is None else np.broadcast_to(np.asarray(step_size, dtype=float), (P,))
+    guess = ~(h > 0)
+    if guess.any():
+        # The usual first guess: a step that changes y by about 1% of its size
+        scale = atol + rtol * np.abs(y)
+        d0 = np.sqrt(np.mean((y / scale) ** 2, axis=1))
+        d1 = np.sqrt(np.mean((k1 / scale) ** 2, axis=1))
+        h = np.where(guess, np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / np.maximum(d1, 1e-300)), h)
+    h = np.minimum(h, duration)
+
+    stages = np.empty((7,) + y.shape)
+    for _ in range(max_steps):
+        active = t < duration * (1 - 1e-12)
+        if not active.any():
+            break
+
+        step = np.where(active, np.minimum(h, duration - t), 0)[:, None]
+        stages[0] = k1
+        for i in range(1, 6):
+            stages[i] = f(y + step * np.tensordot(_DP_A[i], stages[:i], axes=1))
+        y_new = y + step * np.tensordot(_DP_B, stages[:6], axes=1)
+        stages[6] = f(y_new)
+
+        error = step * np.tensordot(_DP_E, stages, axes=1)
+        scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+        error_norm = np.sqrt(np.mean((error / scale) ** 2, axis=1))
+
+        accept = active & (error_norm <= 1)
+        y[accept] = y_new[accept]
+        k1[accept] = stages[6][accept]  # The last stage is the first stage of the next step
+        t[accept] += step[accept, 0]
+        steps[accept] += 1
+
+        with np.errstate(divide='ignore'):
+            factor = np.clip(0.9 * error_norm ** -0.2, 0.2, 5)
+        factor = np.where(accept, factor, np.minimum(factor, 1))
+        h = np.where(active, np.maximum(step[:, 0], 1e-300) * factor, h)
+    else:
+        raise Exception(f"dormand_prince did not reach the end in {max_steps} steps.")
+
+    return y, h, steps
@@ -0,0 +1,124 @@
+"""
+The sparse patch state of the NStrain eq mode (rules.sparse_eq).
+
+After an eq update a patch holds at most one strain, the winner, at its equilibrium. Until the next update the only
+other cells in it are the colonists that landed since. So instead of a veg and spore population for every strain,
+each patch stores its winner (-1 if empty) with the winner's veg and spores, and all colonists of the world go in one
+Propagules buffer. Memory and work per patch then grow with the strains present instead of with num_strains.
+"""
+
+import numpy as np
+
+
+class Propagules:
+    """
+    The cells added to patches since the last eq update, as parallel arrays of patch index, strain, veg and spores.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.patch = np.zeros(0, dtype=np.int64)
+        self.strain = np.zeros(0, dtype=np.int64)
+        self.veg = np.zeros(0)
+        self.spore = np.zeros(0)
+        self._sorted = True
+
+    def add(self, patches, strains, veg=0.0, spore=0.0):
+        """ Adds cells. veg and spore are amounts for each entry, or one amount for all. """
+
+        patches = np.atleast_1d(np.asarray(patches, dtype=np.int64))
+        if len(patches) == 0:
+            return
+        strains = np.broadcast_to(np.asarray(strains, dtype=np.int64), patches.shape)
+        self._chunks.append((patches, strains, np.broadcast_to(np.asarray(veg, dtype=float), patches.shape),
+                             np.broadcast_to(np.asarray(spore, dtype=float), patches.shape)))
+        self._sorted = False
+
+    def sort(self):
+        """ Gathers everything added into the arrays, sorted by patch, so of_patch can find a patch's cells. """
+
+        if self._sorted:
+            return
+        chunks = [(self.patch, self.strain, self.veg, self.spore)] + self._chunks
+        self._chunks = []
+        patch, strain, veg, spore = (np.concatenate(column) for column in zip(*chunks))
+        order = np.argsort(patch, kind='stable')
+        self.patch, self.strain, self.veg, self.spore = patch[order], strain[order], veg[order], spore[order]
+        self._sorted = True
+
+    def of_patch(self, index):
+        """ The slice of the arrays holding the cells of the patch. """
+
+        self.sort()
+        return slice(np.searchsorted(self.patch, index, side='left'), np.searchsorted(self.patch, index, side='right'))
+
+    def drop(self, index):
+        """ Forgets the cells of a patch, when it is reset. """
+
+        self.drop_many([index])
+
+    def drop_many(self, indices):
+        """ Forgets the cells of many patches at once, in one pass over the buffer. """
+
+        self.sort()
+        keep = ~np.isin(self.patch, indices)
+        if not keep.all():
+            self.patch, self.strain, self.veg, self.spore = (self.patch[keep], self.strain[keep], self.veg[keep],
+                                                             self.spore[keep])
+
+    def move(self, old, new):
+        """ Gives the cells of patch old to patch new, when World.remove_patch moves a patch to a new index. """
+
+        self.sort()
+        moved = self.patch == old
+        if moved.any():
+            self.patch[moved] = new
+            self._sorted = False
+
+    def clear(self):
+        self.__init__()
+
+    def __len__(self):
+        return len(self.patch) + sum(len(chunk[0]) for chunk in self._chunks)
+
+
+def pick_winners(winner, veg, rows, strains, arriving_veg, order, rank, tie_end, rng):
+    """
+    The eq mode winner of some patches, from their current winner and the colonists that landed on them. Like the
+    dense eq mode a strain is present if it has veg cells, and the present strain with the best rank wins (see
+    NStrain.strain_ranks). Ties are broken at random.
+
+    Args:
+        winner, veg: The current winner (-1 if none) and its veg cells, for each of the m patches
+        rows, strains, arriving_veg: The colonists. rows are positions in winner, 0 to m - 1.
+        order, rank, tie_end: See NStrain.strain_ranks
+        rng: A numpy random generator, only used if there are ties
+
+    Returns:
+        The new winner of each patch, -1 if it is empty
+    """
+
+    num_strains = len(order)
+    held = np.flatnonzero((winner >= 0) & (veg > 0))
+    arrived = arriving_veg > 0
+    rows = np.concatenate((held, rows[arrived]))
+    strains = np.concatenate((winner[held], strains[arrived]))
+    ranks = rank[strains]
+
+    best = np.full(len(winner), num_strains)
+    np.minimum.at(best, rows, ranks)
+    occupied = best < num_strains
+
+    tied = occupied & (tie_end[np.minimum(best, num_strains - 1)] - best > 1)
+    if tied.any():
+        # Of the different tied strains present in a patch pick one at random
+        candidates = tied[rows] & (ranks < tie_end[best[rows]])
+        pairs = np.unique(rows[candidates] * num_strains + strains[candidates])
+        pair_rows, pair_strains = pairs // num_strains, pairs % num_strains
+        by_key = np.lexsort((rng.random(len(pairs)), pair_rows))
+        last = np.append(pair_rows[by_key][1:] != pair_rows[by_key][:-1], True)
+        best[pair_rows[by_key][last]] = rank[pair_strains[by_key][last]]
+
+    new_winner = np.full(len(winner), -1, dtype=np.int64)
+    new_winner[occupied] = order[best[occupied]]
+    return new_winner
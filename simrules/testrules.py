@@ -1,5 +1,6 @@
 import logging
-from rules import Rules
+import numpy
+from rules import Rules, VectorRules
 
 class AddOne(Rules):
 
@@ -20,3 +21,38 @@ class AddOne(Rules):
         """
 
         patch.populations += 1
+
+
+class AddOneArray(AddOne):
+    """ The same as AddOne, but the populations of all patches are allocated in one array. """
+
+    def allocate_state(self, world):
+        return {'populations': numpy.zeros(world.num_patches, dtype=int)}
+
+
+class VectorAddOne(VectorRules):
+    """
+    AddOne written against VectorRules. Each generation every patch also sends one individual to the next patch (by
+    index), read from the populations before any are moved.
+    """
+
+    def __init__(self, worldmap, spread=False):
+        super().__init__()
+        self.worldmap = worldmap
+        self.spread = spread
+
+    def allocate_state(self, world):
+        return {'populations': numpy.zeros(world.num_patches, dtype=int)}
+
+    def update(self, world, rows, rng):
+        world.state['populations'][rows] += 1
+
+    def reset(self, world, rows):
+        world.state['populations'][rows] = 0
+
+    def disperse(self, world, deltas, rng):
+        if not self.spread:
+            return
+        senders = numpy.flatnonzero(world.state['populations'] > 0)
+        deltas.add_many('populations', senders, -1)
+        deltas.add_many('populations', (senders + 1) % world.num_patches, 1)
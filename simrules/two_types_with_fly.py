@@ -39,6 +39,7 @@ class SimpleCompetitionColonization(Rules):
         populations = world.patches[0].populations
         populations['rv'] = 100
         populations['kv'] = 100
+        self.record_history(world)
 
     def reset_patch(self, patch):
         """
@@ -47,7 +48,7 @@ class SimpleCompetitionColonization(Rules):
         """
 
         patch.populations = {'rv': 0, 'kv': 0}
-        print(f"Patch {patch.id} has been reset.")
+        logging.debug("Patch %s has been reset.", patch.id)
 
     def patch_update(self, patch):
         """
@@ -119,27 +120,28 @@ class SimpleCompetitionColonization(Rules):
 
     def census(self, world):
 
-        def record_history(world):
-            pass
-
-        print("\n")
-        print("=" * 30)
+        if not self.reporter.due(world.age):
+            return
 
         sum_r = 0
         sum_k = 0
         for patch in world.patches:
             sum_r += patch.populations['rv']
             sum_k += patch.populations['kv']
-        print(f"\nGEN {world.age} TOTALS: rv: {sum_r}, kv: {sum_k}")
 
-        print("\nIndividual Patch Populations")
-        for patch in world.patches:
-            print(f"Patch {patch.id}: {str(patch.populations)}")
+        def lines():
+            l = [f"GEN {world.age} TOTALS: rv: {sum_r}, kv: {sum_k}", "Individual Patch Populations"]
+            for patch in world.patches:
+                l.append(f"Patch {patch.id}: {str(patch.populations)}")
+            return l
+
+        self.reporter.report(world, lines)
 
     def record_history(self, world):
-        """ Records history to the world.history dictionary. """
+        """ Has the world's historian record the total colonizers and competitors every generation. """
 
-        pass
+        world.history.watch('rv', lambda w: sum(patch.populations['rv'] for patch in w.patches))
+        world.history.watch('kv', lambda w: sum(patch.populations['kv'] for patch in w.patches))
 
     def stop_condition(self, world):
         return world.age > self.stop_time
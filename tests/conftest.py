@@ -0,0 +1,68 @@
+"""
+The NStrain simulations most of the tests run on. Tests ask for the factories through the nstrain_rules,
+nstrain_world and random_nstrain_world fixtures.
+"""
+
+from functools import partial
+
+import pytest
+import numpy as np
+import networkx as nx
+
+from world import World
+from AM_programs.NStrain import NStrain
+
+
+def make_nstrain_rules(spore_chance=(.2, .6), n=10, germ_chance=0, fly_v_survival=1, fly_s_survival=1,
+                       folder_name="test", save_data=False, **settings):
+    """
+    NStrain rules on a complete worldmap of n patches, with a strain for each spore chance. The other per strain
+    parameters can also be one value for every strain. settings are set on the rules afterwards, for example
+    update_mode='eq'.
+    """
+
+    S = len(spore_chance)
+
+    def per_strain(value):
+        return list(value) if np.ndim(value) else [value] * S
+
+    rules = NStrain(S, worldmap=nx.complete_graph(n), folder_name=folder_name, spore_chance=list(spore_chance),
+                    germ_chance=per_strain(germ_chance), fly_s_survival=per_strain(fly_s_survival),
+                    fly_v_survival=per_strain(fly_v_survival), save_data=save_data)
+    for name, value in settings.items():
+        setattr(rules, name, value)
+    return rules
+
+
+def make_nstrain_world(seed=None, **kwargs):
+    """
+    A World with make_nstrain_rules(**kwargs). With a seed every patch starts with random populations and resources,
+    and the eq table of the default parameters is made.
+    """
+
+    world = World(make_nstrain_rules(**kwargs))
+    if seed is not None:
+        n, S = world.num_patches, world.rules.num_strains
+        rng = np.random.default_rng(seed)
+        world.state['v_populations'][:] = rng.random((n, S)) * (rng.random((n, S)) < 0.5)
+        world.state['s_populations'][:] = rng.random((n, S))
+        world.state['resources'][:] = rng.random(n) * 10
+        world.rules.make_eq_lookup_table(world.patches[0])
+    return world
+
+
+@pytest.fixture
+def nstrain_rules():
+    return make_nstrain_rules
+
+
+@pytest.fixture
+def nstrain_world():
+    return make_nstrain_world
+
+
+@pytest.fixture
+def random_nstrain_world():
+    """ make_nstrain_world with three strains and random populations, for comparing ways of updating the patches """
+    return partial(make_nstrain_world, seed=3, n=50, spore_chance=(.1, .4, .7), germ_chance=(.5, .2, .5),
+                   fly_v_survival=.5, fly_s_survival=.5)
@@ -1 +1,167 @@
-import pytest
\ No newline at end of file
+import io
+import random
+import pytest
+import numpy as np
+
+import main
+
+
+@pytest.fixture
+def strains_world(nstrain_world):
+    """ nstrain_world with S strains, with spore chances .1, .2, ... """
+    def make(S=4, n=10, **settings):
+        return nstrain_world(spore_chance=[.1 * (i + 1) for i in range(S)], n=n, fly_s_survival=.5, fly_v_survival=.2,
+                             **settings)
+    return make
+
+
+class TestCompaction:
+
+    def test_compact(self, strains_world):
+        world = strains_world()
+        rules = world.rules
+        world.state['v_populations'][:, [0, 2]] = 1
+        world.state['s_populations'][:5, 2] = 2
+        world.patches[0].spore_chance = [.5, .6, .7, .8]
+
+        assert rules.compact_extinct_strains(world) == [1, 3]
+        assert rules.num_strains == 2
+        assert rules.strain_ids.tolist() == [0, 2]
+        assert rules.spore_chance == pytest.approx([.1, .3])
+        assert world.patches[0].spore_chance == [.5, .7]
+        assert world.state['v_populations'].shape == (10, 2)
+        assert world.patches[3].v_populations.tolist() == [1, 1]
+
+        # The outputs still have all the strains
+        rules.book_keeping(world)
+        assert rules.v_population_totals == [10, 0, 10, 0]
+        assert rules.s_population_totals == [0, 0, 10, 0]
+        file = io.StringIO()
+        rules.record_observations(file, world, 0, rules.v_population_totals, rules.s_population_totals)
+        assert len(file.getvalue().splitlines()) == 3 * 4
+
+        # Strain 2 (now 1) dies out too
+        world.state['v_populations'][:, 1] = 0
+        world.state['s_populations'][:, 1] = 0
+        assert rules.compact_extinct_strains(world) == [2]
+        assert rules.strain_ids.tolist() == [0]
+        rules.book_keeping(world)
+        assert rules.v_population_totals == [10, 0, 0, 0]
+
+    def test_sparse(self, strains_world):
+        world = strains_world(sparse_eq=True)
+        rules = world.rules
+        world.state['winner'][:] = 3
+        world.state['veg'][:] = 1
+        rules.propagules.add([0, 1], [1, 3], veg=1)
+
+        assert rules.compact_extinct_strains(world) == [0, 2]
+        assert (world.state['winner'] == 1).all()
+        assert rules.propagules.strain.tolist() == [0, 1]
+        rules.book_keeping(world)
+        assert rules.v_population_totals == [0, 1, 0, 11]
+
+    def test_run(self, strains_world):
+        """ A run with compaction goes the same as one without """
+        totals = []
+        for compact in [False, True]:
+            random._inst.seed(4)  # NStrain replaces random.seed
+            world = strains_world(S=6, n=20)
+            rules = world.rules
+            rules.update_mode = 'eq'
+            rules.colonize_mode = 'probabilities'
+            rules.prob_death = 0.5
+            rules.stop_time = 60
+            rules.compact_strains = compact
+            main.simulate(world)
+            totals.append(rules.all_population_totals)
+
+        assert world.rules.num_strains < 6
+        assert np.allclose(totals[0], totals[1])
+
+
+class TestFusedStep:
+
+    @pytest.fixture
+    def fused_world(self, strains_world):
+        def make(backend='python', update_mode='discrete'):
+            world = strains_world(S=3, n=20, update_mode=update_mode, backend=backend, colonize_mode='mean field',
+                                  stop_time=300)
+            world.rules.reporter.silent = True
+            world.rules.set_initial_conditions(world)
+            return world
+        return make
+
+    def test_step_count(self, fused_world):
+        world = fused_world()
+        world.rules.prob_death = 0
+        assert world.step(10) == 10
+        assert world.age == 10
+        world.rules.fused_step = True
+        assert world.step(1000) == 290
+        assert world.age == 300
+        assert world.step(5) == 0
+
+    @pytest.mark.parametrize("backend", ["python", "numba"])
+    def test_same_without_randomness(self, fused_world, backend):
+        """ With nothing random happening fused and one generation at a time runs end the same """
+        worlds = [fused_world(backend), fused_world(backend)]
+        worlds[1].rules.fused_step = True
+        for world in worlds:
+            world.rules.prob_death = 0
+            world.rules.colonization_prob_slope = 0
+            world.rules.dt = 0.1
+            world.step(250)
+
+        for name in ['v_populations', 's_populations', 'resources']:
+            assert np.allclose(worlds[0].state[name], worlds[1].state[name])
+
+    @pytest.mark.parametrize("backend", ["python", "numba"])
+    def test_census_only_when_due(self, fused_world, backend):
+        world = fused_world(backend, 'eq')
+        rules = world.rules
+        rules.fused_step = True
+        rules.prob_death = 0.01
+        ages = []
+        census = rules.census
+        rules.census = lambda w: (ages.append(w.age), census(w))
+        main.simulate(world)
+
+        assert ages == [0, 100, 200]
+        assert world.age == 300
+        assert 0 < rules.total_pop
+
+    def test_only_mean_field(self, fused_world):
+        """ The other colonize modes draw differently, so they always go one generation at a time """
+        world = fused_world()
+        rules = world.rules
+        rules.fused_step = True
+        world.step(1)  # Past the census of generation 0
+        assert rules.fused_span(world, 10) == 10
+        rules.colonize_mode = 'probabilities'
+        assert rules.fused_span(world, 10) == 0
+
+    def test_no_book_keeping_when_fused(self, fused_world):
+        world = fused_world()
+        rules = world.rules
+        rules.fused_step = True
+        rules.prob_death = 0
+        kept = []
+        book_keeping = rules.book_keeping
+        rules.book_keeping = lambda w: kept.append(w.age) or book_keeping(w)
+        world.step(50)
+
+        assert world.age == 50
+        assert set(kept) == {0}  # Only the generation with a census went through the hooks
+
+    def test_extinction_stops(self, fused_world):
+        world = fused_world(update_mode='eq')
+        rules = world.rules
+        rules.fused_step = True
+        rules.gamma = 0  # Nothing can grow
+        rules.eq_tables.clear()
+        rules.prob_death = 0.5
+        rules.colonization_prob_slope = 0
+        world.step(1000)
+        assert world.age < 100
+        assert rules.total_pop == 0
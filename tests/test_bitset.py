@@ -0,0 +1,87 @@
+import pytest
+import numpy as np
+
+from simrules import bitset, helpers
+
+
+class TestBitset:
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for num_bits in [1, 7, 64, 65, 130]:
+            bits = rng.random((100, num_bits)) < 0.1
+            masks = bitset.pack(bits)
+
+            assert masks.shape == (100, bitset.num_words(num_bits))
+            assert (bitset.unpack(masks, num_bits) == bits).all()
+            assert (bitset.popcount(masks) == bits.sum(axis=1)).all()
+            assert (bitset.bit_counts(masks, num_bits) == bits.sum(axis=0)).all()
+
+    def test_lowest_bit(self):
+        rng = np.random.default_rng(1)
+        bits = rng.random((100, 130)) < 0.01
+        bits[0] = False
+        bits[1, 63] = True
+        expected = np.where(bits.any(axis=1), bits.argmax(axis=1), -1)
+
+        masks = bitset.pack(bits)
+        assert (bitset.lowest_bit(masks) == expected).all()
+        assert [bitset.lowest_bit(row) for row in masks] == expected.tolist()
+
+    def test_set_bits(self):
+        bits = np.zeros((4, 130), dtype=bool)
+        masks = bitset.pack(bits)
+        rows, columns = [0, 2, 2, 2, 3], [5, 64, 129, 64, 0]
+        bits[rows, columns] = True
+
+        bitset.set_bits(masks, rows, columns)
+        assert (bitset.unpack(masks, 130) == bits).all()
+
+
+class TestPresence:
+
+    def test_many_strain_winners(self, nstrain_world):
+        """ With unsorted spore chances and more strains than fit in a word the masks give the same winners """
+        n, S = 30, 100
+        rng = np.random.default_rng(2)
+        spore_chance = rng.choice(np.linspace(0, 1, 40), S).tolist()  # With ties
+        world = nstrain_world(spore_chance=spore_chance, n=n)
+        rules = world.rules
+        world.state['v_populations'][:] = rng.random((n, S)) * (rng.random((n, S)) < 0.05)
+
+        rules.refresh_presence(world)
+        for patch in world.patches:
+            expected = helpers.find_winner(patch.v_populations.tolist(), patch.s_populations.tolist(), spore_chance)
+            assert rules.mask_winners(patch.presence) == expected
+
+    def test_eq_update_keeps_masks(self, nstrain_world):
+        for block_updates in [False, True]:
+            world = nstrain_world(spore_chance=[.5, .2, .5], n=20, update_mode='eq', block_updates=block_updates)
+            rules = world.rules
+            world.state['v_populations'][:] = np.random.default_rng(3).random((20, 3)) < 0.4
+            world.update_patches()
+
+            presence = world.state['presence'].copy()
+            rules.refresh_presence(world)
+            assert (presence == world.state['presence']).all()
+            assert (bitset.popcount(presence) <= 1).all()
+
+    @pytest.mark.parametrize("colonize_mode", ['probabilities', 'mean field', 'fly'])
+    def test_colonization_keeps_masks(self, nstrain_world, colonize_mode):
+        """ The colonization sets the bits of what it adds, so the masks are only built from scratch once """
+        world = nstrain_world(spore_chance=[.5, .2, .5], n=30, update_mode='eq', colonize_mode=colonize_mode,
+                              num_flies=20, colonization_prob_slope=10)
+        rules = world.rules
+        rules.set_initial_conditions(world)
+        world.update_patches()
+
+        rebuilt = []
+        refresh_presence = rules.refresh_presence
+        rules.refresh_presence = lambda world, rows=None: (rebuilt.append(rows is None), refresh_presence(world, rows))
+        for _ in range(5):
+            rules.colonize(world)
+            order = rules.strain_ranks()[0]
+            assert (world.state['presence'] == bitset.pack(world.state['v_populations'][:, order] > 0)).all()
+            world.update_patches()
+
+        assert not any(rebuilt)
@@ -0,0 +1,45 @@
+from simrules import cache
+from simrules.cache import SharedCache
+
+
+class TestSharedCache:
+
+    def test_lru(self):
+        shared = SharedCache(maxsize=2)
+        made = []
+
+        def make(x):
+            made.append(x)
+            return x * 2
+
+        assert shared.get('a', lambda: make(1)) == 2
+        assert shared.get('b', lambda: make(2)) == 4
+        assert shared.get('a', lambda: make(1)) == 2  # a is now the most recently used
+        shared.get('c', lambda: make(3))  # So b is forgotten
+        shared.get('a', lambda: make(1))
+        shared.get('b', lambda: make(2))
+
+        assert made == [1, 2, 3, 2]
+        assert len(shared) == 2
+        assert shared.hits == 2 and shared.misses == 4
+
+    def test_disk(self, tmp_path):
+        SharedCache(path=tmp_path).get(('x', 1.5), lambda: [1, 2, 3])
+
+        other = SharedCache(path=tmp_path)  # Like a later run
+        assert other.get(('x', 1.5), lambda: None) == [1, 2, 3]
+        assert other.misses == 0
+
+        other.clear(disk=True)
+        assert other.get(('x', 1.5), lambda: 'new') == 'new'
+
+    def test_rules_share_tables(self, nstrain_world):
+        """ A new rules object with the same parameters reuses the equilibrium table of the first """
+        def table():
+            world = nstrain_world(spore_chance=[.25, .75], n=3)
+            return world.rules.eq_tables.for_patch(world.patches[0])
+
+        first = table()
+        misses = cache.shared.misses
+        assert table() is first
+        assert cache.shared.misses == misses
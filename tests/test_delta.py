@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+import networkx as nx
+
+from world import World
+from delta import DeltaBuffer
+from simrules import testrules
+from simrules.NStrainsSimple import NStrainsSimple
+
+
+class TestDeltaBuffer:
+
+    def test_nothing_changes_until_applied(self):
+        world = World(NStrainsSimple(3, nx.path_graph(4), 0, 1, 10))
+        deltas = DeltaBuffer(world)
+
+        deltas.add('populations', 0, 2, column=1)
+        deltas.add('populations', 0, 3, column=1)  # Changes to the same place add up
+        deltas.add('populations', 2, [1, 2, 3])
+        deltas.add('resource_level', 3, -0.5)
+        assert len(deltas) == 6
+        assert world.state['populations'].sum() == 0
+
+        deltas.apply()
+        assert list(world.patches[0].populations) == [0, 5, 0]
+        assert list(world.patches[2].populations) == [1, 2, 3]
+        assert world.patches[3].resource_level == 0.5
+        assert len(deltas) == 0
+
+    def test_attributes_outside_state(self):
+        world = World(testrules.AddOne(nx.path_graph(3)))
+        deltas = DeltaBuffer(world)
+
+        deltas.add('populations', 1, 4)
+        deltas.add('populations', 1, 1)
+        assert world.patches[1].populations == 0
+        deltas.apply()
+        assert world.patches[1].populations == 5
+
+        world.patches[2].populations = [1, 2, 3]
+        deltas.add('populations', 2, [1, 0, 2])
+        deltas.add('populations', 2, 1, column=0)
+        deltas.apply()
+        assert world.patches[2].populations == [3, 2, 5]
+
+
+class TestSynchronousColonization:
+
+    def test_individuals_are_conserved(self):
+        """ Colonization only moves individuals around """
+        rules = NStrainsSimple(2, nx.grid_2d_graph(4, 4), 0, 0, 30)
+        rules.synchronous_colonization = True
+        world = World(rules)
+        world.patches[0].populations = [50, 50]
+
+        for i in range(30):
+            rules.colonize(world)
+
+        assert world.state['populations'].sum(axis=0).tolist() == [50, 50]
+        assert np.count_nonzero(world.state['populations'].sum(axis=1)) > 1
+
+    def test_flies_conserve_cells(self, nstrain_world):
+        """ Flies that always survive only move cells around """
+        world = nstrain_world(spore_chance=[.2, .5], germ_chance=.5, synchronous_colonization=True,
+                              colonize_mode='fly', num_flies=20, fly_stomach_size=3, germinate_on_drop=False)
+        rules = world.rules
+        world.state['v_populations'][:] = 1
+        world.state['s_populations'][:] = 1
+
+        rules.colonize(world)
+
+        assert world.state['v_populations'].sum() + world.state['s_populations'].sum() == pytest.approx(40)
+        assert (world.state['v_populations'] != 1).any() or (world.state['s_populations'] != 1).any()  # Cells moved
@@ -0,0 +1,76 @@
+from functools import partial
+
+import pytest
+import numpy as np
+
+from world import World
+from ensemble import Ensemble
+from simrules.equilibria import single_strain_equilibria
+
+
+@pytest.fixture
+def nstrain(nstrain_rules):
+    """ nstrain_rules with the mean field colonization an Ensemble needs """
+    return partial(nstrain_rules, update_mode='discrete', colonize_mode='mean field')
+
+
+class TestEnsemble:
+
+    def test_discrete_same_as_world(self, nstrain):
+        """ Without colonization or deaths every replicate does exactly what a World does """
+        rules = nstrain(patch_update_iterations=5, dt=0.1)
+        world = World(rules)
+        rules.set_initial_conditions(world)
+        rules.block_updates = True
+        world.update_patches()
+
+        ensemble = Ensemble(rules, replicates=3)
+        ensemble.update(slice(None), ensemble.v, ensemble.s, ensemble.resources, {
+            name: getattr(ensemble, name) for name in ('c', 'alpha', 'gamma', 'mu_v', 'mu_s', 'mu_R', 'spore_chance',
+                                                       'germ_chance', 'fly_v_survival', 'fly_s_survival')})
+        for r in range(3):
+            assert np.allclose(ensemble.v[r], world.state['v_populations'])
+            assert np.allclose(ensemble.s[r], world.state['s_populations'])
+
+    def test_parameter_points(self, nstrain):
+        """ Each replicate goes to the equilibria of its own parameters """
+        points = [nstrain(update_mode='eq', spore_chance=sc) for sc in [(.2, .6), (.5, .3)]]
+        ensemble = Ensemble(points)
+        ensemble.colonization_prob_slope = 0
+        ensemble.prob_death = 0
+        ensemble.v[:] = ensemble.yeast_size
+        ensemble.step()
+
+        for r, rules in enumerate(points):
+            table = single_strain_equilibria(rules.spore_chance, rules.c, rules.alpha, rules.gamma, rules.mu_v,
+                                             rules.mu_s, rules.mu_R)
+            winner = int(np.argmin(rules.spore_chance))
+            assert np.allclose(ensemble.v[r, :, winner], table.veg[winner])
+            assert not ensemble.v[r, :, 1 - winner].any()
+            assert np.allclose(ensemble.resources[r], table.resources[winner])
+            assert ensemble.v_population_totals[r, winner] == pytest.approx(10 * table.veg[winner])
+
+    def test_finished_replicates_masked(self, nstrain):
+        """ A replicate that goes extinct stops, and its state is left alone while the others keep going """
+        points = [nstrain(update_mode='eq'), nstrain(update_mode='eq', gamma=0)]
+        ensemble = Ensemble(points)
+        ensemble.stop_time = 20
+        ensemble.prob_death = 0
+        ensemble.run()
+
+        assert ensemble.done.all()
+        assert ensemble.age[0] == 20
+        assert ensemble.age[1] < 20
+        assert ensemble.total_pop[1] == 0
+
+    def test_colonize_and_kill(self, nstrain):
+        rules = nstrain(update_mode='eq', prob_death=0.5, stop_time=30)
+        ensemble = Ensemble(rules, replicates=20, record_every=10)
+        ensemble.run()
+        assert (ensemble.age[~(ensemble.total_pop == 0)] == 30).all()
+        assert [g for g, *_ in ensemble.history] == [0, 10, 20, 30]
+        assert (ensemble.patches_occupied <= 1).all()
+
+    def test_fly_not_allowed(self, nstrain):
+        with pytest.raises(ValueError):
+            Ensemble(nstrain(colonize_mode='fly'))
@@ -0,0 +1,110 @@
+import pytest
+import numpy as np
+
+from simrules.equilibria import single_strain_equilibria, coexistence_equilibrium
+from simrules.ode import NStrainODE
+
+PARAMS = dict(c=0.2, alpha=0.3, gamma=5, mu_v=0.1, mu_s=0.05, mu_R=0.02)
+
+
+class TestEquilibria:
+
+    def test_formula(self):
+        """ Compare with the equilibrium written out one strain at a time """
+        table = single_strain_equilibria([0.1, 0.5, 1], **PARAMS)
+        c, alpha, gamma, mu_v, mu_s, mu_R = (PARAMS[k] for k in ['c', 'alpha', 'gamma', 'mu_v', 'mu_s', 'mu_R'])
+
+        for i, s in enumerate([0.1, 0.5]):
+            assert table.veg[i] == pytest.approx((c * alpha * gamma * (1 - s) - mu_R * mu_v) / (c * mu_v))
+            assert table.spore[i] == pytest.approx(
+                s * (c * alpha * gamma * (s - 1) + mu_R * mu_v) / ((s - 1) * c * mu_s))
+            assert table.resources[i] == pytest.approx(mu_v / ((1 - s) * alpha * c))
+        assert np.isfinite([table.veg[2], table.spore[2], table.resources[2]]).all()
+        assert table.empty_resources == gamma / mu_R
+
+    def test_shared_tables(self, nstrain_world):
+        """ Patches with the same parameters share a table, and patches with their own parameters get their own """
+        world = nstrain_world(update_mode='eq')
+        world.state['v_populations'][:, 0] = 1
+        rules = world.rules
+        for i in [1, 2]:
+            world.patches[i].gamma = 2 * rules.gamma
+        world.patches[3].spore_chance = [.3, .6]
+
+        tables = [rules.eq_tables.for_patch(patch) for patch in world.patches]
+        assert tables[0] is tables[4] is rules.eq_tables.default()
+        assert tables[1] is tables[2] is not tables[0]
+        assert tables[3] is not tables[0]
+        assert len(rules.eq_tables) == 3
+
+        rules.all_patches_same = True
+        assert rules.eq_tables.for_patch(world.patches[1]) is rules.eq_tables.default()
+
+    def test_heterogeneous_eq_update(self, nstrain_world):
+        """ Each patch goes to the equilibrium of its own parameters """
+        world = nstrain_world(update_mode='eq')
+        world.state['v_populations'][:, 0] = 1
+        rules = world.rules
+        world.patches[1].gamma = 2 * rules.gamma
+        world.update_patches()
+
+        default = single_strain_equilibria(rules.spore_chance, rules.c, rules.alpha, rules.gamma, rules.mu_v,
+                                           rules.mu_s, rules.mu_R)
+        richer = single_strain_equilibria(rules.spore_chance, rules.c, rules.alpha, 2 * rules.gamma, rules.mu_v,
+                                          rules.mu_s, rules.mu_R)
+        assert world.patches[0].v_populations[0] == pytest.approx(default.veg[0])
+        assert world.patches[0].resources == pytest.approx(default.resources[0])
+        assert world.patches[1].v_populations[0] == pytest.approx(richer.veg[0])
+        assert world.patches[1].v_populations[0] > world.patches[0].v_populations[0]
+
+
+class TestCoexistence:
+
+    def test_single_strain_same_as_table(self):
+        table = single_strain_equilibria([0.1, 0.5], **PARAMS)
+        for i in range(2):
+            veg, spore, resources = coexistence_equilibrium([i == 0, i == 1], [0.1, 0.5], 0, **PARAMS)
+            assert veg[i] == pytest.approx(table.veg[i])
+            assert spore[i] == pytest.approx(table.spore[i])
+            assert resources == pytest.approx(table.resources[i])
+
+    def test_stable(self):
+        """ With germination the strain with the higher spore chance wins, and the ODE goes there too """
+        spore_chance, germ_chance = [0.2, 0.5, 0.6], [0, 1, 0]
+        veg, spore, resources = coexistence_equilibrium([True, True, True], spore_chance, germ_chance, **PARAMS)
+        assert veg[0] == 0 and veg[1] > 0
+
+        model = NStrainODE(3, spore_chance=spore_chance, germ_chance=germ_chance, **PARAMS)
+        r, v, s = model.advance([10], [[1, 1, 1]], [[1, 1, 1]], 5000, rtol=1e-10, atol=1e-12)
+        assert np.allclose(v[0], veg, atol=1e-4)
+        assert np.allclose(s[0], spore, atol=1e-4)
+        assert r[0] == pytest.approx(resources, rel=1e-4)
+
+    def test_ties_and_empty(self):
+        veg, _, _ = coexistence_equilibrium([True, True], [0.3, 0.3], 0, **PARAMS)
+        assert veg[0] == veg[1] > 0
+
+        veg, spore, resources = coexistence_equilibrium([False, True], [0.3, 1], 0, **PARAMS)
+        assert not veg.any() and not spore.any()
+        assert resources == PARAMS['gamma'] / PARAMS['mu_R']
+
+    def test_eq_update(self, nstrain_world):
+        """ Block and per patch updates both go to the coexistence equilibrium of each patch """
+        for block_updates in [False, True]:
+            world = nstrain_world(update_mode='eq')
+            world.state['v_populations'][:, 0] = 1
+            rules = world.rules
+            rules.eq_solver = 'coexistence'
+            rules.germ_chance = [0, 1]
+            rules.block_updates = block_updates
+            world.state['v_populations'][:5, 1] = 1
+            world.state['v_populations'][-1, 0] = 0
+            world.update_patches()
+
+            both = coexistence_equilibrium([True, True], rules.spore_chance, rules.germ_chance, rules.c,
+                                           rules.alpha, rules.gamma, rules.mu_v, rules.mu_s, rules.mu_R)
+            alone = coexistence_equilibrium([True, False], rules.spore_chance, rules.germ_chance, rules.c,
+                                            rules.alpha, rules.gamma, rules.mu_v, rules.mu_s, rules.mu_R)
+            assert np.allclose(world.state['v_populations'][:5], both[0])
+            assert np.allclose(world.state['v_populations'][5:-1], alone[0])
+            assert not world.state['v_populations'][-1].any()
@@ -23,7 +23,7 @@ def random_simulation(n):
                    fly_v_survival=helpers.random_probs(num_strains), save_data=False)
     rules.update_mode = random.choice(["discrete", "eq"])
 
-    rules.colonize_mode = random.choice(["fly", "probabilities"])
+    rules.colonize_mode = random.choice(["fly", "probabilities", "mean field"])
     rules.fly_stomach_size = random.choice([1, 2, 10, 'type 2'])
 
     rules.c = 0.1  # Consumption rate for init_resources_per_patch.
@@ -714,6 +714,24 @@ class TestNStrainExtinctionPresistence:
             print(rules.book_keeping(world)[-1])
             assert sum(rules.book_keeping(world)[-1]) > 1  # The sum of all cells should be much larger than zero
 
+    def test_mean_field_spreads(self):
+        """ Colonists from the global pool reach every patch of an otherwise empty world """
+
+        for i in range(0, TEST_ITERATIONS):
+            rules = random_simulation(3)
+            rules.spore_chance = [sc / 2 for sc in rules.spore_chance]  # A spore chance near 1 can't live at all
+            rules.worldmap = nx.complete_graph(30)
+            rules.prob_death = 0
+            rules.stop_time = 200
+            rules.update_mode = "eq"
+            rules.colonize_mode = "mean field"
+            rules.colonization_prob_slope = 10
+            world = World(rules)
+
+            main.simulate(world)
+
+            assert rules.patches_occupied == 1
+
     def test_no_colonization_extinction(self):
         """We expect that if strains cannot colonize then they all eventually go extinct, even if cells are nearly immortal"""
 
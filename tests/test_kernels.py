@@ -0,0 +1,82 @@
+import random
+import pytest
+import numpy as np
+
+from world import World
+from simrules import helpers, kernels
+from simrules.TwoStrain import TwoStrain
+
+
+def assert_same_state(world1, world2):
+    for name in ['v_populations', 's_populations', 'resources']:
+        assert np.allclose(world1.state[name], world2.state[name])
+
+
+class TestKernels:
+    """ The compiled kernels give the same results as the python code """
+
+    def test_backend_names(self):
+        assert not kernels.use_numba('python')
+        assert kernels.use_numba('numba') == kernels.HAVE_NUMBA
+        with pytest.raises(ValueError):
+            kernels.use_numba('fortran')
+
+    @pytest.mark.parametrize("update_mode", ["discrete", "eq"])
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_nstrain_updates(self, random_nstrain_world, update_mode, workers):
+        python = random_nstrain_world(update_mode=update_mode, update_workers=workers)
+        compiled = random_nstrain_world(update_mode=update_mode, update_workers=workers, backend='numba')
+
+        for _ in range(3):
+            python.update_patches()
+            compiled.update_patches()
+
+        assert_same_state(python, compiled)
+
+    def test_find_winners(self):
+        spore_chance = [.1, .1, .3, .5, 1]
+        out = np.empty(5, dtype=np.int64)
+        for _ in range(200):
+            v = [random.choice([0, 0, 1.5]) for _ in range(5)]
+            s = [random.choice([0, 2]) for _ in range(5)]
+            for germinate in [False, True]:
+                count = kernels.find_winners(np.array(v), np.array(s), np.array(spore_chance), germinate, out)
+                assert out[:count].tolist() == helpers.find_winner(v, s, spore_chance, germinate)
+
+    def test_two_strain(self):
+        python = World(TwoStrain())
+        compiled_rules = TwoStrain()
+        compiled_rules.backend = 'numba'
+        compiled = World(compiled_rules)
+
+        for world in [python, compiled]:
+            for patch in world.patches[:10]:
+                patch.populations = {'rv': 5, 'rs': 1, 'kv': 3, 'ks': 0.5}
+            for _ in range(20):
+                for patch in world.patches[:10]:
+                    patch.update()
+
+        for p1, p2 in zip(python.patches[:10], compiled.patches[:10]):
+            assert p1.resources == pytest.approx(p2.resources)
+            for key in p1.populations:
+                assert p1.populations[key] == pytest.approx(p2.populations[key])
+
+    @pytest.mark.parametrize("stomach_size", [3, "type 2"])
+    def test_fly_colonize(self, random_nstrain_world, stomach_size):
+        """ Flies that always survive only move cells around """
+        world = random_nstrain_world(n=20, backend='numba')
+        rules = world.rules
+        rules.colonize_mode = 'fly'
+        rules.num_flies = 50
+        rules.fly_stomach_size = stomach_size
+        rules.fly_v_survival = [1, 1, 1]
+        rules.fly_s_survival = [1, 1, 1]
+        rules.germinate_on_drop = False
+        world.state['v_populations'][:] = 1
+        world.state['s_populations'][:] = 1
+
+        rules.colonize(world)
+
+        assert world.state['v_populations'].sum() == pytest.approx(60)
+        assert world.state['s_populations'].sum() == pytest.approx(60)
+        assert (world.state['v_populations'] != 1).any()
@@ -0,0 +1,148 @@
+import pytest
+import numpy as np
+
+from simrules.ode import NStrainODE, dormand_prince
+
+PARAMS = dict(c=0.2, alpha=0.3, gamma=5, mu_v=0.1, mu_s=0.05, mu_R=0.02)
+
+
+def random_state(P, S, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.random(P) * 10, rng.random((P, S)), rng.random((P, S))
+
+
+class TestModel:
+
+    def test_rhs(self):
+        """ Compare with the model written out one strain at a time """
+        spore_chance, germ_chance = [0.1, 0.5, 0.9], [0.3, 0.2, 0.1]
+        model = NStrainODE(3, spore_chance=spore_chance, germ_chance=germ_chance, **PARAMS)
+        resources, v, s = random_state(4, 3)
+
+        d_resources, d_v, d_s = model.unpack(model.rhs(0, model.pack(resources, v, s)))
+
+        p = PARAMS
+        for k in range(4):
+            r = resources[k]
+            assert d_resources[k] == pytest.approx(p['gamma'] - p['mu_R'] * r - p['c'] * r * v[k].sum())
+            for i in range(3):
+                born = p['alpha'] * p['c'] * r * v[k, i]
+                germinated = germ_chance[i] * r * s[k, i]
+                assert d_v[k, i] == pytest.approx(born * (1 - spore_chance[i]) - p['mu_v'] * v[k, i] + germinated)
+                assert d_s[k, i] == pytest.approx(born * spore_chance[i] - p['mu_s'] * s[k, i] - germinated)
+
+    def test_jacobian(self):
+        """ Compare with finite differences, with different parameters for each patch """
+        model = NStrainODE(2, c=[0.2, 0.3, 0.4], alpha=0.3, gamma=[1, 2, 3], mu_v=0.1, mu_s=0.05, mu_R=0.02,
+                           spore_chance=[[0.1, 0.5], [0.2, 0.3], [0.9, 0.4]], germ_chance=[0.3, 0.1])
+        y = model.pack(*random_state(3, 2))
+
+        jacobian = model.jacobian(0, y).toarray()
+        eps = 1e-6
+        for j in range(len(y)):
+            dy = np.zeros_like(y)
+            dy[j] = eps
+            column = (model.rhs(0, y + dy) - model.rhs(0, y - dy)) / (2 * eps)
+            assert np.allclose(jacobian[:, j], column, atol=1e-6)
+
+    def test_stacked(self):
+        """ Integrating patches together is the same as integrating them one at a time """
+        model = NStrainODE(2, spore_chance=[0.2, 0.6], germ_chance=0.1, **PARAMS)
+        resources, v, s = random_state(5, 2)
+
+        together = model.advance(resources, v, s, 10, rtol=1e-8, atol=1e-10)
+        for k in range(5):
+            alone = model.advance(resources[k:k + 1], v[k:k + 1], s[k:k + 1], 10, rtol=1e-8, atol=1e-10)
+            for x, y in zip(together, alone):
+                assert np.allclose(x[k], y[0], rtol=1e-5)
+
+    def test_equilibrium(self, nstrain_world):
+        """ A single strain goes to the equilibrium the eq update mode jumps to """
+        world = nstrain_world(spore_chance=[0.3], n=2)
+        rules = world.rules
+        rules.make_eq_lookup_table(world.patches[0])
+
+        model = rules.ode_model()
+        resources, v, s = model.advance([rules.gamma / rules.mu_R], [[1]], [[0]], 1e5, rtol=1e-9, atol=1e-12)
+
+        assert v[0, 0] == pytest.approx(rules.lookup_table[0]["Veg"], rel=1e-4)
+        assert s[0, 0] == pytest.approx(rules.lookup_table[0]["Spore"], rel=1e-4)
+        assert resources[0] == pytest.approx(rules.lookup_table[0]["Resources"], rel=1e-4)
+
+
+class TestDormandPrince:
+
+    def test_exponential_decay(self):
+        """ Each system has its own rate, and the fast ones shouldn't change how the slow ones are stepped """
+        rates = np.array([[0.1], [1.0], [50.0]])
+        y, step_size, steps = dormand_prince(lambda y: -rates * y, np.ones((3, 1)), 2, rtol=1e-8, atol=1e-12)
+
+        assert np.allclose(y[:, 0], np.exp(-rates[:, 0] * 2), rtol=1e-6, atol=1e-12)
+        assert steps[0] < steps[2]
+
+    def test_same_as_solve_ivp(self):
+        model = NStrainODE(3, spore_chance=[0.1, 0.5, 0.9], germ_chance=0.1, **PARAMS)
+        resources, v, s = random_state(10, 3)
+
+        exact = model.advance(resources, v, s, 20, rtol=1e-10, atol=1e-12)
+        adaptive = model.advance_adaptive(resources, v, s, 20, rtol=1e-8, atol=1e-10)
+        for x, y in zip(exact, adaptive):
+            assert np.allclose(x, y, rtol=1e-5, atol=1e-8)
+
+    def test_continue_with_step_size(self):
+        """ Two halves, the second starting from the step size the first ended on, is the same as the whole """
+        model = NStrainODE(2, spore_chance=[0.2, 0.6], germ_chance=0.1, **PARAMS)
+        y = model.pack(*random_state(5, 2)).reshape(-1, model.size)
+
+        whole, _, _ = dormand_prince(model.derivative, y, 20, rtol=1e-9, atol=1e-12)
+        half, step_size, _ = dormand_prince(model.derivative, y, 10, rtol=1e-9, atol=1e-12)
+        half, _, _ = dormand_prince(model.derivative, half, 10, rtol=1e-9, atol=1e-12, step_size=step_size)
+        assert np.allclose(whole, half, rtol=1e-6)
+
+class TestOdeUpdateMode:
+
+    @pytest.fixture
+    def ode_world(self, nstrain_world):
+        """ nstrain_world with 20 patches in a random_state """
+        def make(update_mode, dt, block_updates=False):
+            world = nstrain_world(n=20, germ_chance=0.1, update_mode=update_mode, dt=dt, block_updates=block_updates)
+            resources, v, s = random_state(20, 2)
+            world.state['resources'][:] = resources
+            world.state['v_populations'][:] = v
+            world.state['s_populations'][:] = s
+            return world
+        return make
+
+    def test_block_same_as_per_patch(self, ode_world):
+        per_patch = ode_world('ode', 1)
+        block = ode_world('ode', 1, block_updates=True)
+        for _ in range(5):
+            per_patch.update_patches()
+            block.update_patches()
+
+        for name in ['v_populations', 's_populations', 'resources']:
+            assert np.allclose(per_patch.state[name], block.state[name], rtol=1e-3)
+
+    def test_adaptive_same_as_ode(self, ode_world):
+        ode = ode_world('ode', 1, block_updates=True)
+        per_patch = ode_world('adaptive', 1)
+        block = ode_world('adaptive', 1, block_updates=True)
+        for _ in range(5):
+            ode.update_patches()
+            per_patch.update_patches()
+            block.update_patches()
+
+        assert (block.state['step_size'] > 0).all()
+        for name in ['v_populations', 's_populations', 'resources']:
+            assert np.allclose(ode.state[name], block.state[name], rtol=1e-3)
+            assert np.allclose(per_patch.state[name], block.state[name], rtol=1e-3)
+
+    def test_close_to_small_euler_steps(self, ode_world):
+        ode = ode_world('ode', 1, block_updates=True)
+        euler = ode_world('discrete', 0.001)
+        euler.rules.patch_update_iterations = 1000
+        ode.update_patches()
+        euler.update_patches()
+
+        for name in ['v_populations', 's_populations', 'resources']:
+            assert np.allclose(ode.state[name], euler.state[name], rtol=1e-2)
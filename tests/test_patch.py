@@ -7,6 +7,7 @@ from patch import Patch
 from rules import Rules
 import general
 from simrules import testrules
+from simrules.TwoStrain import TwoStrain
 
 # logging.basicConfig(filename='test_patch.log', level=logging.DEBUG)
 # logging.info('Started')
@@ -145,6 +146,71 @@ class TestMap():
         assert world.patches[2].neighbor_ids(self_loop=False) == [1, 3]
         assert world.patches[3].neighbor_ids() == [2, 3]
 
+    def test_random_neighbor_labelled_world(self):
+        """ Node labels that are not list positions (here (row, col) tuples) must still find the right patches. """
+        rules = testrules.AddOne(nx.grid_2d_graph(3, 4))
+        world = World(rules)
+
+        corner = world.get_patch((0, 0))
+        assert corner.id == (0, 0)
+        assert sorted(world.nodes[i] for i in corner.neighbor_indices(self_loop=False)) == [(0, 1), (1, 0)]
+
+        for patch in world.patches:
+            allowed = set(patch.neighbor_ids())
+            for _ in range(20):
+                assert patch.random_neighbor().id in allowed
+
+    def test_random_neighbor_shuffled_labels(self):
+        """ Integer labels that are not contiguous or not in order """
+        graph = nx.relabel_nodes(nx.path_graph(4), {0: 30, 1: 7, 2: 12, 3: 5})
+        world = World(testrules.AddOne(graph))
+
+        patch = world.get_patch(7)
+        assert sorted(world.nodes[i] for i in patch.neighbor_indices()) == [7, 12, 30]
+        for _ in range(50):
+            assert patch.random_neighbor().id in (7, 12, 30)
+
+class TestDispersal:
+    """ Weighted and directed dispersal through world.dispersal """
+
+    def test_weights(self):
+        graph = nx.Graph()
+        graph.add_edge(0, 1, weight=3)
+        graph.add_edge(0, 2, weight=1)
+        world = World(testrules.AddOne(graph))
+
+        dist = world.dispersal.distribution(0)
+        assert dist[1] == pytest.approx(0.6)
+        assert dist[2] == pytest.approx(0.2)
+        assert dist[0] == pytest.approx(0.2)  # Staying has weight 1
+
+        counts = {0: 0, 1: 0, 2: 0}
+        for _ in range(5000):
+            counts[world.patches[0].random_neighbor().id] += 1
+        assert 2700 < counts[1] < 3300
+
+    def test_directed(self):
+        graph = nx.DiGraph()
+        graph.add_edge(0, 1)
+        graph.add_edge(1, 2)
+        rules = testrules.AddOne(graph)
+        rules.dispersal_self_weight = 0
+        world = World(rules)
+
+        for _ in range(20):
+            assert world.patches[0].random_neighbor().id == 1
+            assert world.patches[1].random_neighbor().id == 2
+            assert world.patches[2].random_neighbor() is None  # A sink with no way out
+
+    def test_self_loop(self):
+        graph = nx.path_graph(2)
+        graph.add_edge(0, 0, weight=0)
+        world = World(testrules.AddOne(graph))
+
+        assert world.dispersal.distribution(0) == {1: pytest.approx(1.0)}
+        assert world.dispersal.distribution(1) == {0: pytest.approx(0.5), 1: pytest.approx(0.5)}
+
+
 class TestMisc:
 
     def test_check_param_lists(self):
@@ -162,3 +228,63 @@ class TestMisc:
 
         l = [[0.4, 0.2], [0.3, 0.3], [0.99, 0.11], [.2, .5]]
         assert rules.check_param_lists(l) == True
+
+
+class TestCompact:
+
+    def test_defaults_come_from_rules(self):
+        rules = TwoStrain()
+        rules.worldmap = nx.complete_graph(3)
+        world = World(rules)
+        patch = world.patches[0]
+
+        assert patch.c == rules.c
+        rules.c = 0.5  # Defaults are stored once, so changing the rules changes every patch
+        assert world.patches[1].c == 0.5
+
+    def test_overrides(self):
+        rules = TwoStrain()
+        rules.worldmap = nx.complete_graph(3)
+        world = World(rules)
+
+        world.patches[0].c = 0.9
+        assert world.patches[0].c == 0.9
+        assert world.patches[0].has_overrides()
+        assert world.patches[1].c == rules.c
+        assert not world.patches[1].has_overrides()
+
+        # Resetting the patch forgets its own values
+        rules.reset_patch(world.patches[0])
+        assert world.patches[0].c == rules.c
+        assert not world.patches[0].has_overrides()
+
+    def test_update_function_survives_reset(self):
+        world = complete_world()
+        patch = world.patches[0]
+        patch.change_update_function(add_double)
+        world.rules.reset_patch(patch)
+
+        patch.populations = 1
+        patch.update()
+        assert patch.populations == 3
+        world.patches[1].update()
+        assert world.patches[1].populations == 1
+
+    def test_world_knows_custom_patches(self):
+        rules = TwoStrain()
+        rules.worldmap = nx.complete_graph(3)
+        world = World(rules)
+        assert world.custom_patches == set()
+
+        world.patches[0].c = 0.9
+        world.patches[1].change_update_function(add_double)
+        world.patches[2].c = 0.8
+        del world.patches[2].c
+        assert world.custom_patches == {world.patches[0], world.patches[1]}
+
+        rules.reset_patch(world.patches[0])  # Forgets its parameters
+        rules.reset_patch(world.patches[1])  # Keeps its update function
+        assert world.custom_patches == {world.patches[1]}
+
+        world.remove_patch(1)
+        assert world.custom_patches == set()
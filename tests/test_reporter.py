@@ -0,0 +1,84 @@
+import io
+import networkx as nx
+
+from world import World
+import main
+from reporter import ProgressReporter
+from simrules import testrules
+
+
+def make_world():
+    world = World(testrules.AddOne(nx.complete_graph(3)))
+    world.rules.stop_time = 100
+    return world
+
+
+class TestReporter:
+
+    def test_every_n_generations(self):
+        world = make_world()
+        stream = io.StringIO()
+        reporter = ProgressReporter(every=10, interval=None, stream=stream)
+
+        reports = []
+        for age in range(0, 35):
+            world.age = age
+            if reporter.report(world) is not None:
+                reports.append(age)
+
+        assert reports == [0, 10, 20, 30]
+        assert len(stream.getvalue().splitlines()) == 4
+
+    def test_interval(self):
+        world = make_world()
+        reporter = ProgressReporter(every=None, interval=1000, stream=io.StringIO())
+
+        reports = 0
+        for age in range(0, 100):
+            world.age = age
+            if reporter.report(world) is not None:
+                reports += 1
+
+        assert reports == 1  # Only the first report happens within 1000 seconds
+
+    def test_silent(self):
+        world = make_world()
+        stream = io.StringIO()
+        seen = []
+        reporter = ProgressReporter(every=1, interval=None, silent=True, stream=stream, callback=seen.append)
+
+        def lines():
+            raise AssertionError("Lines should not be built in silent mode")
+
+        for age in range(0, 5):
+            world.age = age
+            reporter.report(world, lines)
+
+        assert stream.getvalue() == ""
+        assert len(seen) == 5
+        assert seen[-1]['generation'] == 4
+
+    def test_progress(self):
+        world = make_world()
+        reporter = ProgressReporter(every=1, interval=None, silent=True)
+
+        world.age = 0
+        reporter.report(world)
+        world.age = 50
+        info = reporter.report(world)
+
+        assert info['total'] == 100
+        assert info['generations_per_second'] >= 0
+        assert info['eta'] is None or info['eta'] >= 0
+        assert reporter.last is info
+
+    def test_rules_silent_by_default(self, nstrain_world, capsys):
+        world = nstrain_world(stop_time=20)
+        main.simulate(world)
+        assert capsys.readouterr().out == ""
+        assert world.rules.reporter.last is not None  # Progress is still measured
+
+        world = nstrain_world(stop_time=20)
+        world.rules.reporter.silent = False  # Opting in
+        main.simulate(world)
+        assert "gen 0/20" in capsys.readouterr().out
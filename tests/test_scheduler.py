@@ -0,0 +1,135 @@
+import shutil
+
+import pytest
+import numpy as np
+import pandas
+
+import main
+from world import World
+from scheduler import ChangeFilter, Scheduler
+
+
+class FakeWorld:
+    def __init__(self, age=0):
+        self.age = age
+
+
+class TestScheduler:
+
+    def test_cadences_and_triggers(self):
+        scheduler = Scheduler()
+        runs = []
+        scheduler.observe('every 3', lambda world, totals: runs.append(('every 3', world.age)), every=3)
+        scheduler.observe('odd', lambda world, totals: runs.append(('odd', world.age)), when=lambda w: w.age % 2)
+        for age in range(7):
+            scheduler.run(FakeWorld(age), lambda: None)
+
+        assert runs == [('every 3', 0), ('odd', 1), ('every 3', 3), ('odd', 3), ('odd', 5), ('every 3', 6)]
+
+    def test_totals_only_when_needed(self):
+        scheduler = Scheduler()
+        seen = []
+        scheduler.observe('check', lambda world, totals: seen.append(totals), every=1)
+        scheduler.observe('save', lambda world, totals: seen.append(totals), every=50, totals=True)
+        aggregated = []
+
+        def aggregate():
+            aggregated.append(1)
+            return 'totals'
+
+        results = [scheduler.run(FakeWorld(age), aggregate) for age in range(100)]
+        assert len(aggregated) == 2
+        assert results.count(True) == 2
+        assert seen[:3] == ['totals', 'totals', None]  # Everything due at 0 gets the totals
+
+    def test_until_due(self):
+        scheduler = Scheduler()
+        save_every = [50]
+        scheduler.observe('safety', lambda world, totals: None, every=100)
+        scheduler.observe('save', lambda world, totals: None, every=lambda: save_every[0])
+        scheduler.observe('off', lambda world, totals: None, every=7, enabled=False)
+        scheduler.observe('progress', lambda world, totals: None, when=lambda world: True)
+
+        assert scheduler.generations_until_due(0) == 0
+        assert scheduler.generations_until_due(1) == 49
+        save_every[0] = 200
+        assert scheduler.generations_until_due(1) == 99
+
+        scheduler.remove('safety')
+        scheduler.remove('save')
+        assert scheduler.generations_until_due(1) is None
+
+    def test_needs_a_schedule(self):
+        with pytest.raises(ValueError):
+            Scheduler().observe('never', lambda world, totals: None)
+
+
+class TestNStrainCensus:
+
+    def test_book_keeping_skipped(self, nstrain_world):
+        """ Without saving or a due progress report, census only sums the totals when the safety checks are due """
+        world = nstrain_world()
+        rules = world.rules
+        rules.reporter.every = None
+        rules.reporter.interval = None
+        rules.reporter.due = lambda generation: False
+        rules.scheduler.observe('sums', lambda world, totals: None, every=25, totals=True)
+        rules.set_initial_conditions(world)
+
+        calls = []
+        book_keeping = rules.book_keeping
+        rules.book_keeping = lambda w: (calls.append(w.age), book_keeping(w))[1]
+        for age in range(100):
+            world.age = age
+            rules.census(world)
+
+        assert calls == [0, 25, 50, 75]
+        assert rules.total_pop == pytest.approx(2 * 10 * rules.yeast_size)
+
+
+class TestChangeFilter:
+
+    def test_tolerance_and_heartbeat(self):
+        change_filter = ChangeFilter(rtol=0.1, heartbeat=5)
+        values = [1, 1.05, 1.09, 1.2, 1.21, 1.21, 1.21, 1.21, 1.21, 1.21]
+        through = [g for g, x in enumerate(values) if change_filter.changed(g, [x, 2])]
+        assert through == [0, 3, 8]
+
+    def test_step_function_within_tolerance(self):
+        """ Every value is within the tolerance of the last record before it """
+        change_filter = ChangeFilter(rtol=0.01, atol=0.001)
+        values = np.cumsum(np.random.default_rng(1).normal(0, 0.01, 500)) + 1
+        last = None
+        for x in values:
+            if change_filter.changed(0, [x]):
+                last = x
+            assert abs(x - last) <= 0.001 + 0.01 * abs(last)
+
+
+class TestNStrainChangeRecording:
+
+    def run(self, nstrain_rules, name, **settings):
+        rules = nstrain_rules(folder_name=name, save_data=True)
+        rules.stop_time = 100
+        rules.prob_death = 0  # Nothing changes after the first update
+        rules.colonization_prob_slope = 0
+        rules.reporter.silent = True
+        for key, value in settings.items():
+            setattr(rules, key, value)
+        main.simulate(World(rules))
+        totals = pandas.read_csv(f"{rules.data_path}/totals.csv", index_col=False)
+        shutil.rmtree(rules.data_path)
+        return totals
+
+    def test_stationary_run(self, nstrain_rules):
+        full = self.run(nstrain_rules, "test_scheduler_full")
+        changes = self.run(nstrain_rules, "test_scheduler_changes", record_rtol=1e-9, record_heartbeat=40)
+
+        assert sorted(full['Iteration'].unique()) == list(range(100))
+        assert sorted(changes['Iteration'].unique()) == [0, 1, 41, 81, 99]
+
+        # The saved rows are the full rows of those generations
+        key = ['Iteration', 'Strain Number', 'Type']
+        merged = changes.merge(full, on=key, suffixes=('', '_full'))
+        assert len(merged) == len(changes)
+        assert np.allclose(merged['Population'], merged['Population_full'])
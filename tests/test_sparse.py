@@ -0,0 +1,124 @@
+import pytest
+import numpy as np
+
+import main
+from simrules.sparse import Propagules
+
+
+@pytest.fixture
+def eq_world(nstrain_world):
+    """ nstrain_world in eq mode, with the sparse or the dense state """
+    def make(sparse, n=40, S=6, spore_chance=None, block_updates=False):
+        if spore_chance is None:
+            spore_chance = [.35, .1, .5, .2, .05, .4][:S]
+        return nstrain_world(spore_chance=spore_chance, n=n, update_mode='eq', sparse_eq=sparse,
+                             block_updates=block_updates, germinate_on_drop=False)
+    return make
+
+
+class TestPropagules:
+
+    def test_buffer(self):
+        propagules = Propagules()
+        propagules.add([3, 1, 3], [0, 2, 1], veg=1.0)
+        propagules.add(1, 0, spore=2.0)
+        assert len(propagules) == 4
+
+        here = propagules.of_patch(1)
+        assert sorted(propagules.strain[here].tolist()) == [0, 2]
+        assert propagules.spore[here].sum() == 2
+
+        propagules.drop(3)
+        assert propagules.patch.tolist() == [1, 1]
+
+        propagules.move(1, 0)
+        assert propagules.patch.tolist() == [0, 0]
+
+        propagules.add([2, 4, 5], 0, veg=1.0)
+        propagules.drop_many([0, 5])
+        assert propagules.patch.tolist() == [2, 4]
+
+
+class TestSparseEq:
+
+    def test_same_as_dense(self, eq_world):
+        """ With the same colonists the sparse and dense states go through the same populations """
+        for block_updates in [False, True]:
+            dense = eq_world(False)
+            sparse = eq_world(True, block_updates=block_updates)
+            rng = np.random.default_rng(0)
+
+            for _ in range(10):
+                targets = rng.integers(0, 40, size=15)
+                colonists = rng.integers(0, 12, size=15)
+                for world in [dense, sparse]:
+                    world.rules.add_colonists(world, targets, colonists)
+
+                for world in [dense, sparse]:
+                    world.rules.book_keeping(world)
+                for name in ['v_population_totals', 's_population_totals', 'patch_occupancy', 'patches_occupied']:
+                    assert np.allclose(getattr(dense.rules, name), getattr(sparse.rules, name))
+
+                dense.update_patches()
+                sparse.update_patches()
+                for a, b in zip(dense.rules.dense_populations(dense), sparse.rules.dense_populations(sparse)):
+                    assert np.allclose(a, b)
+                assert np.allclose(dense.state['resources'], sparse.state['resources'])
+
+    def test_ties(self, eq_world):
+        """ Tied strains each win some of the patches """
+        world = eq_world(True, n=200, S=2, spore_chance=[.3, .3], block_updates=True)
+        n = world.num_patches
+        world.rules.propagules.add(np.arange(n), 0, veg=1)
+        world.rules.propagules.add(np.arange(n), 1, veg=1)
+        world.update_patches()
+
+        winners = world.state['winner']
+        assert (winners >= 0).all()
+        assert 50 < np.count_nonzero(winners == 0) < 150
+
+    def test_many_strain_run(self, eq_world):
+        world = eq_world(True, n=50, S=100, spore_chance=np.linspace(0, .9, 100).tolist())
+        rules = world.rules
+        rules.colonize_mode = 'mean field'
+        rules.stop_time = 30
+        main.simulate(world)
+
+        assert 'v_populations' not in world.state
+        assert rules.total_pop > 0
+        assert world.state['winner'].max() < 100
+
+    def test_remove_patch(self, eq_world):
+        """ The colonists of a patch move with it when World.remove_patch gives it a new index """
+        dense = eq_world(False, n=5)
+        sparse = eq_world(True, n=5)
+        for world in [dense, sparse]:
+            world.rules.set_initial_conditions(world)
+            world.remove_patch(0)
+
+        for a, b in zip(dense.rules.dense_populations(dense), sparse.rules.dense_populations(sparse)):
+            assert a.shape == b.shape == (4, 6)
+            assert np.allclose(a, b)
+
+        dense.update_patches()
+        sparse.update_patches()
+        assert (sparse.state['winner'] == [4, 1, 2, 3]).all()
+        assert np.allclose(dense.rules.dense_populations(dense)[0], sparse.rules.dense_populations(sparse)[0])
+
+    def test_kill_patches(self, eq_world):
+        """ Deaths reset the state and colonists of the dead patches in bulk, without making any patch objects """
+        world = eq_world(True, n=200, block_updates=True)
+        rules = world.rules
+        rules.set_initial_conditions(world)
+        world.update_patches()
+        rules.add_colonists(world, np.arange(200), np.zeros(200, dtype=int))
+        rules.prob_death = 0.5
+
+        rules.kill_patches(world)
+
+        dead = world.state['winner'] == -1
+        assert 50 < np.count_nonzero(dead) < 150
+        assert (world.state['veg'][dead] == 0).all()
+        assert (world.state['resources'][dead] == rules.init_resources_per_patch).all()
+        assert sorted(set(rules.propagules.patch.tolist())) == np.flatnonzero(~dead).tolist()
+        assert world.patches.materialized() == 0
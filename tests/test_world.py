@@ -1,8 +1,11 @@
+import random
 import logging
 import pytest
 import networkx as nx
+import numpy as np
 
 from world import World
+from rules import LegacyRulesAdapter
 from patch import Patch
 import general
 from simrules import testrules
@@ -140,3 +143,331 @@ class TestPatchUpdates:
         assert world1.patches[1].populations == 4
         assert world1.patches[2].populations == 4
         assert world1.patches[3].populations == 4
+
+
+class TestBulkBuild:
+
+    def test_patches_made_on_access(self):
+        world = World(testrules.AddOne(nx.path_graph(1000)))
+
+        assert len(world.patches) == 1000
+        assert world.patches.materialized() == 0
+
+        patch = world.patches[500]
+        assert world.patches.materialized() == 1
+        assert patch is world.patches[500]  # The same object is returned each time
+        assert patch.index == 500
+        assert patch.populations == 0
+
+        assert [p.id for p in world.patches[2:5]] == [2, 3, 4]
+        assert world.patches[-1].id == 999
+
+    def test_node_index(self):
+        world = World(testrules.AddOne(nx.grid_2d_graph(3, 4)))
+
+        assert world.num_patches == 12
+        for i, node in enumerate(world.nodes):
+            assert world.node_index[node] == i
+            assert world.patches[i].id == node
+            assert world.patches[i].index == i
+
+    def test_state_backed_patches(self):
+        world = World(testrules.AddOneArray(nx.complete_graph(5)))
+
+        assert list(world.state['populations']) == [0] * 5
+
+        world.update_patches()
+        world.patches[2].populations += 10
+        assert list(world.state['populations']) == [1, 1, 11, 1, 1]
+
+        # Patches made directly still share the world state
+        patch = Patch(3, world)
+        patch.populations = 7
+        assert world.patches[3].populations == 7
+
+
+class TestCompleteMap:
+    """ Complete worldmaps are sampled without compiling any neighbor lists """
+
+    def test_detect(self):
+        assert World(testrules.AddOne(nx.complete_graph(20))).complete
+        assert World(testrules.AddOne(nx.complete_graph(1))).complete
+        assert World(testrules.AddOne(nx.complete_graph(5, nx.DiGraph()))).complete
+        assert not World(testrules.AddOne(nx.path_graph(5))).complete
+
+        graph = nx.complete_graph(4)
+        graph[0][1]['weight'] = 2
+        assert not World(testrules.AddOne(graph)).complete
+
+    def test_uniform(self):
+        world = World(testrules.AddOne(nx.complete_graph(200)))
+        dist = world.dispersal.distribution(7)
+
+        assert len(dist) == 200
+        assert all(p == pytest.approx(1 / 200) for p in dist.values())
+        assert len(world.patches[7].neighbor_indices(self_loop=False)) == 199
+        assert world.patches[3].random_neighbor().index in range(200)
+
+    def test_no_self(self):
+        rules = testrules.AddOne(nx.complete_graph(50))
+        rules.dispersal_self_weight = 0
+        world = World(rules)
+
+        for _ in range(500):
+            assert world.patches[10].random_neighbor().index != 10
+
+
+def compiled_labels(world):
+    """ The compiled neighbor lists and dispersal targets of a world, by node label """
+    neighbors = {world.nodes[i]: sorted(str(world.nodes[j]) for j in nbs) for i, nbs in enumerate(world.neighbors)}
+    dispersal = {world.nodes[i]: {world.nodes[j]: round(p, 9) for j, p in world.dispersal.distribution(i).items()}
+                 for i in range(world.num_patches)}
+    return neighbors, dispersal
+
+
+class TestDynamicMap:
+    """ Changing the worldmap during a run """
+
+    def test_remove_patches(self):
+        world = World(testrules.AddOneArray(nx.grid_2d_graph(5, 5)))
+        world.neighbors, world.dispersal  # Compile before changing the map
+        for patch in world.patches:
+            patch.populations = patch.index
+        labels = {patch.id: patch.populations for patch in world.patches}
+
+        for node in [(0, 0), (4, 4), (2, 2), (2, 3), (0, 4)]:
+            world.remove_patch(node)
+            del labels[node]
+
+        assert world.num_patches == 20 == len(world.patches) == len(world.state['populations'])
+        for patch in world.patches:
+            assert world.nodes[patch.index] == patch.id
+            assert world.node_index[patch.id] == patch.index
+            assert patch.populations == labels[patch.id]  # The state moved along with the patch
+
+        assert compiled_labels(world) == compiled_labels(World(testrules.AddOneArray(world.worldmap)))
+
+    def test_add_patches_and_edges(self):
+        graph = nx.DiGraph()
+        graph.add_edge('a', 'b')
+        world = World(testrules.AddOneArray(graph))
+        world.neighbors, world.dispersal
+
+        for i in range(10):
+            patch = world.add_patch(i)
+            assert patch.populations == 0
+            world.add_edge('a', i, weight=2)
+        world.remove_edge('a', 'b')
+        world.update_patches()
+
+        assert world.num_patches == 12
+        assert all(patch.populations == 1 for patch in world.patches)
+        assert compiled_labels(world) == compiled_labels(World(testrules.AddOneArray(world.worldmap)))
+        assert world.patches[0].random_neighbor().id != 'b'
+
+        with pytest.raises(ValueError):
+            world.add_edge('a', 'nowhere')
+
+    def test_complete(self):
+        world = World(testrules.AddOne(nx.complete_graph(10)))
+        world.dispersal
+
+        world.remove_patch(3)
+        assert world.complete
+        assert len(world.dispersal.distribution(0)) == 9
+
+        world.remove_edge(0, 1)
+        assert not world.complete
+        assert 1 not in world.dispersal.distribution(0)
+
+    def test_rules_told(self):
+        """ The rules hear which patch was removed and which one took its index """
+        calls = []
+        rules = testrules.AddOneArray(nx.path_graph(5))
+        rules.patch_removed = lambda world, index: calls.append(('removed', index))
+        rules.patch_moved = lambda world, old, new: calls.append(('moved', old, new))
+        world = World(rules)
+
+        world.remove_patch(1)
+        world.remove_patch(3)  # The last patch by now, so nothing moves
+
+        assert calls == [('removed', 1), ('moved', 4, 1), ('removed', 3)]
+
+    def test_running_nstrain(self, random_nstrain_world):
+        world = random_nstrain_world(n=500, update_mode="eq")
+        world.rules.set_initial_conditions(world)
+        world.step(3)
+        last = world.state['v_populations'][-1].copy()
+
+        world.remove_patch(0)
+        assert world.num_patches == 499 == len(world.state['v_populations'])
+        assert (world.state['v_populations'][0] == last).all()
+
+        assert world.step(3) == 3
+        assert world.rules.total_pop > 0
+
+
+class TestShardedUpdates:
+    """ Updating the patches in blocks on several threads gives the same result as one at a time """
+
+    @pytest.mark.parametrize("update_mode", ["discrete", "eq"])
+    def test_same_as_sequential(self, random_nstrain_world, update_mode):
+        sequential = random_nstrain_world(seed=7, n=500, update_mode=update_mode)
+        sharded = random_nstrain_world(seed=7, n=500, update_mode=update_mode, update_workers=4)
+
+        for _ in range(3):
+            sequential.update_patches()
+            sharded.update_patches()
+
+        for name in ['v_populations', 's_populations', 'resources']:
+            assert np.allclose(sequential.state[name], sharded.state[name])
+
+    def test_custom_patches(self, random_nstrain_world):
+        """ Patches with their own update function still use it """
+        world = random_nstrain_world(seed=1, n=500, update_mode="discrete", update_workers=3)
+        world.patches[10].change_update_function(general.pass_)
+        before = world.state['v_populations'][10].copy()
+
+        world.update_patches()
+
+        assert (world.state['v_populations'][10] == before).all()
+        assert not (world.state['v_populations'][11:] == 0).all()
+
+    def test_close(self, random_nstrain_world):
+        """ close shuts the thread pool down, and a later update makes a new one """
+        world = random_nstrain_world(n=100, update_mode="discrete", update_workers=3)
+        world.update_patches()
+        executor = world._executor
+        assert executor is not None
+
+        world.close()
+        assert world._executor is None
+        assert executor._shutdown
+
+        world.update_patches()
+        assert world._executor is not None
+        world.close()
+
+
+class TestHistorian:
+
+    def series_of(self, ages, **kwargs):
+        historian = World(testrules.AddOne(nx.complete_graph(1))).history
+        historian.watch('age', lambda w: [w.age, -w.age], **kwargs)
+        world = type('FakeWorld', (), {})()
+        for age in ages:
+            world.age = age
+            historian.record(world)
+        return historian
+
+    def test_grows(self):
+        generations, values = self.series_of(range(200), every=3)['age']
+        assert generations.tolist() == list(range(0, 200, 3))
+        assert values.shape == (67, 2)
+        assert values[-1].tolist() == [198, -198]
+
+    def test_ring(self):
+        generations, values = self.series_of(range(100), capacity=10)['age']
+        assert generations.tolist() == list(range(90, 100))
+        assert values[:, 0].tolist() == list(range(90, 100))
+
+    def test_downsample(self):
+        historian = self.series_of(range(100), capacity=10, downsample=True)
+        generations, _ = historian['age']
+        assert len(generations) <= 10
+        assert generations[0] == 0 and generations[-1] >= 80
+        assert (generations % historian.series['age'].every == 0).all()
+
+    def test_spill(self, tmp_path):
+        historian = World(testrules.AddOne(nx.complete_graph(1))).history
+        historian.spill_dir = str(tmp_path)
+        historian.watch('age', lambda w: w.age, capacity=8, spill=True)
+        world = type('FakeWorld', (), {})()
+        for age in range(30):
+            world.age = age
+            historian.record(world)
+
+        assert len(historian.series['age'].spilled) == 3
+        generations, values = historian['age']
+        assert generations.tolist() == values.tolist() == list(range(30))
+
+        historian.save(tmp_path / "history.npz")
+        assert np.load(tmp_path / "history.npz")['age_values'].tolist() == list(range(30))
+
+    def test_recorded_by_step(self):
+        world = complete_world()
+        world.rules.census = lambda w: None
+        world.rules.stop_condition = lambda w: False
+        world.history.watch('total', lambda w: sum(patch.populations for patch in w.patches), every=2)
+        world.step(6)
+        generations, values = world.history['total']
+        assert generations.tolist() == [0, 2, 4]
+        assert values[1] - values[0] == 2 * 5
+
+
+class TestVectorRules:
+
+    def test_update_and_kill(self):
+        rules = testrules.VectorAddOne(nx.complete_graph(6))
+        world = World(rules)
+        for _ in range(3):
+            world.update_patches()
+        assert list(world.state['populations']) == [3] * 6
+        assert [patch.populations for patch in world.patches] == [3] * 6
+
+        rules.deaths = lambda w, rng: np.arange(w.num_patches) % 2 == 0
+        world.patches[2].populations = 10
+        rules.kill_patches(world)
+        assert list(world.state['populations']) == [0, 3, 0, 3, 0, 3]
+
+    def test_disperse_reads_old_state(self):
+        rules = testrules.VectorAddOne(nx.complete_graph(4), spread=True)
+        world = World(rules)
+        world.state['populations'][:] = [1, 0, 2, 0]
+        rules.colonize(world)
+        assert list(world.state['populations']) == [0, 1, 1, 1]
+
+    def test_simulate(self):
+        rules = testrules.VectorAddOne(nx.complete_graph(5), spread=True)
+        rules.stop_condition = lambda world: world.age >= 4
+        rules.census = lambda world: None
+        world = World(rules)
+        assert world.step(10) == 4
+        assert world.state['populations'].sum() == 20
+
+    def test_patch_update_shares_rng(self):
+        """ The patches updated one at a time in a generation share one generator """
+        rngs = []
+        rules = testrules.VectorAddOne(nx.complete_graph(3))
+        rules.update = lambda world, rows, rng: rngs.append(rng)
+        world = World(rules)
+        for _ in range(2):
+            rules.before_update(world)
+            for patch in world.patches:
+                rules.patch_update(patch)
+
+        assert rngs[0] is rngs[1] is rngs[2]
+        assert rngs[3] is rngs[4] is rngs[5]
+        assert rngs[0] is not rngs[3]
+
+    def test_adapter_runs_legacy_rules(self):
+        world = World(LegacyRulesAdapter(testrules.AddOne(nx.complete_graph(5))))
+        for _ in range(2):
+            world.update_patches()
+        assert [patch.populations for patch in world.patches] == [2] * 5
+
+        world.rules.reset(world, np.array([0, 3]))
+        assert [patch.populations for patch in world.patches] == [0, 2, 2, 0, 2]
+
+    def test_adapter_same_as_unwrapped(self, nstrain_rules):
+        def run(wrap):
+            random._inst.seed(4)  # NStrain replaces random.seed
+            rules = nstrain_rules(stop_time=20)
+            rules.reporter.silent = True
+            world = World(LegacyRulesAdapter(rules) if wrap else rules)
+            world.rules.set_initial_conditions(world)
+            world.step(20)
+            return world.state['v_populations'].copy(), world.state['s_populations'].copy()
+
+        (v, s), (wrapped_v, wrapped_s) = run(False), run(True)
+        assert np.array_equal(v, wrapped_v) and np.array_equal(s, wrapped_s)
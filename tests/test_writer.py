@@ -0,0 +1,65 @@
+import gzip
+import random
+import shutil
+import threading
+
+import pytest
+
+import main
+from world import World
+from writer import AsyncWriter
+
+
+class TestAsyncWriter:
+
+    def test_order_and_formatting(self, tmp_path):
+        writer = AsyncWriter(maxsize=2)
+        path = str(tmp_path / "out.csv")
+        for i in range(50):
+            writer.write(path, lambda a, b: f"{a},{b}\n", i, i * i)
+        writer.write(path, "end\n")
+        writer.flush()
+
+        lines = open(path).read().splitlines()
+        assert lines[:3] == ["0,0", "1,1", "2,4"]
+        assert lines[-1] == "end" and len(lines) == 51
+        writer.close()
+
+    def test_formatted_on_writer_thread(self, tmp_path):
+        writer = AsyncWriter()
+        threads = []
+        writer.write(str(tmp_path / "out.csv"), lambda: threads.append(threading.current_thread()) or "x")
+        writer.close()
+        assert threads and threads[0] is not threading.current_thread()
+
+    def test_gzip(self, tmp_path):
+        writer = AsyncWriter()
+        path = str(tmp_path / "out.csv.gz")
+        writer.write(path, "a,b\n")
+        writer.write(path, "c,d\n")
+        writer.close()
+        with gzip.open(path, 'rt') as file:
+            assert file.read() == "a,b\nc,d\n"
+
+    def test_errors_raised(self, tmp_path):
+        writer = AsyncWriter()
+        writer.write(str(tmp_path / "out.csv"), lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            writer.flush()
+        writer.close()
+
+
+class TestNStrainAsyncOutput:
+
+    def run(self, nstrain_rules, name, async_output):
+        random._inst.seed(12)
+        rules = nstrain_rules(folder_name=name, save_data=True, stop_time=30, data_save_step=5,
+                              async_output=async_output)
+        rules.reporter.silent = True
+        main.simulate(World(rules))
+        files = [open(f"{rules.data_path}/{file}").read() for file in ["totals.csv", "final_eq.csv"]]
+        shutil.rmtree(rules.data_path)
+        return files
+
+    def test_same_files(self, nstrain_rules):
+        assert self.run(nstrain_rules, "test_writer_sync", False) == self.run(nstrain_rules, "test_writer_async", True)
@@ -8,17 +8,33 @@ The world also has the 'worldmap' which is a networkx weighted directed graph th
 are connected together. The colonize function references this map.
 
 Patches are generated from the world map, but they do not exist in the world map.
-The map is just a reference (that may change). Every patch has an id associating a map-node to the patch.
+The map is just a reference (that may change). Every patch has an id associating a map-node to the patch,
+and an index which is its position in world.patches. world.node_index maps ids to indices and world.nodes maps
+indices back to ids, so any hashable node label works (tuples from nx.grid_2d_graph, strings from a file, ...).
+Neighbor lookups go through world.neighbors, the worldmap compiled into lists of indices, and dispersal (where a
+propagule leaving a patch lands) through world.dispersal, which follows the direction and weights of the edges.
+Complete graphs are detected, and then neither is compiled since a random neighbor is just a random patch.
+The map can change during a run through add_patch, remove_patch, add_edge and remove_edge, which update everything
+that depends on the map in place instead of rebuilding the world.
 
-The world also contains a Historian, which is a class that outputs
+The state of all patches can be allocated at once by the rules (see Rules.allocate_state), in which case the
+patch attributes are rows of the arrays in world.state.
 
+The world also contains a Historian (world.history), which keeps the history of the observables we tell it to watch
+in memory.
 
 """
 import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from general import pass_
-from patch import Patch
+from patch import Patch, patch_class
 from rules import Rules
+from worldmap import (CompleteAdjacency, CompleteDispersal, DispersalTable, complete_weight, in_neighbors,
+                      index_adjacency, node_neighbor_indices)
 
 
 class World:
@@ -41,46 +57,323 @@ class World:
         self.age = 0
         self.worldmap = rules.worldmap
 
-        self.history = {}  # A dictionary
+        self.history = Historian()  # The in memory history of the run. See Historian
+        self._executor = None  # The thread pool for update_patches, made when first needed, see close
+        self._executor_workers = 0  # How many threads it has
+        self.custom_patches = set()  # The patches that is_custom, kept up to date by the patches themselves
 
+        self._safety_check()
         self.patches = self.init_patches(self.worldmap)
 
-        logging.info("{} created.".format(self.name))
-        logging.debug("{} __dict__: {}".format(self.name, self.__dict__))
+        logging.info("{} created with {} patches.".format(self.name, len(self.patches)))
+
+    def _safety_check(self):
+        """ A quick check to make sure the world is well defined before the patches are made. """
+
+        if self.worldmap is None:
+            error = "World {} has no worldmap!".format(self.name)
+            logging.critical(error)
+            raise Exception(error)
 
     def init_patches(self, world_map):
         """
-        Initialize the patches by generating them from the world map and adding them to the patches list.
-        Also sets the patch_update function for each patch to be the world's default patch patch_update function
-        and the default populations.
+        Initialize the patches from the world map.
+
+        This is done in bulk. Each node label is given a dense integer index (its position in world.nodes), the
+        rules allocate the state of every patch at once (see Rules.allocate_state), and the Patch objects themselves
+        are only made when they are first accessed through world.patches.
 
         Args:
             world_map: networkx directed graph
 
         Returns:
-            a list of patches
+            a PatchList, which acts like a list of patches
+        """
+
+        self.nodes = list(world_map.nodes())  # index → node label
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}  # node label → index
+        self._neighbors = None  # Compiled on first use, see neighbors
+        self._dispersal = None  # Same, see dispersal
+        self._complete = None  # The edge weight if the worldmap is a complete graph, False if it isn't
+
+        self.state = self.rules.allocate_state(self)
+        if self.state is None:
+            self.state = {}
+        self._state_buffers = dict(self.state)  # world.state are views of these, which have room to grow
+        self.patch_class = patch_class(tuple(self.state), getattr(self.rules, "patch_defaults", None),
+                                       getattr(self.rules, "patch_slots", ()))
+
+        return PatchList(self)
+
+    @property
+    def num_patches(self):
+        return len(self.nodes)
+
+    @property
+    def complete(self):
+        """ True if the worldmap is a complete graph with equal weights, see worldmap.complete_weight. """
+        if self._complete is None:
+            weight = complete_weight(self.worldmap, getattr(self.rules, "dispersal_weight", "weight"))
+            self._complete = weight if weight is not None else False
+        return self._complete is not False
+
+    @property
+    def neighbors(self):
+        """
+        The worldmap as neighbor lists of patch indices: world.neighbors[i] are the indices of the neighbors of patch i.
+        Built the first time it is needed so that worlds which never look at their neighbors don't pay for it.
+        """
+        if self._neighbors is None:
+            if self.complete:
+                self._neighbors = CompleteAdjacency(self.num_patches)
+            else:
+                self._neighbors = index_adjacency(self.worldmap, self.node_index)
+        return self._neighbors
+
+    @property
+    def dispersal(self):
+        """
+        The DispersalTable of the worldmap, built the first time it is needed. Which edge attribute holds the weights
+        and how likely a propagule is to stay on its own patch are set by rules.dispersal_weight and
+        rules.dispersal_self_weight.
+        """
+        if self._dispersal is None:
+            weight = getattr(self.rules, "dispersal_weight", "weight")
+            self_weight = getattr(self.rules, "dispersal_self_weight", 1.0)
+            if self.complete:
+                self._dispersal = CompleteDispersal(self.num_patches, self._complete, self_weight)
+            else:
+                self._dispersal = DispersalTable(self.worldmap, self.node_index, weight=weight, self_weight=self_weight)
+        return self._dispersal
+
+    def get_patch(self, node):
+        """ Returns the patch that belongs to the given worldmap node. """
+        return self.patches[self.node_index[node]]
+
+    def add_patch(self, node):
+        """
+        Adds a node to the worldmap during a run, along with a freshly reset patch for it. Connect it with add_edge.
+
+        The new patch gets the next index. The state arrays keep spare rows, so adding patches one at a time takes
+        amortized constant time.
+
+        Args:
+            node: The label of the new node
+
+        Returns:
+            The new patch
+        """
+
+        if node in self.node_index:
+            raise ValueError(f"{node} is already in the worldmap of {self.name}.")
+
+        self.worldmap.add_node(node)
+        i = len(self.nodes)
+        self.nodes.append(node)
+        self.node_index[node] = i
+        self._resize_state(i + 1)
+        self.patches._patches.append(None)
+
+        if self._complete:
+            self._forget_map()  # A complete map is no longer complete
+        else:
+            if self._neighbors is not None:
+                self._neighbors.append([])
+            if self._dispersal is not None:
+                self._dispersal.build_node(node)
+
+        patch = self.patches[i]
+        self.rules.reset_patch(patch)
+        return patch
+
+    def remove_patch(self, node):
+        """
+        Removes a node and its patch from the world during a run, for example to model habitat loss.
+
+        To keep the indices dense the last patch takes over the index of the removed one, so only the removed node
+        and the nodes around it and around the last node are recompiled. The removed patch object is left
+        with index None. The rules are told through Rules.patch_removed and Rules.patch_moved.
+
+        Args:
+            node: The label of the node to remove
+        """
+
+        i = self.node_index[node]
+        last = len(self.nodes) - 1
+        last_node = self.nodes[last]
+        # The tables that point at the removed or the moved patch, and the moved patch's own (it points at itself)
+        affected = in_neighbors(self.worldmap, node) + in_neighbors(self.worldmap, last_node) + [last_node]
+        affected = dict.fromkeys(affected)
+        affected.pop(node, None)
+
+        self.worldmap.remove_node(node)
+        self.rules.patch_removed(self, i)
+
+        # Move the last patch into the hole
+        for array in self.state.values():
+            array[i] = array[last]
+        self._resize_state(last)
+
+        patches = self.patches._patches
+        removed = patches[i]
+        moved = patches[last]
+        patches[i] = moved
+        patches.pop()
+        if moved is not None:
+            moved.index = i
+        if removed is not None:
+            removed.index = None
+            self.custom_patches.discard(removed)
+
+        self.nodes[i] = last_node
+        self.nodes.pop()
+        self.node_index[last_node] = i
+        del self.node_index[node]
+        if i != last:
+            self.rules.patch_moved(self, last, i)
+
+        if self._complete:  # Still complete, just smaller
+            n = self.num_patches
+            if self._neighbors is not None:
+                self._neighbors = CompleteAdjacency(n)
+            if self._dispersal is not None:
+                self._dispersal = CompleteDispersal(n, self._complete, self._dispersal.self_weight)
+        else:
+            if self._neighbors is not None:
+                self._neighbors[i] = self._neighbors[last]
+                self._neighbors.pop()
+            if self._dispersal is not None:
+                self._dispersal.move(last, i)
+            self._recompile(affected)
+
+    def add_edge(self, u, v, **attr):
+        """
+        Adds an edge to the worldmap during a run, or changes the attributes (such as the weight) of an existing one.
+        Both nodes must already have patches, see add_patch.
+        """
+
+        if u not in self.node_index or v not in self.node_index:
+            raise ValueError(f"Both ends of the edge {u} - {v} must be patches of {self.name}. Use add_patch first.")
+
+        self.worldmap.add_edge(u, v, **attr)
+        self._recompile([u] if self.worldmap.is_directed() else [u, v])
+
+    def remove_edge(self, u, v):
+        """ Removes an edge from the worldmap during a run. """
+
+        self.worldmap.remove_edge(u, v)
+        self._recompile([u] if self.worldmap.is_directed() else [u, v])
+
+    def _recompile(self, nodes):
+        """ Brings the compiled neighbor lists and dispersal tables up to date for nodes whose out edges changed. """
+
+        if self._complete:
+            self._forget_map()  # The map may not be complete anymore, so check again when next needed
+            return
+
+        for node in nodes:
+            if self._neighbors is not None:
+                self._neighbors[self.node_index[node]] = node_neighbor_indices(self.worldmap, node, self.node_index)
+            if self._dispersal is not None:
+                self._dispersal.build_node(node)
+
+    def _forget_map(self):
+        """ Throw away everything compiled from the map. It is compiled again when next needed. """
+        self._complete = None
+        self._neighbors = None
+        self._dispersal = None
+
+    def set_state(self, name, array):
+        """
+        Replaces the state array called name, for example when the rules change how many columns it has.
+        The array needs a row for each patch.
+        """
+
+        if len(array) != self.num_patches:
+            raise ValueError(f"The new {name} has {len(array)} rows, but there are {self.num_patches} patches.")
+        self._state_buffers[name] = array
+        self.state[name] = array[:self.num_patches]
+
+    def _resize_state(self, n):
+        """ Makes the state arrays n rows long, growing their buffers (to double the size) when they are full. """
+
+        for name, buffer in self._state_buffers.items():
+            if n > len(buffer):
+                grown = np.zeros((max(n, 2 * len(buffer)),) + buffer.shape[1:], dtype=buffer.dtype)
+                used = len(self.state[name])
+                grown[:used] = buffer[:used]
+                self._state_buffers[name] = buffer = grown
+            self.state[name] = buffer[:n]
+
+    def step(self, n=1):
         """
+        Runs up to n generations. See Rules.step.
 
-        patches = []
-        for node in world_map.nodes():
-            new_patch = Patch(node, self)
-            patches.append(new_patch)
-            logging.info("Worldmap node {} mapped to patch {}.".format(str(node), new_patch.id))
+        Returns:
+            How many generations were run. Less than n only if the stop condition was reached.
+        """
 
-        return patches
+        return self.rules.step(self, n)
 
     def update_patches(self):
         """
         Go through each patch and patch_update it with the patch_update function the patch owns.
 
+        If rules.update_workers is more than one the patches are instead split into that many blocks, which are
+        updated at the same time in a thread pool with rules.update_block. (With rules.block_updates the patches go
+        through update_block even with one worker.) Each block gets its own numpy random
+        generator, seeded from random, so a seeded run gives the same result every time. Patches with their own
+        update function or parameters (see Patch.is_custom) are updated one at a time afterwards.
+
         Warnings: This assumes patch patch_update functions do not depend on other patches.
         This goes through each patch is sequential order, and dynamics will change depending on the order if
         patches interact during this step.
         """
 
+        self.rules.before_update(self)
+
+        workers = getattr(self.rules, "update_workers", 1)
+        if workers > 1 or getattr(self.rules, "block_updates", False):
+            self._update_sharded(max(workers, 1))
+            return
+
         for patch in self.patches:
             patch.update()
 
+    def _update_sharded(self, workers):
+        """ Updates the patches in blocks on workers threads. See update_patches. """
+
+        custom = sorted(self.custom_patches, key=lambda patch: patch.index)
+        rows = np.arange(self.num_patches)
+        if custom:
+            rows = np.delete(rows, [patch.index for patch in custom])
+
+        blocks = [block for block in np.array_split(rows, workers) if len(block)]
+        seeds = np.random.SeedSequence(random.getrandbits(64)).spawn(len(blocks))
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+
+        if len(blocks) == 1:  # No need for threads
+            self.rules.update_block(self, blocks[0], rngs[0])
+        elif blocks:
+            if self._executor_workers != workers:
+                self.close()
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{self.name} update")
+                self._executor_workers = workers
+            update_block = self.rules.update_block
+            for _ in self._executor.map(lambda args: update_block(self, *args), zip(blocks, rngs)):
+                pass  # Going through the results raises any error from the threads
+
+        for patch in custom:
+            patch.update()
+
+    def close(self):
+        """ Shuts down the thread pool of update_patches, if there is one. The world can still be run afterwards. """
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+            self._executor_workers = 0
+
     # #The below don't work and always return the exceptions. This is not important, just annoying in the logs.
     # def __str__(self):
     #     try:
@@ -95,9 +388,218 @@ class World:
     #         return "reeeeee"
 
 
-class Historian():
+class PatchList:
+    """
+    Acts like the list of patches in a world, but only makes a Patch object the first time it is accessed.
+    Building a world is then only as expensive as allocating its state.
+    """
+
+    def __init__(self, world):
+        self.world = world
+        self._patches = [None] * len(world.nodes)
+
+    def __len__(self):
+        return len(self._patches)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self._patches)))]
+
+        patch = self._patches[i]
+        if patch is None:
+            if i < 0:
+                i += len(self._patches)
+            patch = self.world.patch_class(self.world.nodes[i], self.world, index=i)
+            self._patches[i] = patch
+        return patch
+
+    def __iter__(self):
+        patches = self._patches
+        for i, patch in enumerate(patches):
+            if patch is None:
+                patch = self[i]
+            yield patch
+
+    def materialized(self):
+        """ The number of patch objects that have actually been made. """
+        return sum(1 for patch in self._patches if patch is not None)
+
+    def materialized_patches(self):
+        """ The patch objects that have actually been made, without making any others. """
+        return [patch for patch in self._patches if patch is not None]
+
+
+class Series:
+    """
+    The history of one observable of a Historian: the generations it was recorded at and its values, held in
+    preallocated numpy arrays. They are made at the first record, when the shape and type of the values is known.
+
+    Without a capacity the arrays double in size when they fill up. With a capacity, once they are full either
+        - the oldest value is dropped (a ring buffer, the default),
+        - every other value is dropped and from then on only every other generation is recorded (downsample), so
+          the whole run is kept at a coarser and coarser resolution, or
+        - the values are spilled to an npz file in spill_dir and the buffer starts over.
+    """
+
+    def __init__(self, name, measure, every=1, capacity=None, downsample=False, spill_dir=None):
+        self.name = name
+        self.measure = measure
+        self.every = every
+        self.capacity = capacity
+        self.downsample = downsample
+        self.spill_dir = spill_dir
+
+        self.generations = None
+        self.values = None
+        self._start = 0  # Where the oldest value is, once the ring buffer has wrapped around
+        self._count = 0
+        self.spilled = []  # The files spilled to, oldest first
+
+    def record(self, generation, value):
+        value = np.asarray(value)
+        if self.values is None:
+            size = self.capacity or 64
+            self.values = np.empty((size,) + value.shape, dtype=value.dtype)
+            self.generations = np.empty(size, dtype=np.int64)
+        if self._count == len(self.values):
+            self._make_room()
+
+        i = (self._start + self._count) % len(self.values)
+        self.values[i] = value
+        self.generations[i] = generation
+        self._count += 1
+
+    def _make_room(self):
+        generations, values = self.in_memory()
+
+        if self.capacity is None:  # Grow
+            self.values = np.empty((2 * len(values),) + values.shape[1:], dtype=values.dtype)
+            self.generations = np.empty(2 * len(values), dtype=np.int64)
+            self._start = 0
+            self.values[:len(values)] = values
+            self.generations[:len(values)] = generations
+
+        elif self.downsample:
+            self.every *= 2
+            keep = generations % self.every == 0
+            kept = int(keep.sum())
+            self._start = 0
+            self._count = kept
+            self.values[:kept] = values[keep]
+            self.generations[:kept] = generations[keep]
+
+        elif self.spill_dir is not None:
+            path = f"{self.spill_dir}/{self.name}_{len(self.spilled):04d}.npz"
+            np.savez(path, generations=generations, values=values)
+            self.spilled.append(path)
+            self._start = 0
+            self._count = 0
+
+        else:  # Drop the oldest
+            self._start = (self._start + 1) % len(self.values)
+            self._count -= 1
+
+    def in_memory(self):
+        """ The (generations, values) still in memory, oldest first. Copies. """
+
+        if self.values is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        order = (self._start + np.arange(self._count)) % len(self.values)
+        return self.generations[order], self.values[order]
+
+    def history(self):
+        """ The (generations, values) of the whole history, including any spilled to disk. """
+
+        generations, values = self.in_memory()
+        if not self.spilled:
+            return generations, values
+        parts = [np.load(path) for path in self.spilled]
+        return (np.concatenate([part['generations'] for part in parts] + [generations]),
+                np.concatenate([part['values'] for part in parts] + [values]))
+
+    def __len__(self):
+        return self._count
+
+
+class Historian:
     """
-    The Historian watches the parameters we tell them to and outputs it in a log.
+    The Historian watches the observables we tell it to and keeps their history in memory, so analysis and
+    convergence checks can read it during or after a run without going through the data files.
+
+    An observable is a function of the world, recorded every so many generations by Rules.step right after
+    census. Its values can be numbers or arrays (of the same shape each time). See Series for what happens when
+    the memory for an observable fills up.
 
-    By default the Historian only watches the patches.
+        world.history.watch('resources', lambda world: world.state['resources'].sum(), every=10)
+        generations, values = world.history['resources']
     """
+
+    def __init__(self, spill_dir=None):
+        """
+        Args:
+            spill_dir: The folder spilled observables write their npz files to
+        """
+
+        self.spill_dir = spill_dir
+        self.series = {}  # {name: Series}
+
+    def watch(self, name, measure, every=1, capacity=None, downsample=False, spill=False):
+        """
+        Starts recording an observable. Watching a name again starts its history over.
+
+        Args:
+            name: The name to look the history up by
+            measure: A function of the world that returns the value
+            every: Record every this many generations
+            capacity: How many values to keep in memory. None to keep them all.
+            downsample: If true, keep the whole run at a lower resolution when capacity is reached
+            spill: If true, spill to spill_dir when capacity is reached
+
+        Returns:
+            The Series
+        """
+
+        if spill and self.spill_dir is None:
+            raise ValueError(f"Can't spill {name}, since the historian has no spill_dir.")
+        series = Series(name, measure, every, capacity, downsample, self.spill_dir if spill else None)
+        self.series[name] = series
+        return series
+
+    def unwatch(self, name):
+        self.series.pop(name, None)
+
+    def record(self, world):
+        """ Records the observables that are due this generation. """
+
+        age = world.age
+        for series in self.series.values():
+            if age % series.every == 0:
+                series.record(age, series.measure(world))
+
+    def generations_until_due(self, age):
+        """ How many generations from age until an observable is next recorded, 0 if one is due at age. None if
+        nothing is watched. """
+
+        waits = [-age % series.every for series in self.series.values()]
+        return min(waits) if waits else None
+
+    def save(self, path):
+        """ Saves the whole history to an npz file, as arrays <name>_generations and <name>_values. """
+
+        arrays = {}
+        for name, series in self.series.items():
+            arrays[f"{name}_generations"], arrays[f"{name}_values"] = series.history()
+        np.savez(path, **arrays)
+
+    def __getitem__(self, name):
+        """ The (generations, values) of an observable. """
+        return self.series[name].history()
+
+    def __contains__(self, name):
+        return name in self.series
+
+    def __len__(self):
+        return len(self.series)
+
+    def __repr__(self):
+        return f"Historian({ {name: len(series) for name, series in self.series.items()} })"
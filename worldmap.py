@@ -6,6 +6,7 @@ Note that the worldmap is just a map; no information is contained in the nodes.
 
 """
 
+import networkx as nx
 
 
 # class Worldmap():
@@ -18,3 +19,275 @@ Note that the worldmap is just a map; no information is contained in the nodes.
 #         Args:
 #             nx_graph: A networkx graph
 #         """
+
+
+def index_adjacency(graph, node_index):
+    """
+    Compiles the graph into neighbor lists of dense patch indices, so that neighbor lookups never touch the
+    node labels.
+
+    For directed graphs these are the successors of each node, which is where a propagule leaving the node can land.
+    Self loops are left out; whether a patch counts as its own neighbor is up to the caller.
+
+    Args:
+        graph: The networkx worldmap
+        node_index: A dictionary from node label to patch index (world.node_index)
+
+    Returns:
+        A list where entry i is the list of indices of the neighbors of patch i.
+    """
+
+    adjacency = [None] * len(node_index)
+    for node in graph.nodes():
+        adjacency[node_index[node]] = node_neighbor_indices(graph, node, node_index)
+    return adjacency
+
+
+def node_neighbor_indices(graph, node, node_index):
+    """ The entry of index_adjacency for a single node. Used to update the adjacency when the map changes. """
+    return [node_index[nb] for nb in graph[node] if nb != node]
+
+
+def in_neighbors(graph, node):
+    """ The nodes with an edge into node, other than node itself. These are the nodes whose dispersal uses the node. """
+    nbs = graph.predecessors(node) if graph.is_directed() else graph[node]
+    return [nb for nb in nbs if nb != node]
+
+
+def alias_table(weights):
+    """
+    Builds Walker's alias table for sampling from a discrete distribution in constant time.
+
+    To sample, draw u uniform in [0, len(weights)), let k = int(u). Return k if u - k < prob[k], otherwise alias[k].
+
+    Args:
+        weights: A list of non-negative weights, not all zero
+
+    Returns:
+        The lists (prob, alias)
+    """
+
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s = small.pop()
+        l = large[-1]
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(large.pop())
+
+    # Whatever is left over is 1 up to rounding error, so keeps prob 1.0
+    return prob, alias
+
+
+class DispersalTable:
+    """
+    Where a propagule leaving a patch lands, precompiled from the worldmap so that each draw takes constant time.
+
+    The chance of moving from node u to node v is proportional to the weight of the edge u → v (for directed graphs
+    only the out edges count). Edges without the weight attribute have weight 1, so an unweighted map gives a uniform
+    choice. A patch is its own neighbor with weight self_weight unless the map has an explicit self loop, in which
+    case the weight of the loop is used.
+
+    For each patch index i, targets[i] are the indices it can disperse to and prob[i], alias[i] its alias table.
+    """
+
+    def __init__(self, graph, node_index, weight="weight", self_weight=1.0):
+        """
+        Args:
+            graph: The networkx worldmap
+            node_index: A dictionary from node label to patch index (world.node_index)
+            weight: The name of the edge attribute that holds the dispersal weight. If None all edges have weight 1.
+            self_weight: The weight of staying on the same patch, if the map has no self loop. None or 0 means a
+                         propagule always leaves.
+        """
+
+        self.graph = graph
+        self.node_index = node_index
+        self.weight = weight
+        self.self_weight = self_weight
+
+        n = len(node_index)
+        self.targets = [None] * n
+        self.prob = [None] * n
+        self.alias = [None] * n
+        for node in graph.nodes():
+            self.build_node(node)
+
+    def build_node(self, node):
+        """ (Re)compiles the table of a single node, for example after its out edges changed. """
+
+        i = self.node_index[node]
+        if i == len(self.targets):  # A new node
+            self.targets.append(None)
+            self.prob.append(None)
+            self.alias.append(None)
+        targets = []
+        weights = []
+        has_loop = False
+        for nb, data in self.graph[node].items():
+            w = data.get(self.weight, 1.0) if self.weight is not None else 1.0
+            if w < 0:
+                raise ValueError(f"Edge {node} -> {nb} has negative dispersal weight {w}.")
+            if nb == node:
+                has_loop = True
+            if w > 0:
+                targets.append(self.node_index[nb])
+                weights.append(w)
+
+        if not has_loop and self.self_weight:
+            targets.append(i)
+            weights.append(self.self_weight)
+
+        self.targets[i] = targets
+        if targets:
+            self.prob[i], self.alias[i] = alias_table(weights)
+        else:
+            self.prob[i], self.alias[i] = [], []
+
+    def move(self, src, dst):
+        """
+        Moves the table of index src to index dst and drops the last entry, following World.remove_patch.
+        Tables that point to src have to be rebuilt afterwards.
+        """
+
+        self.targets[dst] = self.targets[src]
+        self.prob[dst] = self.prob[src]
+        self.alias[dst] = self.alias[src]
+        for table in (self.targets, self.prob, self.alias):
+            table.pop()
+
+    def sample(self, i, u):
+        """
+        Returns the index of the patch that a propagule leaving patch i lands on, or None if it has nowhere to go.
+
+        Args:
+            i: The index of the patch the propagule leaves
+            u: A uniform random number in [0, 1)
+        """
+
+        targets = self.targets[i]
+        if not targets:
+            return None
+        n = len(targets)
+        u *= n
+        k = int(u)
+        if k == n:  # u * n can round up to n
+            k -= 1
+        if u - k < self.prob[i][k]:
+            return targets[k]
+        return targets[self.alias[i][k]]
+
+    def distribution(self, i):
+        """ The exact chance of landing on each target of patch i, as {index: probability}. Useful for testing. """
+
+        targets = self.targets[i]
+        n = len(targets)
+        dist = {}
+        for k, target in enumerate(targets):
+            p = self.prob[i][k] / n
+            dist[target] = dist.get(target, 0.0) + p
+            if self.prob[i][k] < 1.0:
+                alt = targets[self.alias[i][k]]
+                dist[alt] = dist.get(alt, 0.0) + (1 - self.prob[i][k]) / n
+        return dist
+
+
+def complete_weight(graph, weight="weight"):
+    """
+    Checks if the graph is complete: every node joined to every other node, all edges with the same weight and no self
+    loops. On such a graph a random neighbor is just a random patch, so nothing needs to be compiled.
+
+    Args:
+        graph: The networkx worldmap
+        weight: The name of the edge attribute that holds the weight. If None all edges have weight 1.
+
+    Returns:
+        The weight of the edges if the graph is complete, otherwise None.
+    """
+
+    if graph.is_multigraph():
+        return None
+
+    n = graph.number_of_nodes()
+    pairs = n * (n - 1) if graph.is_directed() else n * (n - 1) // 2
+    if n == 0 or graph.number_of_edges() != pairs or nx.number_of_selfloops(graph) > 0:
+        return None
+
+    if weight is None:
+        return 1.0
+
+    common = None
+    for _, _, w in graph.edges(data=weight, default=1.0):
+        if common is None:
+            common = w
+        elif w != common:
+            return None
+
+    if common is None:  # A single node
+        return 1.0
+    if common <= 0:
+        return None
+    return common
+
+
+class CompleteAdjacency:
+    """ The neighbor lists of a complete graph, made only when asked for. """
+
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return [j for j in range(self.n) if j != i]
+
+
+class CompleteDispersal:
+    """
+    A DispersalTable for complete graphs. Every other patch is equally likely and staying has weight self_weight
+    (relative to edge_weight), so a draw is constant time and nothing is stored per patch.
+    """
+
+    def __init__(self, n, edge_weight=1.0, self_weight=1.0):
+        self.n = n
+        self.edge_weight = edge_weight
+        self.self_weight = self_weight if self_weight else 0
+
+        total = (n - 1) * edge_weight + self.self_weight
+        self.stay = self.self_weight / total if total > 0 else 0.0  # The chance of staying on the same patch
+
+    def sample(self, i, u):
+        """ Same as DispersalTable.sample """
+
+        if u < self.stay:
+            return i
+        if self.n == 1:
+            return None
+
+        k = int((u - self.stay) / (1 - self.stay) * (self.n - 1))
+        if k == self.n - 1:  # Rounding
+            k -= 1
+        return k if k < i else k + 1  # Skip over the patch itself
+
+    def distribution(self, i):
+        """ Same as DispersalTable.distribution """
+
+        dist = {}
+        if self.stay > 0:
+            dist[i] = self.stay
+        if self.n > 1:
+            other = (1 - self.stay) / (self.n - 1)
+            for j in range(self.n):
+                if j != i:
+                    dist[j] = other
+        return dist
@@ -0,0 +1,109 @@
+"""
+The background writer. Appends to output files on a thread of its own, so the simulation doesn't wait on the disk.
+
+The simulation hands the writer text, or a function that makes the text together with the values to make it from,
+and carries on. The writer thread formats, writes (gzip compressed if the path ends in .gz) and keeps the files open
+between writes. The queue is bounded, so if the disk can't keep up the simulation waits for it instead of
+snapshots piling up in memory. flush waits until everything handed over is on disk, and close also closes the files.
+
+An error while writing is raised on the simulation thread by the next call to the writer.
+
+    writer = AsyncWriter()
+    writer.write('save_data/run/totals.csv', format_row, world.age, list(totals))
+    ...
+    writer.close()
+"""
+
+import gzip
+import logging
+import queue
+import threading
+
+
+class AsyncWriter:
+
+    def __init__(self, maxsize=256, name="writer"):
+        """
+        Args:
+            maxsize: How many writes can wait in the queue before write blocks
+            name: The name of the thread
+        """
+
+        self.maxsize = maxsize
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._files = {}  # {path: open file}, only used on the writer thread and once the queue is empty
+        self._thread = None
+        self._error = None
+
+    def write(self, path, data, *args):
+        """
+        Queues text to append to the file at path. Blocks while the queue is full.
+
+        Args:
+            path: The file
+            data: The text, or a function called as data(*args) on the writer thread that returns it. The args must
+                  not change afterwards, so pass copies (lists of the totals, not the state arrays).
+        """
+
+        self._raise()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        self._queue.put((path, data, args))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, data, args = item
+                if self._error is None:  # After an error the rest is dropped
+                    self._file(path).write(data(*args) if callable(data) else data)
+            except Exception as e:
+                logging.error(f"The background writer failed: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _file(self, path):
+        file = self._files.get(path)
+        if file is None:
+            file = gzip.open(path, 'at') if str(path).endswith('.gz') else open(path, 'a')
+            self._files[path] = file
+        return file
+
+    def flush(self):
+        """ Waits until everything queued is written, and flushes the files. """
+
+        self._queue.join()  # The writer thread is now idle, so the files are ours
+        for file in self._files.values():
+            file.flush()
+        self._raise()
+
+    def close(self):
+        """ Flushes, closes the files and stops the thread. Writing again starts a new one. """
+
+        self._queue.join()
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+        self._raise()
+
+    @property
+    def pending(self):
+        """ How many writes are waiting in the queue. """
+        return self._queue.qsize()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def __repr__(self):
+        return f"AsyncWriter({self.pending} pending, {len(self._files)} open files)"